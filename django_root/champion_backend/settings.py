@@ -266,7 +266,34 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REDIS_HOST = environ.get('REDIS_HOST', 'redis')
 REDIS_PORT = environ.get('REDIS_PORT', 6379)
 
+# Общий кеш форм турнирных сеток в redis для всех воркеров
+BRACKET_TOPOLOGY_REDIS_CACHE = environ.get('BRACKET_TOPOLOGY_REDIS_CACHE', 'False') == 'True'
+# Сколько секунд действует предпросмотр сетки (plan_token) для create-bracket/commit/
+BRACKET_PREVIEW_MAX_AGE = int(environ.get('BRACKET_PREVIEW_MAX_AGE', 3600))
+
+# Кеш готового JSON турнира в redis. Ключ содержит версию турнира, которая увеличивается при каждом изменении
+TOURNAMENT_DETAIL_REDIS_CACHE = environ.get('TOURNAMENT_DETAIL_REDIS_CACHE', 'False') == 'True'
+TOURNAMENT_DETAIL_CACHE_TIMEOUT = int(environ.get('TOURNAMENT_DETAIL_CACHE_TIMEOUT', 600))
+
+# Кеш гистограмм цен турниров (GetTournamentsPrices) в redis
+TOURNAMENT_PRICES_REDIS_CACHE = environ.get('TOURNAMENT_PRICES_REDIS_CACHE', 'False') == 'True'
+TOURNAMENT_PRICES_CACHE_TIMEOUT = int(environ.get('TOURNAMENT_PRICES_CACHE_TIMEOUT', 3600))
+
+# Кеш счетчиков фильтров (facets) турниров и любительских матчей в redis
+FACETS_REDIS_CACHE = environ.get('FACETS_REDIS_CACHE', 'False') == 'True'
+FACETS_CACHE_TIMEOUT = int(environ.get('FACETS_CACHE_TIMEOUT', 60))
+
+# Поисковый индекс для фильтров search. Выключен - поиск идет по индексам базы (main.services.search)
+SEARCH_INDEXING = environ.get('SEARCH_INDEXING', 'False') == 'True'
+SEARCH_BACKEND = environ.get('SEARCH_BACKEND', 'main.services.search_index.ElasticsearchBackend')
+ELASTICSEARCH_HOSTS = environ.get('ELASTICSEARCH_HOSTS', 'http://elastic:9200').split(',')
+SEARCH_INDEX_PREFIX = environ.get('SEARCH_INDEX_PREFIX', 'champion')
+# Сколько результатов поиска по индексу попадает в список (40 страниц по PAGE_SIZE). Указано в описании фильтра search (main.filters.SEARCH_HELP_TEXT)
+SEARCH_RESULTS_LIMIT = int(environ.get('SEARCH_RESULTS_LIMIT', 1000))
+
 
 CELERY_BROKER_URL = 'redis://redis:6379'
 CELERY_RESULT_BACKEND = 'redis://redis:6379'
 CELERY_RESULT_EXPIRES = celery_timedelta(seconds=20)
+# В тестах задачи выполняются сразу, без брокера
+CELERY_TASK_ALWAYS_EAGER = 'test' in sys.argv or 'test_coverage' in sys.argv
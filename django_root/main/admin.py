@@ -7,8 +7,33 @@ from main.all_models.subscription import *
 from main.all_models.team import *
 from main.all_models.tournament import *
 from main.all_models.user import *
+from operator import attrgetter
+from main.services.versions import bump_version
 # Register your models here.
 
+
+class VersionedAdmin(admin.ModelAdmin):
+    """Изменения из админки, как и через API, увеличивают версию турнира или матча, от которой зависят ETag и кеш"""
+    version_model = Tournament
+    version_id_attr = 'tournament_id'
+
+    def bump_object_version(self, obj):
+        bump_version(self.version_model, attrgetter(self.version_id_attr)(obj))
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.bump_object_version(obj)
+
+    def delete_model(self, request, obj):
+        self.bump_object_version(obj)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.bump_object_version(obj)
+        super().delete_queryset(request, queryset)
+
+
 # User Group
 class UserAdmin(admin.ModelAdmin):
     list_display = ['email', 'first_name', 'last_name', 'surname']
@@ -25,29 +50,40 @@ admin.site.register(Plan)
 admin.site.register(Transaction)
 
 # Tournament Group
-class TournamentAdmin(admin.ModelAdmin):
+class TournamentAdmin(VersionedAdmin):
+    version_id_attr = 'id'
     list_display = ['name', 'city', 'sport', 'start', 'end']
     search_fields = ['name', 'city', 'description', 'surname', 'start', 'end', 'sport__name', 'enter_prize', 'prize_pool']
     filter_horizontal = ['users_requests', 'teams_requests', 'moderators']
 
-class TournamentStageAdmin(admin.ModelAdmin):
+class TournamentStageAdmin(VersionedAdmin):
     list_display = ['name', 'tournament', 'start', 'end']
     search_fields = ['name', 'tournament__name', 'start', 'end']
 
-class MatchAdmin(admin.ModelAdmin):
+class MatchAdmin(VersionedAdmin):
+    version_id_attr = 'stage.tournament_id'
     list_display = ['participant1', 'participant2', 'stage']
     search_fields = ['stage__name']
 
+class StageResultAdmin(VersionedAdmin):
+    version_id_attr = 'stage.tournament_id'
+
 admin.site.register(Tournament, TournamentAdmin)
 admin.site.register(TournamentStage, TournamentStageAdmin)
-admin.site.register(StageResult)
+admin.site.register(StageResult, StageResultAdmin)
+admin.site.register(Standing, VersionedAdmin)
+admin.site.register(StageFinalizationJob)
 admin.site.register(Match, MatchAdmin)
 admin.site.register(MatchPhoto)
 admin.site.register(Participant)
 admin.site.register(New)
 
 # Private Match Group
-admin.site.register(AmateurMatch)
+class AmateurMatchAdmin(VersionedAdmin):
+    version_model = AmateurMatch
+    version_id_attr = 'id'
+
+admin.site.register(AmateurMatch, AmateurMatchAdmin)
 
 # Court Group
 admin.site.register(CourtFacility)
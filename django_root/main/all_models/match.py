@@ -2,9 +2,10 @@ from django.db import models
 from main.models import User
 from main.all_models.sport import Sport
 from main.enums import *
+from main.all_models.versioned import VersionedSaveMixin
 
 
-class AmateurMatch(models.Model):
+class AmateurMatch(VersionedSaveMixin, models.Model):
     name = models.CharField(max_length=255, verbose_name='Имя матча', db_index=True)
     description = models.CharField(max_length=500, default="", verbose_name='Описание матча')
     start = models.DateTimeField(verbose_name='Дата и время начала матча')
@@ -22,6 +23,7 @@ class AmateurMatch(models.Model):
     canceled = models.BooleanField(default=False)
     city = models.TextField(default="", verbose_name='Город', db_index=True)
     verified = models.BooleanField(default=False, verbose_name='Подтвержден модерацией')
+    version = models.PositiveIntegerField(default=0, verbose_name='Версия (увеличивается при каждом изменении)')
 
     def is_full(self):
         return self.max_participants == self.participants.count()+1
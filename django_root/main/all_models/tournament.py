@@ -1,16 +1,21 @@
 import math
 from turtle import position
 from django.db import models
-from main.enums import MATCH_STATUS, TOURNAMENT_TYPE, TOURNAMENT_BRACKET_TYPE, REGISTER_OPEN_UNTIL
+import uuid
+from datetime import timedelta
+from main.enums import JOB_STATUS, MATCH_STATUS, TOURNAMENT_TYPE, TOURNAMENT_BRACKET_TYPE, REGISTER_OPEN_UNTIL
 from main.models import User
 from main.all_models.sport import Sport
 from main.all_models.team import Team
+from main.all_models.versioned import VersionedSaveMixin
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Sum
+from django.db.models import Case, F, Sum, Value, When, Window
+from django.db.models.functions import RowNumber
  
 
-class Tournament(models.Model):
+class Tournament(VersionedSaveMixin, models.Model):
     name = models.CharField(max_length=255, verbose_name='Название', db_index=True)
+    version = models.PositiveIntegerField(default=0, verbose_name='Версия (увеличивается при каждом изменении)')
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_tournaments', verbose_name='Владелец')
     city = models.TextField(verbose_name='Город', default="")    
     address = models.TextField(verbose_name='Адрес', default="")    
@@ -62,13 +67,16 @@ class Tournament(models.Model):
     group_stage_draw_points = models.FloatField(blank=True, null=True, verbose_name='Очки за ничью (Групповой этап)')
     group_stage_rounds_count = models.IntegerField(blank=True, null=True, verbose_name='Кол-во туров (Групповой этап)', validators=[MinValueValidator(1), MaxValueValidator(20)],)
 
+    def get_registration_end(self):
+        """Время окончания регистрации: начало турнира минус register_open_until"""
+        return self.start - dict(REGISTER_OPEN_UNTIL).get(self.register_open_until, timedelta(minutes=15))
+
     def get_stage_offset(self):    
         """Возвращает оффсет позиции этапов для Двуступенчатых турниров"""
         stage_position_offset = 0
-        if TournamentStage.objects.filter(tournament=self).exists() and self.tournament_type == 1: 
+        if self.tournament_type == 1: 
             # Если создается финальный этап Двуступенчатого турнира
-            groups_count = self.max_participants // self.participants_in_group
-            stage_position_offset = groups_count * self.rounds_count
+            stage_position_offset = self.group_stages_count()
         return stage_position_offset
     
     def get_active_stage(self):
@@ -95,25 +103,28 @@ class Tournament(models.Model):
         return not TournamentStage.objects.filter(tournament=self, ended=False).exists()
 
     def set_qualified_participants(self):
-        """Меняет список участников, которые прошли отбор из групповой стадии"""                
-        for group_number in range(self.groups_count()):
-            first_stage_pos = group_number * self.rounds_count + 1
-            last_stage_pos = (group_number + 1) * self.rounds_count
-
-            group_participants = (
-                Participant.objects
-                .filter(stage_results__stage__tournament=self,
-                        stage_results__stage__position__gte=first_stage_pos,
-                        stage_results__stage__position__lte=last_stage_pos)
-                .annotate(total_score=Sum('stage_results__score'))
-                .order_by('-total_score')
-                .distinct()
-                [:self.final_stage_advance_count]
-            )
-
-            for participant in group_participants:
-                participant.qualified = True
-                participant.save()
+        """
+        Меняет список участников, которые прошли отбор из групповой стадии.
+        Участники ранжируются внутри своих групп одним запросом (ROW_NUMBER() OVER (PARTITION BY группа)),
+        из каждой группы проходят первые final_stage_advance_count
+        """
+        group_results = (
+            StageResult.objects
+            .filter(stage__tournament=self, stage__group__isnull=False)
+            .values('participant', 'stage__group')
+            .annotate(total_score=Sum('score'))
+            .annotate(group_place=Window(
+                expression=RowNumber(),
+                partition_by=F('stage__group'),
+                order_by=[F('total_score').desc(), F('participant')],
+            ))
+            .filter(group_place__lte=self.final_stage_advance_count)
+        )
+        qualified_ids = [result['participant'] for result in group_results]
+
+        Participant.objects.filter(tournament=self).update(
+            qualified=Case(When(id__in=qualified_ids, then=Value(True)), default=Value(False))
+        )
     
     def get_qualified_participants(self):
         return Participant.objects.filter(tournament=self, qualified=True)
@@ -123,7 +134,7 @@ class Tournament(models.Model):
 
     def group_stages_count(self):
         """Возвращает количество этапов Групповой стадии двуступенчтатого турнира"""
-        return self.groups_count() * self.rounds_count
+        return TournamentStage.objects.filter(tournament=self, group__isnull=False).count()
 
     def final_stages_count(self):
         qualified_participants_count = self.get_qualified_participants().count()
@@ -137,7 +148,7 @@ class Tournament(models.Model):
             return self.rounds_count
     
     def get_group_stages(self):
-        return TournamentStage.objects.filter(tournament=self).order_by('position')[:self.group_stages_count()]
+        return TournamentStage.objects.filter(tournament=self, group__isnull=False).order_by('position')
 
     def get_places(self):
         """Возвращает список участников и их мест на турнире"""
@@ -180,6 +191,7 @@ class TournamentStage(models.Model):
     tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='stages', verbose_name='Турнир этапа')
     position = models.IntegerField(default=1, verbose_name='Позиция этапа (какой он идёт по счету)')
     ended = models.BooleanField(default=False, verbose_name='Завершен ли этап')
+    group = models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Номер группы (Групповой этап двуступенчатого турнира)')
     
     class Meta:
         verbose_name = 'Этап турнира'
@@ -220,11 +232,57 @@ class StageResult(models.Model):
     class Meta:
         verbose_name = 'Результат этапа'
         verbose_name_plural = 'Результаты этапов'
+        constraints = [
+            models.UniqueConstraint(fields=['stage', 'participant'], name='unique_stage_result'),
+        ]
 
     def __str__(self):
         return f"{self.participant} - {self.score} очков на этапе {self.stage.name}"
 
 
+class Standing(models.Model):
+    """Строка турнирной таблицы. Обновляется при сохранении результатов матчей и этапов, а не пересчитывается при чтении"""
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='standings', verbose_name='Турнир')
+    participant = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name='standings', verbose_name='Участник')
+    group = models.PositiveSmallIntegerField(default=0, verbose_name='Номер группы (0 - общая таблица или финальная стадия)')
+    points = models.FloatField(default=0, verbose_name='Очки')
+    wins = models.PositiveIntegerField(default=0, verbose_name='Победы')
+    draws = models.PositiveIntegerField(default=0, verbose_name='Ничьи')
+    losses = models.PositiveIntegerField(default=0, verbose_name='Поражения')
+    score_difference = models.IntegerField(default=0, verbose_name='Разница забитых и пропущенных')
+
+    class Meta:
+        verbose_name = 'Строка турнирной таблицы'
+        verbose_name_plural = 'Турнирные таблицы'
+        constraints = [
+            models.UniqueConstraint(fields=['participant', 'group'], name='unique_participant_standing'),
+        ]
+        indexes = [
+            models.Index(fields=['tournament', 'group', '-points', '-score_difference'], name='standing_order_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.participant} - {self.points} очков (группа {self.group})"
+
+
+class StageFinalizationJob(models.Model):
+    """Фоновое завершение этапа. Статус хранится в базе, т.к. результаты celery живут недолго"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='stage_jobs', verbose_name='Турнир')
+    stage = models.ForeignKey(TournamentStage, on_delete=models.CASCADE, related_name='jobs', verbose_name='Этап')
+    status = models.PositiveSmallIntegerField(choices=JOB_STATUS, default=0, verbose_name='Статус')
+    message = models.TextField(blank=True, default='', verbose_name='Результат или ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='Завершена')
+
+    class Meta:
+        verbose_name = 'Задача завершения этапа'
+        verbose_name_plural = 'Задачи завершения этапов'
+
+    def __str__(self):
+        return f"{self.stage} - {self.get_status_display()}"
+
+
 class Match(models.Model):
     scheduled_start = models.DateTimeField(verbose_name='Запланированное время начала', blank=True, null=True)
     actual_start = models.DateTimeField(null=True, blank=True, verbose_name='Фактическое время начала')
@@ -0,0 +1,15 @@
+class VersionedSaveMixin:
+    """
+    Поле version меняется только запросом F('version') + 1 (main.services.versions).
+    Обычный save() его не записывает, иначе значение из памяти затрет увеличение, сделанное после загрузки объекта
+    """
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = [field for field in update_fields if field != 'version']
+        elif not self._state.adding and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'version'
+            ]
+        super().save(*args, **kwargs)
@@ -9,3 +9,6 @@ redis_instance = redis.StrictRedis(
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        from main import signals
@@ -27,6 +27,13 @@ AMATEUR_MATCH_STATUS = (
     (3, 'Отменен'),
 )
 
+JOB_STATUS = (
+    (0, 'В очереди'),
+    (1, 'Выполняется'),
+    (2, 'Завершена'),
+    (3, 'Ошибка'),
+)
+
 MATCH_RESULT = (
     (0, 'Победа'),
     (1, 'Поражение'),
@@ -1,10 +1,21 @@
+import json
 import django_filters
 from main.all_models.match import AmateurMatch
 from main.all_models.tournament import Tournament, Team
-from main.models import User
-from django.db.models import Q
+from main.models import User, get_search_name
+from django.db.models import Case, IntegerField, Q, Value, When
+from main.services.search import search
+from main.services.search_index import search_queryset
+
+# Описание фильтра search в документации API: поиск по индексу возвращает ограниченное количество результатов
+SEARCH_HELP_TEXT = (
+    'Поиск, результаты от наиболее подходящих. '
+    'При включенном поисковом индексе возвращается не больше SEARCH_RESULTS_LIMIT (по умолчанию 1000) результатов'
+)
+
 
 class AmateurMatchFilter(django_filters.FilterSet):
+    search = django_filters.CharFilter(method='filter_search', label=SEARCH_HELP_TEXT)
     name = django_filters.CharFilter(lookup_expr='icontains')
     address = django_filters.CharFilter(lookup_expr='icontains')
     city = django_filters.CharFilter(lookup_expr='icontains')
@@ -23,8 +34,13 @@ class AmateurMatchFilter(django_filters.FilterSet):
         model = AmateurMatch
         fields = ['name', 'address', 'city', 'sport', 'enter_price', 'start']
 
+    def filter_search(self, queryset, name, value):
+        """Поиск по названию, адресу и городу через индекс, от наиболее подходящих"""
+        return search(queryset, value)
+
 
 class TournamentFilter(django_filters.FilterSet):
+    search = django_filters.CharFilter(method='filter_search', label=SEARCH_HELP_TEXT)
     name = django_filters.CharFilter(lookup_expr='icontains')
     # city = django_filters.CharFilter(lookup_expr='icontains')
     
@@ -42,8 +58,13 @@ class TournamentFilter(django_filters.FilterSet):
         model = Tournament
         fields = ['name', 'sport', 'enter_price', 'start']
 
+    def filter_search(self, queryset, name, value):
+        """Поиск по названию через индекс, от наиболее подходящих"""
+        return search(queryset, value)
+
 
 class TeamFilter(django_filters.FilterSet):
+    search = django_filters.CharFilter(method='filter_search', label=SEARCH_HELP_TEXT)
     name = django_filters.CharFilter(lookup_expr='icontains')
 
     sport = django_filters.NumberFilter(field_name='sport__id')
@@ -53,7 +74,13 @@ class TeamFilter(django_filters.FilterSet):
         model = Team
         fields = ['name', 'sport']
 
+    def filter_search(self, queryset, name, value):
+        """Поиск по поисковому индексу, без него - по названию"""
+        found = search_queryset(queryset, value)
+        return found if found is not None else queryset.filter(name__icontains=value)
+
 class UserFilter(django_filters.FilterSet):
+    search = django_filters.CharFilter(method='filter_search', label=SEARCH_HELP_TEXT)
     fullname = django_filters.CharFilter(method='filter_fullname')
 
     class Meta:
@@ -62,14 +89,34 @@ class UserFilter(django_filters.FilterSet):
 
     def filter_fullname(self, queryset, name, value):
         """
-        Custom filter method to search users by splitting the input 'fullname' into parts and
-        searching these parts across first_name, surname, and last_name fields.
+        Поиск по ФИО с начала: первое слово запроса - начало имени или фамилии, остальные - начала любых слов ФИО.
+        Сначала те, чье ФИО (в порядке "имя фамилия" или "фамилия имя") начинается со всего запроса
         """
-        name_parts = value.split()
-        queries = [Q(first_name__icontains=part) | Q(surname__icontains=part) | Q(last_name__icontains=part) for part in name_parts]
-
-        query = queries.pop()
-        for item in queries:
-            query |= item
-
-        return queryset.filter(query)
+        search_name = get_search_name(value)
+        if not search_name:
+            return queryset
+        first_part, *other_parts = search_name.split()
+
+        # Первое слово ищется по индексам search_name и search_surname_name (LIKE 'слово%'), даже из одной буквы.
+        # Остальные слова проверяются только в уже найденных строках
+        queryset = queryset.filter(Q(search_name__startswith=first_part) | Q(search_surname_name__startswith=first_part))
+        for part in other_parts:
+            queryset = queryset.filter(Q(search_name__startswith=part) | Q(search_name__contains=f' {part}'))
+
+        rank = Case(
+            When(Q(search_name__startswith=search_name) | Q(search_surname_name__startswith=search_name), then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        )
+        return queryset.annotate(search_rank=rank).order_by('search_rank', 'search_surname_name', 'id')
+
+    def filter_search(self, queryset, name, value):
+        """Поиск по поисковому индексу, без него - как fullname"""
+        found = search_queryset(queryset, value)
+        return found if found is not None else self.filter_fullname(queryset, name, value)
+
+
+def get_filters_key(filterset):
+    """Заполненные фильтры проверенного filterset в фиксированном порядке. Используется как ключ кеша"""
+    filters = {name: str(value) for name, value in filterset.form.cleaned_data.items() if value not in (None, '')}
+    return json.dumps(filters, sort_keys=True, ensure_ascii=False)
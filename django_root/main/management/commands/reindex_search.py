@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from main.services.search_index import SEARCH_INDEXES, reindex
+
+
+class Command(BaseCommand):
+    help = 'Пересоздает поисковые индексы (турниры, любительские матчи, команды, пользователи)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('indexes', nargs='*', choices=list(SEARCH_INDEXES), help='Индексы для пересоздания, по умолчанию все')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for name in options['indexes'] or SEARCH_INDEXES:
+            count = reindex(name, options['batch_size'])
+            self.stdout.write(f'{name}: {count}')
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:38
+
+import re
+from django.db import migrations, models
+
+GROUP_STAGE_NAME = re.compile(r'^Группа (\d+)\.')
+
+
+def get_stage_group(stage, tournament):
+    """
+    Номер группы этапа, созданного до появления поля group.
+    Берется из названия "Группа N. Этап M", иначе из позиции: раньше у каждой группы было rounds_count этапов подряд
+    """
+    match = GROUP_STAGE_NAME.match(stage.name)
+    if match:
+        return int(match.group(1))
+
+    if not tournament.participants_in_group:
+        return None
+    groups_count = tournament.max_participants // tournament.participants_in_group
+    rounds_count = tournament.rounds_count or 1
+    if 1 <= stage.position <= groups_count * rounds_count:
+        return (stage.position - 1) // rounds_count + 1
+    return None
+
+
+def fill_stage_group(apps, schema_editor):
+    """
+    Заполняет group у этапов групповой стадии двуступенчатых турниров. Должно выполниться до 0062_standing,
+    которая раскладывает очки по группам. Возвращает id турниров, у которых что-то изменилось
+    """
+    TournamentStage = apps.get_model('main', 'TournamentStage')
+    stages = (
+        TournamentStage.objects
+        .filter(tournament__tournament_type=1, group__isnull=True)
+        .select_related('tournament')
+        .order_by('id')
+    )
+    updated_stages = []
+    for stage in stages.iterator(chunk_size=1000):
+        stage.group = get_stage_group(stage, stage.tournament)
+        if stage.group is not None:
+            updated_stages.append(stage)
+    TournamentStage.objects.bulk_update(updated_stages, ['group'], batch_size=1000)
+    return {stage.tournament_id for stage in updated_stages}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0059_participant_qualified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentstage',
+            name='group',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Номер группы (Групповой этап двуступенчатого турнира)'),
+        ),
+        migrations.RunPython(fill_stage_group, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:09
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_results(apps, schema_editor):
+    """Перед добавлением ограничения оставляем только последний результат участника на этапе"""
+    StageResult = apps.get_model('main', 'StageResult')
+    last_results = StageResult.objects.values('stage', 'participant').annotate(last_id=Max('id')).values('last_id')
+    StageResult.objects.exclude(id__in=last_results).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0060_tournamentstage_group'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_results, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='stageresult',
+            constraint=models.UniqueConstraint(fields=('stage', 'participant'), name='unique_stage_result'),
+        ),
+    ]
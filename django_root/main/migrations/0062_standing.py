@@ -0,0 +1,97 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_standings(apps, tournament_ids=None):
+    """
+    Заполняет турнирные таблицы и очки участников по уже сохраненным результатам этапов и матчей.
+    Если переданы tournament_ids - пересчитывает только эти турниры, удаляя их прежние таблицы
+    """
+    Standing = apps.get_model('main', 'Standing')
+    StageResult = apps.get_model('main', 'StageResult')
+    Match = apps.get_model('main', 'Match')
+    Participant = apps.get_model('main', 'Participant')
+
+    results = StageResult.objects.all()
+    matches = Match.objects.filter(status=2, participant1__isnull=False, participant2__isnull=False)
+    if tournament_ids is not None:
+        Standing.objects.filter(tournament_id__in=tournament_ids).delete()
+        results = results.filter(stage__tournament_id__in=tournament_ids)
+        matches = matches.filter(stage__tournament_id__in=tournament_ids)
+
+    standings = {}
+
+    def get_standing(stage, participant_id):
+        key = (participant_id, stage.group or 0)
+        if key not in standings:
+            standings[key] = Standing(tournament_id=stage.tournament_id, participant_id=participant_id, group=stage.group or 0)
+        return standings[key]
+
+    for result in results.select_related('stage').iterator():
+        get_standing(result.stage, result.participant_id).points += result.score
+
+    for match in matches.select_related('stage').iterator():
+        sides = [
+            (match.participant1_id, match.participant1_score, match.participant2_score),
+            (match.participant2_id, match.participant2_score, match.participant1_score),
+        ]
+        for participant_id, score, opponent_score in sides:
+            standing = get_standing(match.stage, participant_id)
+            standing.wins += score > opponent_score
+            standing.draws += score == opponent_score
+            standing.losses += score < opponent_score
+            standing.score_difference += score - opponent_score
+
+    Standing.objects.bulk_create(standings.values(), batch_size=500)
+
+    total_points = {}
+    for (participant_id, _), standing in standings.items():
+        total_points[participant_id] = total_points.get(participant_id, 0) + standing.points
+
+    participants = Participant.objects.filter(id__in=total_points).select_related('tournament')
+    for participant in participants.iterator():
+        participant.score = total_points[participant.id]
+        if participant.tournament.tournament_type == 1:
+            final_standing = standings.get((participant.id, 0))
+            participant.final_step_score = final_standing.points if final_standing else 0
+        participant.save(update_fields=['score', 'final_step_score'])
+
+
+def fill_standings(apps, schema_editor):
+    build_standings(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0061_stageresult_unique_stage_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Standing',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.PositiveSmallIntegerField(default=0, verbose_name='Номер группы (0 - общая таблица или финальная стадия)')),
+                ('points', models.FloatField(default=0, verbose_name='Очки')),
+                ('wins', models.PositiveIntegerField(default=0, verbose_name='Победы')),
+                ('draws', models.PositiveIntegerField(default=0, verbose_name='Ничьи')),
+                ('losses', models.PositiveIntegerField(default=0, verbose_name='Поражения')),
+                ('score_difference', models.IntegerField(default=0, verbose_name='Разница забитых и пропущенных')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='main.participant', verbose_name='Участник')),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='main.tournament', verbose_name='Турнир')),
+            ],
+            options={
+                'verbose_name': 'Строка турнирной таблицы',
+                'verbose_name_plural': 'Турнирные таблицы',
+                'indexes': [models.Index(fields=['tournament', 'group', '-points', '-score_difference'], name='standing_order_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='standing',
+            constraint=models.UniqueConstraint(fields=('participant', 'group'), name='unique_participant_standing'),
+        ),
+        migrations.RunPython(fill_standings, migrations.RunPython.noop),
+    ]
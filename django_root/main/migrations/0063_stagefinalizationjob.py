@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0062_standing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StageFinalizationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'В очереди'), (1, 'Выполняется'), (2, 'Завершена'), (3, 'Ошибка')], default=0, verbose_name='Статус')),
+                ('message', models.TextField(blank=True, default='', verbose_name='Результат или ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+                ('stage', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='main.tournamentstage', verbose_name='Этап')),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stage_jobs', to='main.tournament', verbose_name='Турнир')),
+            ],
+            options={
+                'verbose_name': 'Задача завершения этапа',
+                'verbose_name_plural': 'Задачи завершения этапов',
+            },
+        ),
+    ]
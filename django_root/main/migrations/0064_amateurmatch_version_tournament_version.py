@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0063_stagefinalizationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='amateurmatch',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия (увеличивается при каждом изменении)'),
+        ),
+        migrations.AddField(
+            model_name='tournament',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия (увеличивается при каждом изменении)'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# Таблица: поля. Должно совпадать с main.services.search.SEARCH_FIELDS
+SEARCH_FIELDS = {
+    'main_tournament': ['name'],
+    'main_amateurmatch': ['name', 'address', 'city'],
+}
+
+
+def get_postgresql_sql(table, fields):
+    return [
+        f'CREATE INDEX IF NOT EXISTS {table}_{field}_trgm ON {table} USING gin ((UPPER({field}::text)) gin_trgm_ops)'
+        for field in fields
+    ]
+
+
+def get_sqlite_sql(table, fields):
+    search_table = f'{table}_search'
+    columns = ', '.join(fields)
+    new_values = ', '.join(f'new.{field}' for field in fields)
+    old_values = ', '.join(f'old.{field}' for field in fields)
+    return [
+        f"CREATE VIRTUAL TABLE {search_table} USING fts5({columns}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER {search_table}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {search_table}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+        f"CREATE TRIGGER {search_table}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {search_table}({search_table}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END",
+        f"CREATE TRIGGER {search_table}_update AFTER UPDATE OF {columns} ON {table} BEGIN "
+        f"INSERT INTO {search_table}({search_table}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO {search_table}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+        f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild')",
+    ]
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        get_sql = get_postgresql_sql
+    elif vendor == 'sqlite':
+        get_sql = get_sqlite_sql
+    else:
+        return
+
+    for table, fields in SEARCH_FIELDS.items():
+        for sql in get_sql(table, fields):
+            schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table, fields in SEARCH_FIELDS.items():
+        if vendor == 'postgresql':
+            for field in fields:
+                schema_editor.execute(f'DROP INDEX IF EXISTS {table}_{field}_trgm')
+        elif vendor == 'sqlite':
+            for action in ['insert', 'delete', 'update']:
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {table}_search_{action}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {table}_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0064_amateurmatch_version_tournament_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def fill_search_name(apps, schema_editor):
+    User = apps.get_model('main', 'User')
+    last_id = 0
+    while True:
+        users = list(User.objects.filter(id__gt=last_id).order_by('id').only('id', 'first_name', 'surname', 'last_name')[:BATCH_SIZE])
+        if not users:
+            return
+        for user in users:
+            name = ' '.join([user.first_name, user.surname, user.last_name])
+            user.search_name = ' '.join(name.lower().replace('ё', 'е').split())
+        User.objects.bulk_update(users, ['search_name'])
+        last_id = users[-1].id
+
+
+def create_trigram_index(apps, schema_editor):
+    # Для поиска по началу второго и следующих слов (LIKE '% слово%'). pg_trgm включен в 0065_search_indexes
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS main_user_search_name_trgm ON main_user USING gin (search_name gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS main_user_search_name_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0065_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=400, verbose_name='ФИО для поиска'),
+        ),
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,24 @@
+from importlib import import_module
+from django.db import migrations
+
+# group заполняется в 0060_tournamentstage_group. Здесь - для баз, где 0060 была применена до этого
+fill_stage_group = import_module('main.migrations.0060_tournamentstage_group').fill_stage_group
+build_standings = import_module('main.migrations.0062_standing').build_standings
+
+
+def backfill_stage_group(apps, schema_editor):
+    """Заполняет group у этапов и пересчитывает таблицы турниров, в которых очки групп попали в общую таблицу"""
+    tournament_ids = fill_stage_group(apps, schema_editor)
+    if tournament_ids:
+        build_standings(apps, tournament_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0066_user_search_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_stage_group, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def fill_search_surname_name(apps, schema_editor):
+    User = apps.get_model('main', 'User')
+    last_id = 0
+    while True:
+        users = list(User.objects.filter(id__gt=last_id).order_by('id').only('id', 'first_name', 'surname', 'last_name')[:BATCH_SIZE])
+        if not users:
+            return
+        for user in users:
+            name = ' '.join([user.surname, user.first_name, user.last_name])
+            user.search_surname_name = ' '.join(name.lower().replace('ё', 'е').split())
+        User.objects.bulk_update(users, ['search_surname_name'])
+        last_id = users[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0067_backfill_tournamentstage_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_surname_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=400, verbose_name='ФИО для поиска (фамилия первой)'),
+        ),
+        migrations.RunPython(fill_search_surname_name, migrations.RunPython.noop),
+    ]
@@ -4,6 +4,15 @@ from main.enums import *
 from main.managers import CustomUserManager
 from main.all_models.sport import Sport
 
+# Поля, из которых собираются User.search_name (имя первым) и User.search_surname_name (фамилия первой)
+SEARCH_NAME_FIELDS = ['first_name', 'surname', 'last_name']
+
+
+def get_search_name(*parts):
+    """Строка для поиска по ФИО: нижний регистр, ё -> е, слова через один пробел"""
+    return ' '.join(' '.join(parts).lower().replace('ё', 'е').split())
+
+
 class User(AbstractUser):
     role = models.PositiveSmallIntegerField(choices=ROLE_CHOICES, default=0, verbose_name='Роль')
     email_code = models.CharField(max_length=5, blank=True, verbose_name='Email Код')
@@ -25,6 +34,8 @@ class User(AbstractUser):
     )
     date_payment = models.DateField(null=True, blank=True, verbose_name='Дата последнего платежа')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    search_name = models.CharField(max_length=400, blank=True, editable=False, db_index=True, verbose_name='ФИО для поиска')
+    search_surname_name = models.CharField(max_length=400, blank=True, editable=False, db_index=True, verbose_name='ФИО для поиска (фамилия первой)')
 
     objects = CustomUserManager()
 
@@ -33,4 +44,13 @@ class User(AbstractUser):
         verbose_name_plural = 'Пользователи'
 
     def __str__(self):
-        return self.username
\ No newline at end of file
+        return self.username
+
+    def save(self, *args, **kwargs):
+        # Поля поиска обновляются при каждом сохранении ФИО. update()/bulk_update() их не обновляют
+        self.search_name = get_search_name(self.first_name, self.surname, self.last_name)
+        self.search_surname_name = get_search_name(self.surname, self.first_name, self.last_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(SEARCH_NAME_FIELDS):
+            kwargs['update_fields'] = {*update_fields, 'search_name', 'search_surname_name'}
+        super().save(*args, **kwargs)
\ No newline at end of file
@@ -2,7 +2,7 @@ from datetime import timedelta
 from django.utils import timezone
 from rest_framework import serializers
 from main.all_models.team import Team
-from main.all_models.tournament import StageResult, Tournament, TournamentStage, Participant, Match, TournamentPhoto
+from main.all_models.tournament import StageFinalizationJob, StageResult, Standing, Tournament, TournamentStage, Participant, Match, TournamentPhoto
 
 from main.models import User
 from main.serializers.sport import SportField, TournamentListSportSerializer
@@ -12,6 +12,7 @@ from main.services.tournament import create_double_elimination_bracket, create_l
 from main.serializers.user import AmateurMatchUserSerializer, TournamentListUserSerializer, TournamentUserSerializer, UserSerializer
 
 from django.db import transaction
+from django.db.models import Prefetch
 
 from main.services.img_functions import _decode_photo
 
@@ -116,14 +117,129 @@ class TournamentStageSerializer(serializers.ModelSerializer):
     def get_results(self, obj):
         if obj.tournament.bracket != 4:
             return []
-        stage_results = StageResult.objects.filter(stage=obj)
-        return [StageResultSerializer(result).data for result in stage_results]
+        return [StageResultSerializer(result).data for result in obj.results.all()]
 
     class Meta:
         model = TournamentStage
         fields = ['id', 'name', 'start', 'end', 'matches', 'results']
 
 
+class StandingSerializer(serializers.ModelSerializer):
+    participant = ParticipantSerializer(many=False, read_only=True)
+
+    class Meta:
+        model = Standing
+        fields = ['participant', 'points', 'wins', 'draws', 'losses', 'score_difference']
+
+
+class StageFinalizationJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StageFinalizationJob
+        fields = ['id', 'tournament', 'stage', 'status', 'message', 'created_at', 'finished_at']
+
+
+def get_stages_queryset():
+    """Этапы со всеми связями, которые нужны TournamentStageSerializer. Количество запросов не зависит от размера сетки"""
+    participant_fields = ['participant1', 'participant2', 'winner']
+    match_participant_fields = participant_fields + [f'{match}__{participant}' for match in ['next_match', 'next_lose_match'] for participant in participant_fields]
+
+    matches = Match.objects.order_by('id').select_related(
+        *[f'{field}__user' for field in match_participant_fields],
+        *[f'{field}__team__sport' for field in match_participant_fields],
+    ).prefetch_related(
+        *[f'{field}__team__members' for field in match_participant_fields],
+    )
+
+    return TournamentStage.objects.select_related('tournament').prefetch_related(
+        Prefetch('matches', queryset=matches),
+        'results__participant__user',
+        'results__participant__team',
+    ).order_by('position')
+
+
+def get_tournament_prefetches():
+    """Все связи, которые нужны TournamentSerializer при получении одного турнира"""
+    return [
+        Prefetch('stages', queryset=get_stages_queryset()),
+        Prefetch('participants', queryset=Participant.objects.select_related('user', 'team')),
+        'moderators',
+        'users_requests',
+        Prefetch('teams_requests', queryset=Team.objects.select_related('sport').prefetch_related('members')),
+        'photos',
+    ]
+
+
+BRACKET_STAGE_FIELDS = ['id', 'name', 'position', 'group', 'start', 'end', 'ended']
+BRACKET_MATCH_FIELDS = [
+    'id', 'stage_id', 'scheduled_start', 'actual_start', 'actual_end', 'status',
+    'participant1_id', 'participant2_id', 'participant1_score', 'participant2_score',
+    'winner_id', 'next_match_id', 'next_lose_match_id',
+]
+
+def get_tournament_list_prefetches():
+    """
+    Первое фото и первые 4 участника для карточек списка турниров.
+    Срез в Prefetch выполняется одним запросом с ROW_NUMBER() по турниру для всей страницы
+    """
+    return [
+        Prefetch('photos', queryset=TournamentPhoto.objects.order_by('id')[:1], to_attr='first_photos'),
+        Prefetch('participants', queryset=Participant.objects.select_related('user', 'team').order_by('id')[:4], to_attr='first_participants'),
+    ]
+
+
+def get_bracket_data(tournament):
+    """
+    Сетка турнира в нормализованном виде: этапы, матчи со ссылками на id и словарь участников.
+    Каждый участник сериализуется один раз, матчи и этапы читаются через values() без создания моделей
+    """
+    participants = (
+        Participant.objects.filter(tournament=tournament)
+        .select_related('user', 'team__sport')
+        .prefetch_related('team__members')
+    )
+    return {
+        'stages': list(TournamentStage.objects.filter(tournament=tournament).order_by('position').values(*BRACKET_STAGE_FIELDS)),
+        'matches': list(Match.objects.filter(stage__tournament=tournament).order_by('stage__position', 'id').values(*BRACKET_MATCH_FIELDS)),
+        'results': list(StageResult.objects.filter(stage__tournament=tournament).order_by('id').values('stage_id', 'participant_id', 'score')),
+        'participants': {participant.id: ParticipantSerializer(participant).data for participant in participants},
+    }
+
+
+def get_bracket_preview(plan):
+    """
+    Несохраненная сетка в формате, близком к TournamentStageSerializer.
+    У матчей еще нет id, поэтому next_match и next_lose_match - номера матчей в сетке
+    """
+    matches_indexes = {id(match): index for index, match in enumerate(plan.matches())}
+    participants_data = {}
+
+    def get_participant_data(participant):
+        if not participant:
+            return None
+        if participant.id not in participants_data:
+            participants_data[participant.id] = {'id': participant.id, **ParticipantSerializer(participant).data}
+        return participants_data[participant.id]
+
+    return [
+        {
+            'name': stage.name,
+            'position': stage.position,
+            'group': stage.group,
+            'matches': [
+                {
+                    'index': matches_indexes[id(match)],
+                    'scheduled_start': match.scheduled_start,
+                    'participant1': get_participant_data(match.participant1),
+                    'participant2': get_participant_data(match.participant2),
+                    'next_match': matches_indexes[id(match.next_match)] if match.next_match else None,
+                    'next_lose_match': matches_indexes[id(match.next_lose_match)] if match.next_lose_match else None,
+                }
+                for match in stage.matches
+            ],
+        }
+        for stage in plan.stages
+    ]
+
 
 class TournamentPhotoSerializer(serializers.ModelSerializer):
     photo = serializers.FileField(use_url=True)
@@ -148,14 +264,17 @@ class TournamentListSerializer(serializers.ModelSerializer):
                   'max_participants', 'participants', 'participants_count', 'prize_pool']
 
     def get_photo(self, obj):
-        photo = obj.photos.first()
+        if hasattr(obj, 'first_photos'):
+            photo = obj.first_photos[0] if obj.first_photos else None
+        else:
+            photo = obj.photos.order_by('id').first()
         return TournamentPhotoSerializer(photo).data['photo']
 
-    def get_participants_count(self, obj):
-        return Participant.objects.filter(tournament=obj).count()
-
     def get_participants(self, obj):
-        participants = obj.participants.all()[:4]  # Ограничиваем до первых 4 участников
+        if hasattr(obj, 'first_participants'):
+            participants = obj.first_participants
+        else:
+            participants = obj.participants.order_by('id')[:4]  # Ограничиваем до первых 4 участников
         return ParticipantTournamentListSerializer(participants, many=True).data
     
 
@@ -250,12 +369,11 @@ class TournamentSerializer(serializers.ModelSerializer):
         return requests_data
 
     def get_is_registration_available(self, obj):
-        REGISTER_OPEN_UNTIL_DICT = dict(REGISTER_OPEN_UNTIL)
-        registration_end_time = obj.start - REGISTER_OPEN_UNTIL_DICT.get(obj.register_open_until, timedelta(minutes=15))
-        return timezone.now() < registration_end_time
+        return timezone.now() < obj.get_registration_end()
 
     def get_qualified_participants(self, obj):
-        qualified_participants = obj.get_qualified_participants()
+        # Фильтруем уже загруженных участников, чтобы не делать отдельный запрос
+        qualified_participants = [participant for participant in obj.participants.all() if participant.qualified]
         serializer = ParticipantTournamentListSerializer(qualified_participants, many=True)
         return serializer.data
 
@@ -0,0 +1,678 @@
+import json
+import math
+import random
+import redis
+from collections import Counter
+from functools import lru_cache
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from main.all_models.tournament import TournamentStage, Match
+
+# Сетка сначала полностью строится в памяти (этапы, матчи и связи между ними),
+# а затем сохраняется в БД несколькими bulk запросами, независимо от размера сетки.
+# Форма сетки на выбывание зависит только от типа сетки и количества участников,
+# поэтому она кешируется, а при создании турнира в нее только рассаживаются участники.
+
+
+class PlannedStage:
+    def __init__(self, name, position, group=None):
+        self.name = name
+        self.position = position
+        self.group = group
+        self.matches = []
+        self.instance = None
+
+
+class PlannedMatch:
+    def __init__(self, stage, participant1=None, participant2=None, scheduled_start=None, seed_slots=None):
+        self.stage = stage
+        # Сколько участников рассаживается в матч из посева. None - матч без посева
+        self.seed_slots = seed_slots
+        self.participant1 = participant1
+        self.participant2 = participant2
+        self.scheduled_start = scheduled_start
+        self.next_match = None
+        self.next_lose_match = None
+        self.instance = None
+
+
+class BracketPlan:
+    """Граф этапов и матчей турнира, который еще не сохранен в БД"""
+
+    def __init__(self):
+        self.stages = []
+
+    def add_stage(self, name, position=None, group=None):
+        stage = PlannedStage(name, position, group)
+        self.stages.append(stage)
+        return stage
+
+    def add_match(self, stage, participant1=None, participant2=None, scheduled_start=None, seed_slots=None):
+        match = PlannedMatch(stage, participant1, participant2, scheduled_start, seed_slots)
+        stage.matches.append(match)
+        return match
+
+    def order_stages(self, stages, first_position):
+        """Расставляет позиции этапов в переданном порядке"""
+        for position, stage in enumerate(stages, start=first_position):
+            stage.position = position
+        self.stages = list(stages)
+
+    def matches(self):
+        return [match for stage in self.stages for match in stage.matches]
+
+    def to_topology(self):
+        """Форма сетки без участников: названия этапов и матчи [этап, мест для посева, next_match, next_lose_match]"""
+        matches = self.matches()
+        stages_indexes = {id(stage): index for index, stage in enumerate(self.stages)}
+        matches_indexes = {id(match): index for index, match in enumerate(matches)}
+        return {
+            'stages': [stage.name for stage in self.stages],
+            'matches': [
+                [
+                    stages_indexes[id(match.stage)],
+                    match.seed_slots,
+                    matches_indexes[id(match.next_match)] if match.next_match else None,
+                    matches_indexes[id(match.next_lose_match)] if match.next_lose_match else None,
+                ]
+                for match in matches
+            ],
+        }
+
+    @classmethod
+    def from_topology(cls, topology, first_position=1):
+        plan = cls()
+        stages = [plan.add_stage(name, position) for position, name in enumerate(topology['stages'], start=first_position)]
+        matches = [
+            plan.add_match(stages[stage_index], seed_slots=seed_slots)
+            for stage_index, seed_slots, _, _ in topology['matches']
+        ]
+        for match, (_, _, next_index, next_lose_index) in zip(matches, topology['matches']):
+            match.next_match = matches[next_index] if next_index is not None else None
+            match.next_lose_match = matches[next_lose_index] if next_lose_index is not None else None
+        return plan
+
+    def to_data(self):
+        """
+        Сетка с участниками для предпросмотра, которую потом можно сохранить через from_data.
+        Этапы: [название, позиция, группа]. Матчи: [этап, участник 1, участник 2, начало, next_match, next_lose_match]
+        """
+        matches = self.matches()
+        stages_indexes = {id(stage): index for index, stage in enumerate(self.stages)}
+        matches_indexes = {id(match): index for index, match in enumerate(matches)}
+        return {
+            'stages': [[stage.name, stage.position, stage.group] for stage in self.stages],
+            'matches': [
+                [
+                    stages_indexes[id(match.stage)],
+                    match.participant1.id if match.participant1 else None,
+                    match.participant2.id if match.participant2 else None,
+                    match.scheduled_start,
+                    matches_indexes[id(match.next_match)] if match.next_match else None,
+                    matches_indexes[id(match.next_lose_match)] if match.next_lose_match else None,
+                ]
+                for match in matches
+            ],
+        }
+
+    def to_shape(self):
+        """Форма сетки для сравнения: этапы [название, позиция, группа] и матчи [этап, next_match, next_lose_match]"""
+        data = self.to_data()
+        return {
+            'stages': data['stages'],
+            'matches': [[stage_index, next_index, next_lose_index] for stage_index, _, _, _, next_index, next_lose_index in data['matches']],
+        }
+
+    @classmethod
+    def from_data(cls, data, participants):
+        """Восстанавливает сетку из to_data. Данные приходят от клиента, поэтому все ссылки проверяются"""
+        participants_by_id = {participant.id: participant for participant in participants}
+        plan = cls()
+        try:
+            for name, position, group in data['stages']:
+                plan.add_stage(str(name), int(position), int(group) if group is not None else None)
+
+            matches = []
+            links = []
+            unknown_ids = set()
+            for stage_index, participant1_id, participant2_id, scheduled_start, next_index, next_lose_index in data['matches']:
+                for participant_id in (participant1_id, participant2_id):
+                    if participant_id is not None and participant_id not in participants_by_id:
+                        unknown_ids.add(participant_id)
+                matches.append(plan.add_match(
+                    plan.stages[stage_index],
+                    participants_by_id.get(participant1_id),
+                    participants_by_id.get(participant2_id),
+                    scheduled_start,
+                ))
+                links.append((next_index, next_lose_index))
+
+            for match, (next_index, next_lose_index) in zip(matches, links):
+                match.next_match = matches[next_index] if next_index is not None else None
+                match.next_lose_match = matches[next_lose_index] if next_lose_index is not None else None
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise ValidationError("Неверный формат сетки.")
+
+        if unknown_ids:
+            raise ValidationError(f"Участники не найдены в турнире: {', '.join(map(str, sorted(unknown_ids)))}.")
+        # Из матча можно перейти только в более поздний этап, иначе в сетке появится цикл
+        for match in matches:
+            for next_match in (match.next_match, match.next_lose_match):
+                if next_match and next_match.stage.position <= match.stage.position:
+                    raise ValidationError("Матч может вести только в следующие этапы.")
+        return plan
+
+    def check_participants(self, expected):
+        """
+        Участник стоит не больше чем в одном матче этапа. В сетках с посевом (expected - та же сетка, построенная сервером)
+        участники стоят только на местах посева и только один раз во всей сетке
+        """
+        seeded = any(match.seed_slots is not None for match in expected.matches())
+        seated_ids = []
+        for stage in self.stages:
+            stage_ids = [
+                participant.id for match in stage.matches
+                for participant in (match.participant1, match.participant2) if participant is not None
+            ]
+            if len(set(stage_ids)) != len(stage_ids):
+                raise ValidationError("Участник указан в нескольких матчах этапа.")
+            seated_ids += stage_ids
+
+        if not seeded:
+            return
+        if len(set(seated_ids)) != len(seated_ids):
+            raise ValidationError("Участник указан в нескольких матчах сетки.")
+        for match, expected_match in zip(self.matches(), expected.matches()):
+            seated = (match.participant1 is not None) + (match.participant2 is not None)
+            if seated > (expected_match.seed_slots or 0):
+                raise ValidationError("Участники могут стоять только на местах посева.")
+
+    def seed(self, tournament, matches_data, participants):
+        """Рассаживает участников по местам посева в порядке матчей"""
+        seeded_matches = [match for match in self.matches() if match.seed_slots is not None]
+        seeding = ParticipantsSeeding(tournament, matches_data, participants, [match.seed_slots for match in seeded_matches])
+        for match in seeded_matches:
+            match.participant1, match.participant2, match_info = seeding.next_match(match.seed_slots)
+            match.scheduled_start = match_info.get("scheduled_start", None) if match_info else None
+
+    @transaction.atomic
+    def save(self, tournament):
+        """Сохраняет сетку: этапы, матчи и связи next_match/next_lose_match"""
+        stages = [
+            TournamentStage(name=stage.name, tournament=tournament, position=stage.position, group=stage.group)
+            for stage in self.stages
+        ]
+        TournamentStage.objects.bulk_create(stages)
+        for planned_stage, stage in zip(self.stages, stages):
+            planned_stage.instance = stage
+
+        planned_matches = self.matches()
+        for planned_match in planned_matches:
+            planned_match.instance = Match(
+                stage=planned_match.stage.instance,
+                participant1=planned_match.participant1,
+                participant2=planned_match.participant2,
+                scheduled_start=planned_match.scheduled_start,
+            )
+        Match.objects.bulk_create([planned_match.instance for planned_match in planned_matches])
+
+        # Связи можно проставить только после того как у всех матчей появились id
+        linked_matches = []
+        for planned_match in planned_matches:
+            if planned_match.next_match or planned_match.next_lose_match:
+                match = planned_match.instance
+                match.next_match = planned_match.next_match.instance if planned_match.next_match else None
+                match.next_lose_match = planned_match.next_lose_match.instance if planned_match.next_lose_match else None
+                linked_matches.append(match)
+        if linked_matches:
+            Match.objects.bulk_update(linked_matches, ['next_match', 'next_lose_match'])
+
+        return stages
+
+
+# Сохранить можно только сетку, которую сервер построил в предпросмотре: она возвращается клиенту подписанной
+PLAN_SIGNING_SALT = 'tournament-bracket-plan'
+
+
+def sign_plan(tournament, plan):
+    return signing.dumps({'tournament': tournament.id, 'plan': plan.to_data()}, salt=PLAN_SIGNING_SALT, compress=True)
+
+
+def load_signed_plan(tournament, token, participants):
+    """Сетка из подписанного предпросмотра этого турнира. Подпись и срок действия проверяются"""
+    try:
+        data = signing.loads(token or '', salt=PLAN_SIGNING_SALT, max_age=settings.BRACKET_PREVIEW_MAX_AGE)
+    except signing.BadSignature:
+        raise ValidationError("Предпросмотр сетки устарел или изменен, постройте его заново.")
+    if data.get('tournament') != tournament.id:
+        raise ValidationError("Предпросмотр сетки построен для другого турнира.")
+    return BracketPlan.from_data(data['plan'], participants)
+
+
+class ParticipantsSeeding:
+    """
+    Рассадка участников по данным matches_data из запроса.
+    Участники индексируются по id пользователя (или команды) один раз,
+    все переданные id проверяются сразу, до построения сетки.
+    capacities - сколько мест для посева в каждом матче сетки.
+    """
+
+    def __init__(self, tournament, matches_data, participants, capacities):
+        matches_data = matches_data or []
+        key = 'team_id' if tournament.is_team_tournament else 'user_id'
+        participants_by_id = {getattr(participant, key): participant for participant in participants}
+
+        unknown_ids = []
+        repeated_ids = []
+        overfilled_matches = []
+        seeded_ids = set()
+        self.seeded_matches = []
+        for number, match_info in enumerate(matches_data, start=1):
+            participants_ids = match_info.get('participants') or []
+            if number <= len(capacities) and len(participants_ids) > capacities[number - 1]:
+                overfilled_matches.append(f"{number} (мест: {capacities[number - 1]})")
+
+            match_participants = []
+            for pid in participants_ids:
+                if pid not in participants_by_id:
+                    unknown_ids.append(pid)
+                elif pid in seeded_ids:
+                    repeated_ids.append(pid)
+                else:
+                    seeded_ids.add(pid)
+                    match_participants.append(participants_by_id[pid])
+            self.seeded_matches.append((match_participants, match_info))
+
+        errors = []
+        if len(matches_data) > len(capacities):
+            errors.append(f"Передано матчей: {len(matches_data)}, в сетке матчей с посевом: {len(capacities)}.")
+        if unknown_ids:
+            errors.append(f"Участники не найдены в турнире: {', '.join(map(str, unknown_ids))}.")
+        if repeated_ids:
+            errors.append(f"Участники указаны в нескольких матчах: {', '.join(map(str, repeated_ids))}.")
+        if overfilled_matches:
+            errors.append(f"Участников больше, чем мест в матчах: {', '.join(overfilled_matches)}.")
+        if errors:
+            raise ValidationError(' '.join(errors))
+
+        # Участники без места в matches_data заполняют свободные места матчей
+        self.available_participants = [p for p in participants if getattr(p, key) not in seeded_ids]
+        self.seeded_matches.reverse()
+
+    def next_match(self, seed_slots=2):
+        """Возвращает участников и данные очередного матча"""
+        match_participants, match_info = self.seeded_matches.pop() if self.seeded_matches else ([], None)
+        match_participants = list(match_participants)
+        while len(match_participants) < 2:
+            if self.available_participants and len(match_participants) < seed_slots:
+                match_participants.append(self.available_participants.pop())
+            else:
+                match_participants.append(None)
+        return match_participants[0], match_participants[1], match_info
+
+
+def get_stage_name(round_number, num_rounds):
+    if round_number == num_rounds:
+        return "Финал"
+    elif round_number == num_rounds - 1:
+        return "Полуфинал"
+    else:
+        return f"Этап {round_number}"
+
+
+def add_seeded_matches(plan, stage, count, seeds_count):
+    """Создает матчи этапа с местами для посева. Места занимаются по порядку, по два на матч"""
+    matches = []
+    for _ in range(count):
+        seed_slots = min(2, seeds_count)
+        seeds_count -= seed_slots
+        matches.append(plan.add_match(stage, seed_slots=seed_slots))
+    return matches
+
+
+def fill_free_slots(matches, preliminary_matches):
+    """Победители предварительного этапа занимают свободные места первого раунда"""
+    preliminary_winners = iter(preliminary_matches)
+    for match in matches:
+        for _ in range(2 - match.seed_slots):
+            preliminary_match = next(preliminary_winners, None)
+            if preliminary_match:
+                preliminary_match.next_match = match
+
+
+def link_rounds(plan, stage, previous_matches):
+    """Создает матчи следующего раунда: победители каждой пары матчей играют между собой"""
+    new_matches = []
+    for i in range(0, len(previous_matches), 2):
+        new_match = plan.add_match(stage)
+        for previous_match in previous_matches[i:i + 2]:
+            previous_match.next_match = new_match
+        new_matches.append(new_match)
+    return new_matches
+
+
+def add_fed_matches(plan, stage, feeds_pairs):
+    """
+    Создает по матчу на каждую пару источников.
+    Источник - это (матч, проигравший ли из него переходит в новый матч)
+    """
+    new_matches = []
+    for feeds in feeds_pairs:
+        new_match = plan.add_match(stage)
+        for previous_match, is_loser in feeds:
+            if is_loser:
+                previous_match.next_lose_match = new_match
+            else:
+                previous_match.next_match = new_match
+        new_matches.append(new_match)
+    return new_matches
+
+
+def pairs(feeds):
+    return list(zip(feeds[0::2], feeds[1::2]))
+
+
+def winners(matches):
+    return [(match, False) for match in matches]
+
+
+def losers(matches):
+    return [(match, True) for match in matches]
+
+
+def build_single_elimination(num_participants):
+    """Строит форму сетки Single Elimination без участников"""
+    plan = BracketPlan()
+    if num_participants < 2:
+        return plan
+
+    # Размер первого раунда. Лишние участники играют предварительный этап
+    target_participants = 2**int(math.log2(num_participants))
+    num_rounds = int(math.log2(target_participants))
+    num_preliminary_matches = num_participants - target_participants
+
+    stage_position = 1
+    preliminary_matches = []
+    if num_preliminary_matches:
+        stage = plan.add_stage(get_stage_name(0, num_rounds), stage_position)
+        stage_position += 1
+        preliminary_matches = add_seeded_matches(plan, stage, num_preliminary_matches, 2 * num_preliminary_matches)
+
+    current_matches = []
+    for round_number in range(1, num_rounds + 1):
+        stage = plan.add_stage(get_stage_name(round_number, num_rounds), stage_position)
+        stage_position += 1
+
+        if round_number == 1:
+            current_matches = add_seeded_matches(plan, stage, target_participants // 2, num_participants - 2 * num_preliminary_matches)
+            fill_free_slots(current_matches, preliminary_matches)
+        else:
+            current_matches = link_rounds(plan, stage, current_matches)
+
+    return plan
+
+
+def build_double_elimination(num_participants):
+    """Строит форму сетки Double Elimination без участников: верхняя и нижняя сетки, предварительные этапы и финал"""
+    plan = BracketPlan()
+    if num_participants < 2:
+        return plan
+
+    target_participants = 2**int(math.log2(num_participants))
+    num_rounds_upper = int(math.log2(target_participants))
+    num_preliminary_matches = num_participants - target_participants
+
+    # Верхняя сетка
+    upper_preliminary_stages = []
+    preliminary_matches = []
+    if num_preliminary_matches:
+        stage = plan.add_stage("Верхняя сетка - Предварительный Этап 1")
+        upper_preliminary_stages.append(stage)
+        preliminary_matches = add_seeded_matches(plan, stage, num_preliminary_matches, 2 * num_preliminary_matches)
+
+    upper_stages = [plan.add_stage(f"Верхняя сетка - Этап {i + 1}") for i in range(num_rounds_upper)]
+    upper_rounds = [add_seeded_matches(plan, upper_stages[0], target_participants // 2, num_participants - 2 * num_preliminary_matches)]
+    fill_free_slots(upper_rounds[0], preliminary_matches)
+    for stage in upper_stages[1:]:
+        upper_rounds.append(link_rounds(plan, stage, upper_rounds[-1]))
+
+    # Предварительные этапы нижней сетки. Проигравшие предварительного этапа
+    # играют с проигравшими первого раунда, чтобы в нижней сетке осталось target_participants // 2 участников
+    lower_preliminary_stages = []
+    first_round_losers = losers(upper_rounds[0])
+    preliminary_losers = losers(preliminary_matches)
+
+    extra_matches_count = num_preliminary_matches - target_participants // 2
+    if extra_matches_count > 0:
+        stage = plan.add_stage("Нижняя сетка - Предварительный Этап 1")
+        lower_preliminary_stages.append(stage)
+        extra_matches = add_fed_matches(plan, stage, pairs(preliminary_losers[-2 * extra_matches_count:]))
+        preliminary_losers = preliminary_losers[:-2 * extra_matches_count] + winners(extra_matches)
+
+    if preliminary_losers:
+        stage = plan.add_stage(f"Нижняя сетка - Предварительный Этап {len(lower_preliminary_stages) + 1}")
+        lower_preliminary_stages.append(stage)
+        preliminary_lower_matches = add_fed_matches(plan, stage, zip(preliminary_losers, first_round_losers))
+        first_round_losers = winners(preliminary_lower_matches) + first_round_losers[len(preliminary_lower_matches):]
+
+    # Нижняя сетка. Этапы, где проигравшие играют между собой, чередуются с этапами,
+    # где к ним присоединяются проигравшие следующего раунда верхней сетки
+    lower_stages = []
+    lower_feeds = first_round_losers
+    if len(lower_feeds) > 1:
+        stage = plan.add_stage(f"Нижняя сетка - Этап {len(lower_stages) + 1}")
+        lower_stages.append(stage)
+        lower_feeds = winners(add_fed_matches(plan, stage, pairs(lower_feeds)))
+
+    for round_index, upper_round in enumerate(upper_rounds[1:], start=2):
+        stage = plan.add_stage(f"Нижняя сетка - Этап {len(lower_stages) + 1}")
+        lower_stages.append(stage)
+        lower_feeds = winners(add_fed_matches(plan, stage, zip(losers(upper_round), lower_feeds)))
+
+        if round_index < num_rounds_upper:
+            stage = plan.add_stage(f"Нижняя сетка - Этап {len(lower_stages) + 1}")
+            lower_stages.append(stage)
+            lower_feeds = winners(add_fed_matches(plan, stage, pairs(lower_feeds)))
+
+    # Финал: победитель верхней сетки против победителя нижней
+    final_stage = plan.add_stage("Финал")
+    add_fed_matches(plan, final_stage, [(winners(upper_rounds[-1])[0], lower_feeds[0])])
+
+    # Порядок этапов: сначала предварительные, затем раунды верхней и нижней сеток по очереди
+    ordered_stages = upper_preliminary_stages + lower_preliminary_stages[:-1] + upper_stages[:1] + lower_preliminary_stages[-1:]
+    for i in range(max(len(upper_stages), len(lower_stages))):
+        if 0 < i < len(upper_stages):
+            ordered_stages.append(upper_stages[i])
+        if i < len(lower_stages):
+            ordered_stages.append(lower_stages[i])
+    ordered_stages.append(final_stage)
+    plan.order_stages(ordered_stages, 1)
+
+    return plan
+
+
+TOPOLOGY_BUILDERS = {
+    0: build_single_elimination,
+    1: build_double_elimination,
+}
+
+# Версия формы сеток. Увеличивается при изменении build_* функций, чтобы не брать устаревшие сетки из redis
+TOPOLOGY_VERSION = 1
+
+
+@lru_cache(maxsize=512)
+def get_bracket_topology(bracket, num_participants):
+    """
+    Форма сетки для типа сетки и количества участников.
+    Кешируется в памяти процесса и, если включено BRACKET_TOPOLOGY_REDIS_CACHE, в redis для всех воркеров.
+    Возвращаемый словарь общий для всех вызовов, изменять его нельзя
+    """
+    key = f'bracket_topology:{TOPOLOGY_VERSION}:{bracket}:{num_participants}'
+    topology = get_shared_topology(key)
+    if topology is None:
+        topology = TOPOLOGY_BUILDERS[bracket](num_participants).to_topology()
+        set_shared_topology(key, topology)
+    return topology
+
+
+def get_shared_topology(key):
+    if not settings.BRACKET_TOPOLOGY_REDIS_CACHE:
+        return None
+    from main.apps import redis_instance
+    try:
+        return json.loads(redis_instance.get(key))
+    # TypeError - ключа нет в redis, ValueError - значение повреждено
+    except (redis.RedisError, ValueError, TypeError):
+        return None
+
+
+def set_shared_topology(key, topology):
+    if not settings.BRACKET_TOPOLOGY_REDIS_CACHE:
+        return
+    from main.apps import redis_instance
+    try:
+        redis_instance.set(key, json.dumps(topology))
+    except (redis.RedisError, ValueError, TypeError):
+        pass
+
+
+def plan_bracket(bracket, tournament, matches_data, participants, stage_position_offset=0):
+    """Строит сетку из кешированной формы и рассаживает в нее участников"""
+    plan = BracketPlan.from_topology(get_bracket_topology(bracket, len(participants)), 1 + stage_position_offset)
+    plan.seed(tournament, matches_data, participants)
+    return plan
+
+
+def plan_single_elimination(tournament, matches_data, participants, stage_position_offset=0):
+    return plan_bracket(0, tournament, matches_data, participants, stage_position_offset)
+
+
+def plan_double_elimination(tournament, matches_data, participants, stage_position_offset=0):
+    return plan_bracket(1, tournament, matches_data, participants, stage_position_offset)
+
+
+def get_round_robin_rounds(participants):
+    """
+    Расписание круговой системы методом круга (таблицы Бергера).
+    Первый участник стоит на месте, остальные сдвигаются по кругу, поэтому за тур каждый играет не больше одного матча.
+    При нечетном количестве участников один из них в каждом туре отдыхает
+    """
+    players = list(participants)
+    if len(players) % 2:
+        players.append(None)
+
+    rounds = []
+    for round_number in range(len(players) - 1):
+        pairs = []
+        for i in range(len(players) // 2):
+            participant1, participant2 = players[i], players[-1 - i]
+            if participant1 is None or participant2 is None:
+                continue
+            # Чередуем порядок, чтобы первый участник не был всегда participant1
+            if i == 0 and round_number % 2:
+                participant1, participant2 = participant2, participant1
+            pairs.append((participant1, participant2))
+        rounds.append(pairs)
+        players = players[:1] + players[-1:] + players[1:-1]
+    return rounds
+
+
+def plan_round_robin(groups, cycles, stage_position_offset=0, is_group_stage=False):
+    """
+    Строит круговую систему в памяти. Каждый тур - отдельный этап, круг повторяется cycles раз.
+    groups - списки участников групп. Для групповой стадии двуступенчатого турнира этапы помечаются номером группы
+    """
+    plan = BracketPlan()
+    position = 1 + stage_position_offset
+    for group_number, participants in enumerate(groups, start=1):
+        rounds = get_round_robin_rounds(participants)
+        round_number = 1
+        for cycle in range(cycles):
+            for pairs in rounds:
+                if is_group_stage:
+                    stage = plan.add_stage(f"Группа {group_number}. Этап {round_number}", position, group_number)
+                else:
+                    stage = plan.add_stage(f"Этап {round_number}", position)
+                for participant1, participant2 in pairs:
+                    # В повторных кругах участники меняются местами
+                    if cycle % 2:
+                        participant1, participant2 = participant2, participant1
+                    plan.add_match(stage, participant1, participant2)
+                position += 1
+                round_number += 1
+    return plan
+
+
+def plan_swiss(tournament, matches_data, participants, stage_position_offset=0):
+    """Строит первый этап швейцарской системы в памяти. Участники без посева распределяются случайно"""
+    plan = BracketPlan()
+    participants = list(participants)
+    random.shuffle(participants)
+
+    stage = plan.add_stage("Этап 1", 1 + stage_position_offset)
+    add_seeded_matches(plan, stage, len(participants) // 2, len(participants))
+    plan.seed(tournament, matches_data, participants)
+    return plan
+
+
+def get_played_pairs(tournament):
+    """Все пары участников, которые уже играли между собой в турнире. Один запрос"""
+    matches = Match.objects.filter(stage__tournament=tournament, participant1__isnull=False, participant2__isnull=False)
+    return {frozenset(pair) for pair in matches.values_list('participant1_id', 'participant2_id')}
+
+
+def pair_swiss_participants(participants, played_pairs, max_steps=100000):
+    """
+    Разбивает на пары участников, отсортированных по очкам.
+    Перебором с возвратом ищет пары без повторных встреч, каждый играет с ближайшим по очкам соперником.
+    При нечетном количестве один участник пропускает тур.
+    Если пар без повторов нет или перебор слишком долгий, повторные встречи допускаются
+    """
+    steps = 0
+
+    def have_played(participant1, participant2):
+        return frozenset((participant1.id, participant2.id)) in played_pairs
+
+    def backtrack(remaining):
+        nonlocal steps
+        if not remaining:
+            return []
+        first = remaining[0]
+        for i in range(1, len(remaining)):
+            steps += 1
+            if steps > max_steps:
+                return None
+            if have_played(first, remaining[i]):
+                continue
+            rest = backtrack(remaining[1:i] + remaining[i + 1:])
+            if rest is not None:
+                return [(first, remaining[i])] + rest
+        return None
+
+    participants = list(participants)
+    if len(participants) % 2:
+        # Без пары остается тот, кто сыграл больше всех (то есть еще не пропускал тур), а среди них - с наименьшими очками
+        games_count = Counter(participant_id for pair in played_pairs for participant_id in pair)
+        bye_order = sorted(reversed(range(len(participants))), key=lambda i: -games_count[participants[i].id])
+        bye_candidates = [participants[:i] + participants[i + 1:] for i in bye_order]
+    else:
+        bye_candidates = [participants]
+
+    for candidates in bye_candidates:
+        pairs = backtrack(candidates)
+        if pairs is not None:
+            return pairs
+        if steps > max_steps:
+            break
+
+    # Жадное разбиение: сначала соперник без повторной встречи, иначе ближайший по очкам
+    pairs = []
+    remaining = bye_candidates[0]
+    while len(remaining) > 1:
+        first = remaining.pop(0)
+        opponent = next((p for p in remaining if not have_played(first, p)), remaining[0])
+        remaining.remove(opponent)
+        pairs.append((first, opponent))
+    return pairs
@@ -0,0 +1,99 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from drf_yasg import openapi
+from main.filters import get_filters_key
+from main.services.redis import FacetsCache
+
+# Диапазоны цены участия: (ключ, от, до включительно). None - без верхней границы
+PRICE_BANDS = [
+    ('free', 0, 0),
+    ('up_to_1000', 1, 1000),
+    ('up_to_5000', 1001, 5000),
+    ('up_to_20000', 5001, 20000),
+    ('over_20000', 20001, None),
+]
+
+# Окна по дате начала: (ключ, количество дней от начала сегодняшнего дня)
+DATE_WINDOWS = [
+    ('today', 1),
+    ('week', 7),
+    ('month', 30),
+]
+
+# Пример ответа для swagger, общий для фильтров турниров и любительских матчей
+FACETS_RESPONSE = openapi.Response(
+    description='',
+    examples={
+        "application/json": {
+            "success": True,
+            "facets": {
+                "total": 12,
+                "sport": [{"id": 1, "name": "Футбол", "count": 8}],
+                "city": [{"name": "Алматы", "count": 5}],
+                "price": [{"key": "free", "start_price": 0, "end_price": 0, "count": 3}],
+                "date": [{"key": "today", "start": "2024-01-02T00:00:00+05:00", "end": "2024-01-03T00:00:00+05:00", "count": 1}],
+            }
+        },
+    }
+)
+
+
+def get_facets_cache():
+    """Кеш счетчиков фильтров или None, если он выключен в настройках"""
+    if not settings.FACETS_REDIS_CACHE:
+        return None
+    from main.apps import redis_instance
+    return FacetsCache(redis_instance, settings.FACETS_CACHE_TIMEOUT)
+
+
+def get_price_band_filter(start, end):
+    price_filter = Q(enter_price__gte=start)
+    if end is not None:
+        price_filter &= Q(enter_price__lte=end)
+    return price_filter
+
+
+def get_facets(queryset):
+    """
+    Количество объектов по видам спорта, городам, диапазонам цены и окнам дат для отфильтрованного queryset.
+    Три запроса: группировка по спорту, группировка по городу и один aggregate с условными Count для цен и дат
+    """
+    queryset = queryset.order_by()
+    today = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+    windows = [(key, today, today + timedelta(days=days)) for key, days in DATE_WINDOWS]
+
+    sports = queryset.values('sport_id', 'sport__name').annotate(count=Count('id')).order_by('-count', 'sport__name')
+    cities = queryset.exclude(city='').values('city').annotate(count=Count('id')).order_by('-count', 'city')
+    counts = queryset.aggregate(
+        total=Count('id'),
+        **{f'price_{key}': Count('id', filter=get_price_band_filter(start, end)) for key, start, end in PRICE_BANDS},
+        **{f'date_{key}': Count('id', filter=Q(start__gte=start, start__lt=end)) for key, start, end in windows},
+    )
+
+    return {
+        'total': counts['total'],
+        'sport': [{'id': sport['sport_id'], 'name': sport['sport__name'], 'count': sport['count']} for sport in sports],
+        'city': [{'name': city['city'], 'count': city['count']} for city in cities],
+        'price': [
+            {'key': key, 'start_price': start, 'end_price': end, 'count': counts[f'price_{key}']}
+            for key, start, end in PRICE_BANDS
+        ],
+        'date': [
+            {'key': key, 'start': start.isoformat(), 'end': end.isoformat(), 'count': counts[f'date_{key}']}
+            for key, start, end in windows
+        ],
+    }
+
+
+def get_cached_facets(kind, filterset):
+    """Счетчики для проверенного filterset. Кешируются на FACETS_CACHE_TIMEOUT секунд по набору фильтров"""
+    cache = get_facets_cache()
+    key = f'{kind}:{get_filters_key(filterset)}'
+    facets = cache.get_facets(key) if cache else None
+    if facets is None:
+        facets = get_facets(filterset.qs)
+        if cache:
+            cache.set_facets(key, facets)
+    return facets
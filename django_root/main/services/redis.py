@@ -33,4 +33,92 @@ class RedisCallService:
         return data
 
     def delete_call_data_by_call_id(self, call_id: int) -> None:
-        self.redis_conn.delete(str(call_id))
\ No newline at end of file
+        self.redis_conn.delete(str(call_id))
+
+
+class TournamentDetailCache:
+    """
+    Готовый JSON турнира в redis под ключом (id турнира, Tournament.version).
+    При изменении турнира версия увеличивается, старые ключи больше не читаются и истекают сами
+    """
+
+    def __init__(self, redis_conn: Redis, timeout: int) -> None:
+        self.redis_conn = redis_conn
+        self.timeout = timeout
+
+    def detail_key(self, tournament_id: int, version: int) -> str:
+        return f'tournament:{tournament_id}:detail:{version}'
+
+    def get_detail(self, tournament_id: int, version: int) -> Optional[bytes]:
+        try:
+            return self.redis_conn.get(self.detail_key(tournament_id, version))
+        except:
+            return None
+
+    def set_detail(self, tournament_id: int, version: int, content: bytes, timeout: Optional[int] = None) -> None:
+        try:
+            self.redis_conn.set(self.detail_key(tournament_id, version), content, ex=timeout or self.timeout)
+        except:
+            pass
+
+
+class PricesHistogramCache:
+    """
+    Гистограммы цен турниров в redis под ключом (версия цен, фильтры запроса).
+    Версия увеличивается только при изменении цен турниров, старые ключи истекают сами
+    """
+    version_key = 'tournaments:prices:version'
+
+    def __init__(self, redis_conn: Redis, timeout: int) -> None:
+        self.redis_conn = redis_conn
+        self.timeout = timeout
+
+    def histogram_key(self, version: int, filters_key: str) -> str:
+        return f'tournaments:prices:{version}:{filters_key}'
+
+    def get_version(self) -> Optional[int]:
+        try:
+            return int(self.redis_conn.get(self.version_key) or 0)
+        except:
+            return None
+
+    def bump_version(self) -> None:
+        try:
+            self.redis_conn.incr(self.version_key)
+        except:
+            pass
+
+    def get_histogram(self, version: int, filters_key: str) -> Optional[Dict]:
+        try:
+            return json.loads(self.redis_conn.get(self.histogram_key(version, filters_key)))
+        except:
+            return None
+
+    def set_histogram(self, version: int, filters_key: str, histogram: Dict) -> None:
+        try:
+            self.redis_conn.set(self.histogram_key(version, filters_key), json.dumps(histogram), ex=self.timeout)
+        except:
+            pass
+
+
+class FacetsCache:
+    """Счетчики фильтров (FacetsView) в redis под ключом набора фильтров. Живут недолго и не сбрасываются вручную"""
+
+    def __init__(self, redis_conn: Redis, timeout: int) -> None:
+        self.redis_conn = redis_conn
+        self.timeout = timeout
+
+    def facets_key(self, key: str) -> str:
+        return f'facets:{key}'
+
+    def get_facets(self, key: str) -> Optional[Dict]:
+        try:
+            return json.loads(self.redis_conn.get(self.facets_key(key)))
+        except:
+            return None
+
+    def set_facets(self, key: str, facets: Dict) -> None:
+        try:
+            self.redis_conn.set(self.facets_key(key), json.dumps(facets), ex=self.timeout)
+        except:
+            pass
@@ -0,0 +1,71 @@
+from functools import reduce
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from main.services.search_index import search_queryset
+
+# Поиск по текстовым полям без последовательного сканирования таблицы (миграция 0065_search_indexes).
+# PostgreSQL: GIN индексы pg_trgm по UPPER(поле) - их использует и обычный icontains, ранжирование по сходству триграмм.
+# SQLite: внешняя FTS5 таблица {таблица}_search с токенизатором trigram, обновляется триггерами, ранжирование bm25.
+
+SEARCH_FIELDS = {
+    'main_tournament': ['name'],
+    'main_amateurmatch': ['name', 'address', 'city'],
+}
+
+# Триграммный индекс не ищет слова короче трех символов
+MIN_TERM_LENGTH = 3
+
+
+def get_search_terms(value):
+    return [term for term in value.split() if term]
+
+
+def filter_contains(queryset, fields, terms):
+    """Каждое слово встречается хотя бы в одном из полей"""
+    queries = [reduce(lambda query, field: query | Q(**{f'{field}__icontains': term}), fields, Q()) for term in terms]
+    return queryset.filter(reduce(lambda query, item: query & item, queries))
+
+
+def search_postgresql(queryset, fields, terms, value):
+    from django.contrib.postgres.search import TrigramWordSimilarity
+    from django.db.models.functions import Greatest
+
+    similarities = [TrigramWordSimilarity(value, field) for field in fields]
+    rank = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+    return filter_contains(queryset, fields, terms).annotate(search_rank=rank).order_by('-search_rank', '-id')
+
+
+def search_sqlite(queryset, table, terms):
+    search_table = f'{table}_search'
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    ids = RawSQL(f'SELECT rowid FROM {search_table} WHERE {search_table} MATCH %s', [match])
+    # bm25 меньше у более подходящих записей
+    rank = RawSQL(
+        f'SELECT bm25({search_table}) FROM {search_table} WHERE {search_table} MATCH %s AND rowid = {table}.id', [match]
+    )
+    return queryset.filter(id__in=ids).annotate(search_rank=rank).order_by('search_rank', '-id')
+
+
+def search(queryset, value):
+    """
+    Поиск по поисковому индексу, если он включен, иначе по SEARCH_FIELDS модели. Результаты от наиболее подходящих.
+    Если индекс не поддерживается базой или слово слишком короткое - обычный icontains без ранжирования
+    """
+    found = search_queryset(queryset, value)
+    if found is not None:
+        return found
+
+    table = queryset.model._meta.db_table
+    fields = SEARCH_FIELDS[table]
+    terms = get_search_terms(value)
+    if not terms:
+        return queryset
+
+    if any(len(term) < MIN_TERM_LENGTH for term in terms):
+        return filter_contains(queryset, fields, terms)
+    if connection.vendor == 'postgresql':
+        return search_postgresql(queryset, fields, terms, value)
+    if connection.vendor == 'sqlite':
+        return search_sqlite(queryset, table, terms)
+    return filter_contains(queryset, fields, terms)
@@ -0,0 +1,211 @@
+import logging
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from django.conf import settings
+from django.db.models import Case, IntegerField, Value, When
+from django.utils.module_loading import import_string
+from main.all_models.match import AmateurMatch
+from main.all_models.team import Team
+from main.all_models.tournament import Tournament
+from main.models import User
+
+# Поисковый индекс (Elasticsearch) турниров, любительских матчей, команд и пользователей.
+# Документы обновляются после коммита по сигналам сохранения/удаления (main/signals.py) задачей update_search_index_task,
+# полностью пересобираются командой reindex_search. Бэкенд задается настройкой SEARCH_BACKEND,
+# в тестах вместо Elasticsearch используется InMemorySearchBackend.
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+
+class InMemorySearchBackend:
+    """Инвертированный индекс в памяти процесса с тем же интерфейсом, что и ElasticsearchBackend"""
+
+    # Ошибки недоступности бэкенда, при которых поиск переходит на базу
+    errors = (ConnectionError,)
+
+    def __init__(self):
+        self.indexes = {}
+
+    def get_index(self, index):
+        return self.indexes.setdefault(index, {'documents': {}, 'postings': defaultdict(set)})
+
+    def index_documents(self, index, documents):
+        self.delete_documents(index, documents.keys())
+        data = self.get_index(index)
+        for document_id, document in documents.items():
+            tokens = Counter(tokenize(' '.join(document.values())))
+            data['documents'][document_id] = tokens
+            for token in tokens:
+                data['postings'][token].add(document_id)
+
+    def delete_documents(self, index, ids):
+        data = self.get_index(index)
+        for document_id in list(ids):
+            for token in data['documents'].pop(document_id, {}):
+                data['postings'][token].discard(document_id)
+
+    def clear(self, index):
+        self.indexes.pop(index, None)
+
+    def search(self, index, query, fields, size):
+        """Каждое слово запроса - префикс слова документа. Полное совпадение слова весит больше"""
+        data = self.get_index(index)
+        scores = None
+        for term in tokenize(query):
+            term_scores = Counter()
+            for token, ids in data['postings'].items():
+                if token.startswith(term):
+                    for document_id in ids:
+                        term_scores[document_id] += data['documents'][document_id][token] * (2 if token == term else 1)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = Counter({document_id: scores[document_id] + score for document_id, score in term_scores.items() if document_id in scores})
+        ranked = sorted((scores or {}).items(), key=lambda item: (-item[1], item[0]))
+        return [document_id for document_id, _ in ranked[:size]]
+
+
+class ElasticsearchBackend:
+    def __init__(self):
+        from elasticsearch import Elasticsearch
+        self.client = Elasticsearch(settings.ELASTICSEARCH_HOSTS)
+
+    @property
+    def errors(self):
+        # ConnectionError и ошибки ответа кластера - подклассы TransportError
+        from elasticsearch.exceptions import TransportError
+        return (TransportError,)
+
+    def index_documents(self, index, documents):
+        from elasticsearch.helpers import bulk
+        actions = ({'_op_type': 'index', '_index': index, '_id': document_id, '_source': document} for document_id, document in documents.items())
+        bulk(self.client, actions)
+
+    def delete_documents(self, index, ids):
+        from elasticsearch.helpers import bulk
+        # Документа может не быть в индексе, 404 не ошибка
+        bulk(self.client, ({'_op_type': 'delete', '_index': index, '_id': document_id} for document_id in ids), raise_on_error=False)
+
+    def clear(self, index):
+        self.client.indices.delete(index=index, ignore_unavailable=True)
+
+    def search(self, index, query, fields, size):
+        body = {
+            'query': {'multi_match': {'query': query, 'fields': fields, 'type': 'bool_prefix', 'operator': 'and'}},
+            'size': size,
+            '_source': False,
+        }
+        response = self.client.search(index=index, body=body, ignore_unavailable=True)
+        return [int(hit['_id']) for hit in response['hits']['hits']]
+
+
+@lru_cache
+def load_search_backend(path):
+    return import_string(path)()
+
+
+def get_search_backend():
+    return load_search_backend(settings.SEARCH_BACKEND)
+
+
+class SearchIndex:
+    """Какие поля модели попадают в документ. Поля связанных моделей через __ (sport__name -> sport_name)"""
+
+    def __init__(self, name, model, fields, select_related=()):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.select_related = select_related
+        # Поля модели, от которых зависит документ
+        self.model_fields = {field.split('__')[0] for field in fields}
+
+    @property
+    def index_name(self):
+        return f'{settings.SEARCH_INDEX_PREFIX}_{self.name}'
+
+    @property
+    def document_fields(self):
+        return [field.replace('__', '_') for field in self.fields]
+
+    def get_queryset(self):
+        return self.model.objects.select_related(*self.select_related).order_by('id')
+
+    def get_document(self, obj):
+        document = {}
+        for field in self.fields:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr) if value is not None else None
+            document[field.replace('__', '_')] = str(value) if value is not None else ''
+        return document
+
+
+SEARCH_INDEXES = {
+    index.name: index for index in [
+        SearchIndex('tournaments', Tournament, ['name', 'city', 'address', 'sport__name'], ['sport']),
+        SearchIndex('amateur_matches', AmateurMatch, ['name', 'city', 'address', 'sport__name'], ['sport']),
+        SearchIndex('teams', Team, ['name', 'sport__name'], ['sport']),
+        SearchIndex('users', User, ['username', 'first_name', 'surname', 'last_name']),
+    ]
+}
+
+
+def get_model_index(model):
+    for index in SEARCH_INDEXES.values():
+        if index.model is model:
+            return index
+    return None
+
+
+def update_search_index(name, ids):
+    """Переиндексирует объекты по id. Удаленные из базы объекты удаляются из индекса"""
+    index = SEARCH_INDEXES[name]
+    objects = index.get_queryset().in_bulk(ids)
+    backend = get_search_backend()
+    if objects:
+        backend.index_documents(index.index_name, {obj.id: index.get_document(obj) for obj in objects.values()})
+    deleted_ids = [object_id for object_id in ids if object_id not in objects]
+    if deleted_ids:
+        backend.delete_documents(index.index_name, deleted_ids)
+
+
+def reindex(name, batch_size=500):
+    """Пересоздает индекс целиком, объекты читаются пачками по id. Возвращает количество документов"""
+    index = SEARCH_INDEXES[name]
+    backend = get_search_backend()
+    backend.clear(index.index_name)
+
+    count, last_id = 0, 0
+    while True:
+        objects = list(index.get_queryset().filter(id__gt=last_id)[:batch_size])
+        if not objects:
+            return count
+        backend.index_documents(index.index_name, {obj.id: index.get_document(obj) for obj in objects})
+        count += len(objects)
+        last_id = objects[-1].id
+
+
+def search_queryset(queryset, value):
+    """
+    Результаты поиска по индексу в порядке релевантности (не больше SEARCH_RESULTS_LIMIT).
+    None, если индекс выключен или недоступен - тогда ищем по базе
+    """
+    index = get_model_index(queryset.model)
+    if not settings.SEARCH_INDEXING or index is None:
+        return None
+    backend = get_search_backend()
+    try:
+        ids = backend.search(index.index_name, value, index.document_fields, settings.SEARCH_RESULTS_LIMIT)
+    except backend.errors as error:
+        logger.warning('Поисковый индекс недоступен, поиск по базе: %s', error)
+        return None
+
+    if not ids:
+        return queryset.none()
+    order = Case(*[When(id=object_id, then=Value(position)) for position, object_id in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(id__in=ids).order_by(order)
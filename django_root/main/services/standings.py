@@ -0,0 +1,75 @@
+from django.db import transaction
+from main.all_models.tournament import Participant, Standing
+
+# Турнирная таблица хранится готовой (модель Standing) и меняется только на разницу:
+# при сохранении результата матча или этапа старый вклад вычитается, а новый добавляется.
+# Поэтому чтение таблицы не требует агрегации по StageResult и Match.
+
+STANDING_FIELDS = ['points', 'wins', 'draws', 'losses', 'score_difference']
+
+
+class StandingsChanges:
+    """Накопленные изменения турнирной таблицы: {(id участника, группа): {поле: изменение}}"""
+
+    def __init__(self, tournament):
+        self.tournament = tournament
+        self.changes = {}
+
+    def add(self, participant_id, group, **values):
+        key = (participant_id, group or 0)
+        change = self.changes.setdefault(key, dict.fromkeys(STANDING_FIELDS, 0))
+        for field, value in values.items():
+            change[field] += value
+
+    def add_points(self, participant_id, group, points):
+        if participant_id and points:
+            self.add(participant_id, group, points=points)
+
+    def add_match(self, match, group, sign=1):
+        """Добавляет (sign=1) или вычитает (sign=-1) вклад завершенного матча"""
+        if match.status != 2 or not match.participant1_id or not match.participant2_id:
+            return
+
+        sides = [
+            (match.participant1_id, match.participant1_score, match.participant2_score),
+            (match.participant2_id, match.participant2_score, match.participant1_score),
+        ]
+        for participant_id, score, opponent_score in sides:
+            self.add(
+                participant_id, group,
+                wins=sign * (score > opponent_score),
+                draws=sign * (score == opponent_score),
+                losses=sign * (score < opponent_score),
+                score_difference=sign * (score - opponent_score),
+            )
+
+    @transaction.atomic
+    def save(self):
+        """Применяет изменения к таблице и к очкам участников. Количество запросов не зависит от числа изменений"""
+        changes = {key: change for key, change in self.changes.items() if any(change.values())}
+        if not changes:
+            return
+
+        Standing.objects.bulk_create(
+            [Standing(tournament=self.tournament, participant_id=participant_id, group=group) for participant_id, group in changes],
+            ignore_conflicts=True,
+        )
+        participants_ids = {participant_id for participant_id, _ in changes}
+        standings = list(Standing.objects.select_for_update().filter(participant_id__in=participants_ids))
+        for standing in standings:
+            change = changes.get((standing.participant_id, standing.group))
+            if change:
+                for field in STANDING_FIELDS:
+                    setattr(standing, field, getattr(standing, field) + change[field])
+        Standing.objects.bulk_update(standings, STANDING_FIELDS)
+
+        # Participant.score - очки за весь турнир, final_step_score - только финальная стадия двуступенчатого турнира
+        participants = Participant.objects.select_for_update().in_bulk(participants_ids)
+        for (participant_id, group), change in changes.items():
+            participant = participants[participant_id]
+            participant.score += change['points']
+            if self.tournament.tournament_type == 1 and group == 0:
+                participant.final_step_score += change['points']
+        Participant.objects.bulk_update(participants.values(), ['score', 'final_step_score'])
+
+        self.changes = {}
@@ -1,358 +1,23 @@
+import json
 import math
 from turtle import position
 from main.all_models.tournament import StageResult, TournamentStage, Match, Participant, Tournament
-import random
-
-def get_participants_from_matches_data(matches_data: list, tournament, available_participants):
-    match_info = None
-    try:
-        match_info = matches_data.pop()
-    except:
-        pass
-    
-    participants_ids = []
-    if match_info:
-        participants_ids = match_info.get('participants', [])
-    
-    extracted_participants = []
-    for pid in participants_ids:
-        if tournament.is_team_tournament:
-            participant = next((p for p in available_participants if p.team.id == pid), None)
-        else:
-            participant = next((p for p in available_participants if p.user.id == pid), None)
-        
-        if participant:
-            available_participants.remove(participant)
-            extracted_participants.append(participant)
-    
-    while len(extracted_participants) < 2:
-        if available_participants:
-            extracted_participants.append(available_participants.pop())
-        else:
-            extracted_participants.append(None)
-    
-    return extracted_participants[0], extracted_participants[1], match_info
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from collections import Counter
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Max, Min, OuterRef, Q, Subquery, Sum, Value, Window
+from django.db.models.functions import Coalesce, Floor, Least, Rank
+from main.services.bracket import BracketPlan, get_played_pairs, pair_swiss_participants, plan_double_elimination, plan_round_robin, plan_single_elimination, plan_swiss
+from main.services.standings import StandingsChanges
+from rest_framework.exceptions import ValidationError
 
 def create_single_elimination_bracket(tournament, matches_data, participants:list):
-    num_participants = len(participants)
-    target_participants = 2**math.ceil(math.log2(num_participants)) // 2
-    if num_participants == 0:
-        num_rounds = 0
-    else:
-        num_rounds = math.ceil(math.log2(target_participants))
-    current_matches = []
-    
-    preliminary_needed = False
-    if num_participants != target_participants:
-        preliminary_needed = True
-        num_preliminary_matches = num_participants - target_participants
-
-    num_matches_in_round_one = target_participants // 2
-    
-    stage_position = 1
-    stage_position_offset = tournament.get_stage_offset()
-
-    if preliminary_needed:
-        stage_name = get_stage_name(0, num_rounds)
-        stage = TournamentStage.objects.create(name=stage_name, tournament=tournament, position=stage_position + stage_position_offset)
-        stage_position += 1
-        for i in range(num_preliminary_matches):
-            # match_info = matches_data[i] if i < len(matches_data) else None
-            
-            participant1, participant2, match_info = get_participants_from_matches_data(matches_data, tournament, participants)
-            
-            match = Match.objects.create(
-                participant1=participant1,
-                participant2=participant2,
-                scheduled_start=match_info.get("scheduled_start", None),
-                stage=stage
-            )
-            current_matches.append(match)
-
-    for round_number in range(1, num_rounds + 1):
-        stage_name = get_stage_name(round_number, num_rounds)
-        stage = TournamentStage.objects.create(name=stage_name, tournament=tournament, position=stage_position + stage_position_offset)
-        stage_position += 1
-
-        new_matches = []
-        match_count = 0
-        if round_number == 1:
-            for i in range(num_matches_in_round_one):
-                if not participants:
-                    break
-                # match_info = matches_data[i + num_preliminary_matches] if (i + num_preliminary_matches) < len(matches_data) else None
-                participant1, participant2, match_info = get_participants_from_matches_data(matches_data, tournament, participants)
-
-                scheduled_start = None if not match_info else match_info.get("scheduled_start", None)                
-
-                match = Match.objects.create(
-                    scheduled_start=scheduled_start,
-                    participant1=participant1,
-                    participant2=participant2,
-                    stage=stage
-                )
-                new_matches.append(match)
-                match_count += 1  
-            
-            i = 0
-            if current_matches:
-                for match in new_matches:
-                    if not match.participant1:
-                        current_matches[i].next_match = match
-                        current_matches[i].save()
-                        i += 1
-                    if not match.participant2:
-                        current_matches[i].next_match = match
-                        current_matches[i].save()
-                        i += 1
-        else:
-            for i in range(0, len(current_matches), 2):
-                new_match = Match.objects.create(stage=stage)
-                current_matches[i].next_match = new_match
-                if i + 1 < len(current_matches):
-                    current_matches[i + 1].next_match = new_match
-                current_matches[i].save()
-                if i + 1 < len(current_matches):
-                    current_matches[i + 1].save()
-                new_matches.append(new_match)
-
-        current_matches = new_matches
-
-def get_stage_name(round_number, num_rounds):
-    if round_number == num_rounds:
-        return "Финал"
-    elif round_number == num_rounds - 1:
-        return "Полуфинал"
-    else:
-        return f"Этап {round_number}"
+    plan = plan_single_elimination(tournament, matches_data, participants, tournament.get_stage_offset())
+    plan.save(tournament)
 
 def create_double_elimination_bracket(tournament, matches_data, participants:list):
-    num_participants = len(participants)
-    target_participants = 2**math.ceil(math.log2(num_participants)) // 2
-    num_rounds_upper = math.ceil(math.log2(target_participants))
-    num_rounds_lower = 2 * (num_rounds_upper) - 2
-    
-    stage_position_offset = tournament.get_stage_offset() # Для Двуступенчатых турниров
-    
-    preliminary_needed = False
-    need_create_additional_stage = False
-    if num_participants != target_participants:
-        preliminary_needed = True
-        num_preliminary_matches = num_participants - target_participants
-        need_create_additional_stage = num_preliminary_matches > target_participants // 2
-        
-    # Создаем этапы верхней и нижней сетки
-    upper_stages = [
-        TournamentStage.objects.create(
-            name=f"Верхняя сетка - Этап {i + 1}", tournament=tournament, position=(i * 2 + 1) + stage_position_offset
-        ) for i in range(num_rounds_upper)
-    ]
-
-    lower_stages = [
-        TournamentStage.objects.create(
-            name=f"Нижняя сетка - Этап {i + 1}", tournament=tournament, position=(i * 2 + 2) + stage_position_offset
-        ) for i in range(num_rounds_lower)
-    ]
-
-    if target_participants != num_participants:
-        position = -1
-        new_upper_stage = TournamentStage.objects.create(name=f"Верхняя сетка - Предварительный Этап 1", tournament=tournament, position=position)
-        # upper_stages.append(new_upper_stage)
-        additional_upper_matches = []
-        for i in range(num_preliminary_matches):
-            participant1, participant2, match_info = get_participants_from_matches_data(matches_data, tournament, participants)
-            match = Match.objects.create(
-                participant1=participant1,
-                participant2=participant2,
-                scheduled_start=match_info.get("scheduled_start", None),
-                stage=new_upper_stage
-            )
-            additional_upper_matches.append(match)
-
-        position = 1
-        new_lower_stage = TournamentStage.objects.create(name=f"Нижняя сетка - Предварительный Этап 2", tournament=tournament, position=position)
-        # lower_stages.append(new_lower_stage)
-        additional_lower_matches = []
-
-        for i in range(min(target_participants // 2, num_preliminary_matches)):
-            match = Match.objects.create(stage=new_lower_stage)
-            additional_upper_matches[i].next_lose_match = match
-            additional_upper_matches[i].save()
-            additional_lower_matches.append(match)
-        
-        if need_create_additional_stage:
-            upper_stages[0].position = 0
-            upper_stages[0].save()
-            new_upper_stage.position = -2
-            new_upper_stage.save()
-            position = -1
-            
-            new_lower_stage2 = TournamentStage.objects.create(name=f"Нижняя сетка - Предварительный Этап 1", tournament=tournament, position=position)
-            # lower_stages.append(new_lower_stage2)
-            new_lower_stage.position = 1
-            new_lower_stage.save()           
-         
-            additional_upper_matches_len = len(additional_upper_matches)
-            for i in range(target_participants // 2, num_preliminary_matches):
-                match = Match.objects.create(stage = new_lower_stage2)
-                
-                next_match_set = False
-                count = 0
-                while not next_match_set:
-                    if not additional_lower_matches[count].participant1 or not additional_lower_matches[count].participant2:
-                        match.next_match = additional_lower_matches[count]
-                        match.save()
-                        next_match_set = True
-                    count += 1
-
-                additional_upper_matches[additional_upper_matches_len-1].next_lose_match = match
-                additional_upper_matches[additional_upper_matches_len-1].save()
-
-                additional_upper_matches[additional_upper_matches_len-2].next_lose_match = match
-                additional_upper_matches[additional_upper_matches_len-2].save()
-
-                additional_upper_matches_len -= 2
-
-              
-                
-
-    # Фиксим позиции этапов если надо
-    previous_stage = None
-    for stage in TournamentStage.objects.filter(tournament=tournament).order_by("position"):
-        if previous_stage:
-            if stage.position - previous_stage.position != 1:
-                stage.position = previous_stage.position + 1
-                stage.save()
-        previous_stage = stage 
-
-    # Создаем матчи для первого раунда верхней сетки
-    count = 0
-    for i in range(target_participants // 2):
-        participant1, participant2, match_info = get_participants_from_matches_data(matches_data, tournament, participants)
-        if match_info:
-            scheduled_start = match_info.get('scheduled_start', None)
-
-        match = Match.objects.create(
-            stage=upper_stages[0],
-            scheduled_start=scheduled_start,
-            participant1=participant1,
-            participant2=participant2
-        )
-
-        if count < len(additional_upper_matches) and not participant1:            
-                additional_upper_matches[count].next_match = match
-                additional_upper_matches[count].save()
-                count += 1
-        
-        if count < len(additional_upper_matches) and not participant2:            
-                additional_upper_matches[count].next_match = match
-                additional_upper_matches[count].save()
-                count += 1
-
-        if i < len(additional_lower_matches):
-            match.next_lose_match = additional_lower_matches[i]
-            match.save()
-
-    # Матчи для верхней сетки
-    for stage_index in range(1, num_rounds_upper):
-        previous_stage_matches = Match.objects.filter(stage=upper_stages[stage_index - 1])
-        for i in range(0, len(previous_stage_matches), 2):
-            match = Match.objects.create(
-                stage=upper_stages[stage_index]
-            )            
-
-            previous_stage_matches[i].next_match = match
-            previous_stage_matches[i].save()
-            if len(previous_stage_matches) > 1:
-                previous_stage_matches[i + 1].next_match = match
-                previous_stage_matches[i + 1].save()
-
-    # Создание матчей для нижней сетки
-    for stage_index in range(num_rounds_lower):
-        current_stage = lower_stages[stage_index]
-
-        if stage_index == 0:
-            # Первый этап нижней сетки - проигравшие первого раунда верхней сетки
-            upper_first_round_matches = Match.objects.filter(stage=upper_stages[0])
-            count = 0
-            for i in range(0, len(upper_first_round_matches), 2):                
-                new_match = Match.objects.create(stage=current_stage)
-                
-                next_lose_match_set1 = False                
-                next_lose_match_set2 = False                
-                while not next_lose_match_set1 and not next_lose_match_set2:
-                    if i >= len(upper_first_round_matches):
-                        next_lose_match_set1 = True
-                    elif not upper_first_round_matches[i].next_lose_match: 
-                        upper_first_round_matches[i].next_lose_match = new_match
-                        upper_first_round_matches[i].save()
-                        next_lose_match_set1 = True
-                    if i + 1 >= len(upper_first_round_matches):
-                        next_lose_match_set2 = True
-                    elif not upper_first_round_matches[i + 1].next_lose_match: 
-                        upper_first_round_matches[i + 1].next_lose_match = new_match
-                        upper_first_round_matches[i + 1].save()
-                        next_lose_match_set2 = True
-                    i += 2                 
-                
-                if count < len(additional_lower_matches):
-                    additional_lower_matches[count].next_match = new_match
-                    additional_lower_matches[count].save()
-                if count+1 < len(additional_lower_matches):
-                    additional_lower_matches[count+1].next_match = new_match
-                    additional_lower_matches[count+1].save()
-                count += 2
-        elif stage_index % 2 == 0:
-            # Этапы, где лузеры играют с лузерами
-            previous_lower_stage_matches = Match.objects.filter(stage=lower_stages[stage_index - 1])
-            for i in range(0, len(previous_lower_stage_matches), 2):
-                new_match = Match.objects.create(stage=current_stage)
-                previous_lower_stage_matches[i].next_match = new_match
-                previous_lower_stage_matches[i].save()
-                if i + 1 < len(previous_lower_stage_matches):
-                    previous_lower_stage_matches[i + 1].next_match = new_match
-                    previous_lower_stage_matches[i + 1].save()
-        else:
-            upper_stage_losers_matches = Match.objects.filter(stage=upper_stages[stage_index // 2 + 1])
-            previous_lower_stage_matches = Match.objects.filter(stage=lower_stages[stage_index - 1])
-            previous_lower_stage_matches_len = len(previous_lower_stage_matches)
-            
-            for i, match in enumerate(upper_stage_losers_matches, start=0):
-                new_match = Match.objects.create(stage=current_stage)
-                match.next_lose_match = new_match
-                match.save()
-                if previous_lower_stage_matches_len > i:
-                    previous_lower_stage_matches[i].next_match = new_match
-                    previous_lower_stage_matches[i].save()
-                i += 1
-
-    # Финальный этап
-    last_stage_position = TournamentStage.objects.filter(tournament=tournament).order_by("position").last().position
-    final_stage = TournamentStage.objects.create(
-        name="Финал", tournament=tournament, position=last_stage_position + 1
-    )
-    final_match = Match.objects.create(
-        stage=final_stage,
-    )
-
-    # Связываем финальный матч с победителями сеток
-    last_upper_stage_matches = Match.objects.filter(stage=upper_stages[-1])
-    for match in last_upper_stage_matches:
-        if match.next_match is None:
-            match.next_match = final_match
-            match.save()
-
-    last_lower_stage_matches = Match.objects.filter(stage=lower_stages[-1])
-    for match in last_lower_stage_matches:
-        if match.next_match is None:
-            match.next_match = final_match
-            match.save()
-
-    final_match.save()
-    first_stage_position = TournamentStage.objects.filter(tournament=tournament).order_by("position").first().position
-    tournament.active_stage_position = first_stage_position
-    tournament.save()
-
+    plan = plan_double_elimination(tournament, matches_data, participants, tournament.get_stage_offset())
+    plan.save(tournament)
 
 def create_final_match(upper_final_stage, lower_final_stage, tournament):
     stages_count = TournamentStage.objects.filter(tournament=tournament).count()
@@ -374,180 +39,129 @@ def create_final_match(upper_final_stage, lower_final_stage, tournament):
 
 def create_round_robin_bracket(tournament, participants):
     matches_count = tournament.mathces_count if tournament.mathces_count else 1
-    
-    stage_position_offset = tournament.get_stage_offset()
-
-    for position in range(1, matches_count+1):
-        stage_name = f"Этап {position}"
-        stage = TournamentStage.objects.create(name=stage_name, tournament=tournament, position=position + stage_position_offset)                    
-        for i in range(len(participants)):
-            for j in range(i + 1, len(participants)):
-                Match.objects.create(
-                    participant1=participants[i],
-                    participant2=participants[j],
-                    stage=stage
-                )
+    plan = plan_round_robin([participants], matches_count, tournament.get_stage_offset())
+    plan.save(tournament)
 
-def create_round_robin_bracket_2step(tournament):
+def plan_round_robin_bracket_2step(tournament):
     """Участники разделяются на N групп. В каждой группе проходит round robin этап. """
     groups_count = tournament.max_participants // tournament.participants_in_group
     splitted_participants = tournament.get_participants_for_groups(groups_count)
-    position = 1
-    group_number = 1
-    for participants in splitted_participants:
-        rounds_count = tournament.rounds_count if tournament.rounds_count else 1
-        
-        for _ in range(rounds_count):
-            stage_name = f"Группа {group_number}. Этап {position}"
-            stage = TournamentStage.objects.create(name=stage_name, tournament=tournament, position=position)                    
-            for i in range(len(participants)):
-                for j in range(i + 1, len(participants)):
-                    Match.objects.create(
-                        participant1=participants[i],
-                        participant2=participants[j],
-                        stage=stage
-                    )
-            position += 1
-        group_number += 1
-
-def create_swiss_bracket(tournament, matches_data, participants:list):
-    num_participants = len(participants)
+    matches_count = tournament.mathces_count if tournament.mathces_count else 1
+    return plan_round_robin(splitted_participants, matches_count, is_group_stage=True)
 
-    stage_position_offset = tournament.get_stage_offset() # Для Двуступенчатых турниров
+def create_round_robin_bracket_2step(tournament):
+    plan_round_robin_bracket_2step(tournament).save(tournament)
 
-    stage_name = "Этап 1"
-    stage = TournamentStage.objects.create(name=stage_name, tournament=tournament, position=1 + stage_position_offset)
-
-    random.shuffle(participants)
-    for i in range(0, num_participants, 2):
-        if i + 1 < num_participants:
-            match_info = matches_data[i] if i < len(matches_data) else None
-            scheduled_start = None
-            participants_ids = []
-            if match_info:
-                scheduled_start = match_info.get('scheduled_start')
-                participants_ids = match_info.get('participants', [])
-
-            participant1 = None
-            participant2 = None
-
-            if participants_ids:
-                if tournament.is_team_tournament:
-                    participant1 = next((p for p in participants if p.team.id == participants_ids[0]), None)
-                    participant2 = next((p for p in participants if p.team.id == participants_ids[1]), None)
-                else:
-                    participant1 = next((p for p in participants if p.user.id == participants_ids[0]), None)
-                    participant2 = next((p for p in participants if p.user.id == participants_ids[1]), None)
-                if participant1 in participants:
-                    participants.remove(participant1)
-                if participant2 in participants:
-                    participants.remove(participant2)
-            else:
-                participant1 = participants.pop() if participants else None
-                participant2 = participants.pop() if participants else None
-            
-            Match.objects.create(
-                participant1=participant1,
-                participant2=participant2,
-                scheduled_start=scheduled_start,
-                stage=stage
-            )
+def create_swiss_bracket(tournament, matches_data, participants:list):
+    plan = plan_swiss(tournament, matches_data, participants, tournament.get_stage_offset())
+    plan.save(tournament)
 
-def create_leaderboard_bracket(tournament):
+def plan_leaderboard_bracket(tournament):
     stage_position_offset = tournament.get_stage_offset() # Для Двуступенчатых турниров
 
     # Каждый этап будет как событие(тур) турнира
+    plan = BracketPlan()
     rounds_count = max(tournament.rounds_count, 1)
     for i in range(1, rounds_count+1):
-        stage_name = f"Этап {i}"
-        TournamentStage.objects.create(name=stage_name, tournament=tournament, position=i + stage_position_offset)            
+        plan.add_stage(f"Этап {i}", i + stage_position_offset)
+    return plan
+
+def create_leaderboard_bracket(tournament):
+    plan_leaderboard_bracket(tournament).save(tournament)
+
+def plan_tournament_bracket(tournament, matches_data, participants):
+    """Строит сетку турнира в памяти, ничего не записывая в БД. Для сохранения используется plan.save(tournament)"""
+    if tournament.tournament_type == 1:  # Двуступенчатый турнир
+        # Сетку финального этапа строит EndTournamentStage после группового этапа
+        if TournamentStage.objects.filter(tournament=tournament).exists():
+            return BracketPlan()
+        return plan_round_robin_bracket_2step(tournament)
+
+    stage_position_offset = tournament.get_stage_offset()
+    if tournament.bracket == 0:  # Single Elimination
+        return plan_single_elimination(tournament, matches_data, participants, stage_position_offset)
+    elif tournament.bracket == 1:  # Double Elimination
+        return plan_double_elimination(tournament, matches_data, participants, stage_position_offset)
+    elif tournament.bracket == 2:  # Round Robin
+        matches_count = tournament.mathces_count if tournament.mathces_count else 1
+        return plan_round_robin([participants], matches_count, stage_position_offset)
+    elif tournament.bracket == 3:  # Swiss
+        return plan_swiss(tournament, matches_data, participants, stage_position_offset)
+    elif tournament.bracket == 4:  # Leaderboard
+        return plan_leaderboard_bracket(tournament)
+    return BracketPlan()
 
 def create_new_swiss_round(stage, tournament):
-    participants = list(Participant.objects.filter(tournament=tournament))
-    # Сортировка участников по их текущему счету в убывающем порядке
-    participants.sort(key=lambda x: x.score, reverse=True)
+    participants = Participant.objects.filter(tournament=tournament)
+    if tournament.tournament_type == 1:
+        participants = participants.filter(qualified=True)
 
-    # Организация пар на основе текущих результатов
-    # Используем жадный метод для создания пар, чтобы максимально сбалансировать уровень соперников
-    used = set()
-    pairs = []
+    # Сортировка участников по их текущему счету в убывающем порядке.
+    # Учитываются только этапы швейцарской системы, без групповой стадии
+    participants = participants.annotate(
+        total_score=Coalesce(Sum('stage_results__score', filter=Q(stage_results__stage__group__isnull=True)), 0.0)
+    ).order_by('-total_score', 'id')
 
-    for participant in participants:
-        if participant not in used:
-            best_match = None
-            # Ищем наиболее подходящего соперника, не игравшего с данным участником
-            for potential_opponent in participants:
-                if potential_opponent not in used and potential_opponent != participant and not tournament.have_played(participant, potential_opponent):
-                    best_match = potential_opponent
-                    break
-            if best_match:
-                pairs.append((participant, best_match))
-                used.add(participant)
-                used.add(best_match)
+    # Все сыгранные пары загружаются одним запросом, чтобы не проверять каждую пару отдельно
+    pairs = pair_swiss_participants(list(participants), get_played_pairs(tournament))
 
     # Создаем матчи на основе сформированных пар
-    for participant1, participant2 in pairs:
-        Match.objects.create(
-            participant1=participant1,
-            participant2=participant2,
-            stage=stage                
-        )
+    Match.objects.bulk_create([
+        Match(participant1=participant1, participant2=participant2, stage=stage)
+        for participant1, participant2 in pairs
+    ])
+
+def get_score_difference(matches_filter=Q()):
+    """Разница забитых и пропущенных участника в завершенных матчах (подзапросы для annotate)"""
+    def difference(side, opponent_side):
+        matches = Match.objects.filter(matches_filter, status=2, **{side: OuterRef('pk')}).values(side)
+        matches = matches.annotate(difference=Sum(F(f'{side}_score') - F(f'{opponent_side}_score'))).values('difference')
+        return Coalesce(Subquery(matches), 0)
+    return difference('participant1', 'participant2') + difference('participant2', 'participant1')
+
+def rank_participants(participants, order_by, first_place=1, score_field=None):
+    """
+    Расставляет места одним запросом с RANK() OVER, участники с равными показателями делят место.
+    Места (и итоговые очки в score_field) сохраняются одним bulk_update
+    """
+    participants = list(participants.annotate(rank=Window(expression=Rank(), order_by=order_by)))
+    for participant in participants:
+        participant.place = first_place + participant.rank - 1
+        if score_field:
+            setattr(participant, score_field, participant.total_score)
+    Participant.objects.bulk_update(participants, ['place', score_field] if score_field else ['place'])
 
-def assign_final_positions(tournament):# TODO
-    qualified_participants = []
+def assign_final_positions(tournament):
+    participants = Participant.objects.filter(tournament=tournament)
     if tournament.tournament_type == 1:
-        qualified_participants = Participant.objects.filter(tournament=tournament, qualified=True)
-    not_qualified_participants = Participant.objects.filter(tournament=tournament, qualified=False)
-    if tournament.check_score_difference_on_draw:
-        if qualified_participants:
-            qualified_participants = sorted(qualified_participants, key=lambda x: (x.score, x.get_score_difference()), reverse=True)
-        not_qualified_participants = sorted(not_qualified_participants, key=lambda x: (x.score, x.get_score_difference()), reverse=True)
-
+        # Учитываются только этапы финальной стадии, вышедшие из групп стоят выше остальных
+        results_filter = Q(stage_results__stage__group__isnull=True)
+        matches_filter = Q(stage__group__isnull=True)
+        order_by = [F('qualified').desc()]
+        score_field = 'final_step_score'
     else:
-        if tournament.tournament_type == 0:
-            if qualified_participants:
-                qualified_participants = qualified_participants.order_by('-score')
-            not_qualified_participants = not_qualified_participants.order_by('-score')
-        else:
-            if qualified_participants:
-                qualified_participants = qualified_participants.order_by('-final_step_score')
-            not_qualified_participants = not_qualified_participants.order_by('-final_step_score')
-
-    for index, participant in enumerate(qualified_participants, start=1):
-        participant.place = index
-        participant.save()
-
-    for index, participant in enumerate(not_qualified_participants, start=len(qualified_participants)+1):
-        participant.place = index
-        participant.save()
+        results_filter = Q()
+        matches_filter = Q()
+        order_by = []
+        score_field = 'score'
 
-def assign_final_positions_leaderboard(tournament):
-    stages = TournamentStage.objects.filter(tournament=tournament)
-
-    participant_scores = {}
-    for stage in stages:
-        results = StageResult.objects.filter(stage=stage)
-        for result in results:
-            participant = result.participant
-            participant_scores[participant] = participant_scores.get(participant, 0) + result.score
+    participants = participants.annotate(total_score=Coalesce(Sum('stage_results__score', filter=results_filter), 0.0))
+    order_by.append(F('total_score').desc())
+    if tournament.check_score_difference_on_draw:
+        participants = participants.annotate(score_difference=get_score_difference(matches_filter))
+        order_by.append(F('score_difference').desc())
 
-    sorted_participants = sorted(participant_scores.items(), key=lambda x: x[1], reverse=True)
+    rank_participants(participants, order_by, score_field=score_field)
 
+def assign_final_positions_leaderboard(tournament):
+    participants = Participant.objects.filter(tournament=tournament).annotate(
+        total_score=Coalesce(Sum('stage_results__score'), 0.0)
+    )
+    order_by = [F('total_score').desc()]
     if tournament.tournament_type == 1:
-        qualified_participants = [p for p, score in sorted_participants if p.qualified]
-        not_qualified_participants = [p for p, score in sorted_participants if not p.qualified]
-        sorted_participants = qualified_participants + not_qualified_participants
-    else:
-        sorted_participants = [p for p, score in sorted_participants]
+        order_by.insert(0, F('qualified').desc())
 
-    current_position = 1
-    prev_score = None
-    for participant in sorted_participants:
-        if participant_scores[participant] != prev_score:
-            participant.place = current_position
-        prev_score = participant_scores[participant]
-        participant.save()
-        current_position += 1
+    rank_participants(participants, order_by, score_field='score')
 
 def assign_final_positions_single_elimination(tournament:Tournament):
     stages = TournamentStage.objects.filter(tournament=tournament).order_by('-position')  # Получаем этапы в обратном порядке
@@ -593,25 +207,374 @@ def assign_final_positions_double_elimination(tournament):
 
 def assign_final_positions_group_stage(tournament):
     qualified_count = Participant.objects.filter(tournament=tournament, qualified=True).count()
-    starting_position = qualified_count + 1
 
-    non_qualified_participants = Participant.objects.filter(
-        tournament=tournament, 
-        qualified=False
-    ).order_by('-score')
+    # Не вышедшие из групп занимают места после вышедших, по очкам групповой стадии
+    non_qualified_participants = Participant.objects.filter(tournament=tournament, qualified=False).annotate(
+        total_score=Coalesce(Sum('stage_results__score', filter=Q(stage_results__stage__group__isnull=False)), 0.0)
+    )
+    order_by = [F('total_score').desc()]
+    if tournament.check_score_difference_on_draw:
+        non_qualified_participants = non_qualified_participants.annotate(
+            score_difference=get_score_difference(Q(stage__group__isnull=False))
+        )
+        order_by.append(F('score_difference').desc())
+
+    rank_participants(non_qualified_participants, order_by, first_place=qualified_count + 1)
 
-    for index, participant in enumerate(non_qualified_participants, start=starting_position):
-        participant.place = index
-        participant.save()
+def get_match_points(match, tournament, stage):
+    """Очки участников за матч: [(id участника, очки)]"""
+    if tournament.tournament_type == 1 and stage.group:
+        # Если турнир двуступенчатый и завершается этап групповой стадии
+        win_points, draw_points = tournament.group_stage_win_points, tournament.group_stage_draw_points
+    else:
+        win_points, draw_points = tournament.win_points, tournament.draw_points
+
+    if match.participant1_score == match.participant2_score:
+        return [(match.participant1_id, draw_points), (match.participant2_id, draw_points)]
+    return [(match.winner_id, win_points)]
+
+@transaction.atomic
+def save_stage_scores(stage, scores):
+    """
+    Создает или обновляет результаты этапа одним запросом (upsert по уникальной паре этап-участник).
+    Разница со старыми результатами добавляется в турнирную таблицу.
+    scores - {id участника: очки}
+    """
+    scores = {participant_id: score for participant_id, score in scores.items() if participant_id}
+    old_scores = dict(
+        StageResult.objects.select_for_update().filter(stage=stage, participant_id__in=scores).values_list('participant_id', 'score')
+    )
+    StageResult.objects.bulk_create(
+        [StageResult(stage=stage, participant_id=participant_id, score=score) for participant_id, score in scores.items()],
+        update_conflicts=True,
+        unique_fields=['stage', 'participant'],
+        update_fields=['score'],
+    )
 
-def save_stage_score(participant, stage, score):
-    if participant:
+    standings_changes = StandingsChanges(stage.tournament)
+    for participant_id, score in scores.items():
+        standings_changes.add_points(participant_id, stage.group, score - old_scores.get(participant_id, 0))
+    standings_changes.save()
+
+def set_stage_scores(stage, matches, tournament):
+    """Начисляет очки за все матчи этапа"""
+    scores = {}
+    for match in matches:
+        scores.update(get_match_points(match, tournament, stage))
+    save_stage_scores(stage, scores)
+
+def get_participants_ids(tournament):
+    """{id пользователя (или команды): id участника} для всех участников турнира одним запросом"""
+    key = 'team_id' if tournament.is_team_tournament else 'user_id'
+    return dict(Participant.objects.filter(tournament=tournament).values_list(key, 'id'))
+
+def get_result_score(result_data, participants_ids):
+    """Проверяет строку results и возвращает (id участника, очки)"""
+    if not isinstance(result_data, dict):
+        raise ValidationError("ожидается объект с participant_id и score")
+
+    participant_id = result_data.get("participant_id", None)
+    score = result_data.get("score", 0)
+    if participant_id not in participants_ids:
+        raise ValidationError(f"участник {participant_id} не найден")
+    if not isinstance(score, (int, float)) or isinstance(score, bool):
+        raise ValidationError(f"некорректный счет участника {participant_id}")
+    return participants_ids[participant_id], score
+
+def get_results_scores(tournament, results_data):
+    """
+    Переводит results из запроса в {id участника: очки}.
+    Участники турнира загружаются одним запросом, ошибки всех строк собираются в одну ValidationError.
+    """
+    participants_ids = get_participants_ids(tournament)
+
+    scores = {}
+    errors = []
+    for result_data in results_data:
+        try:
+            participant_id, score = get_result_score(result_data, participants_ids)
+            scores[participant_id] = score
+        except ValidationError as error:
+            errors.append(str(error.detail[0]))
+
+    if errors:
+        raise ValidationError(f"Ошибка при обновлении: {', '.join(errors)}!")
+    return scores
+
+RESULTS_BATCH_SIZE = 500
+RESULTS_MAX_ERRORS = 20
+
+@transaction.atomic
+def import_stage_results(tournament, stage, lines):
+    """
+    Сохраняет результаты этапа из NDJSON: каждая строка - {"participant_id": ..., "score": ...}.
+    Строки читаются по одной, очки сохраняются пачками по RESULTS_BATCH_SIZE, поэтому память не растет с размером загрузки.
+    При ошибке в любой строке вся загрузка откатывается. Возвращает количество сохраненных строк.
+    """
+    participants_ids = get_participants_ids(tournament)
+
+    scores = {}
+    errors = []
+    count = 0
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
         try:
-            result = StageResult.objects.get(stage=stage, participant=participant)
-            result.score = score 
-            result.save()                               
-        except:
-            StageResult.objects.create(stage=stage, participant=participant, score=score)
+            try:
+                result_data = json.loads(line)
+            except ValueError:
+                raise ValidationError("некорректный JSON")
+            participant_id, score = get_result_score(result_data, participants_ids)
+        except ValidationError as error:
+            if len(errors) < RESULTS_MAX_ERRORS:
+                errors.append(f"строка {number}: {error.detail[0]}")
+            continue
+
+        if errors:
+            # Загрузка все равно будет отклонена, остальные строки только проверяются
+            continue
+
+        # Повтор участника заменяет его прошлый результат
+        scores[participant_id] = score
+        count += 1
+        if len(scores) >= RESULTS_BATCH_SIZE:
+            save_stage_scores(stage, scores)
+            scores = {}
+
+    if errors:
+        raise ValidationError(f"Ошибка при загрузке: {', '.join(errors)}!")
+    if scores:
+        save_stage_scores(stage, scores)
+    return count
+
+MATCH_TIME_FIELDS = ['scheduled_start', 'actual_start', 'actual_end']
+MATCH_UPDATE_FIELDS = MATCH_TIME_FIELDS + ['participant1_score', 'participant2_score', 'winner', 'status']
+
+def get_updated_matches(tournament, matches_data, standings_changes):
+    """
+    Загружает все матчи из matches_data одним запросом и применяет к ним изменения без сохранения.
+    Старый и новый результат матча передаются в standings_changes.
+    Ошибки всех строк собираются в одну ValidationError, поэтому до записи в базу доходит только корректный запрос.
+    """
+    ids = [match_data.get("id") for match_data in matches_data if isinstance(match_data.get("id"), int)]
+    matches = Match.objects.select_for_update(of=('self',)).select_related('stage').filter(stage__tournament=tournament).in_bulk(ids)
+
+    errors = []
+    for match_data in matches_data:
+        match = matches.get(match_data.get("id"))
+        if not match:
+            errors.append(f"матч {match_data.get('id')} не найден")
+            continue
+
+        times = {}
+        for field in MATCH_TIME_FIELDS:
+            value = match_data.get(field, getattr(match, field))
+            try:
+                times[field] = Match._meta.get_field(field).to_python(value)
+            except DjangoValidationError:
+                errors.append(f"некорректная дата {field} матча {match.id}")
+
+        participant_1_score = match_data.get("participant_1_score", None)
+        participant_2_score = match_data.get("participant_2_score", None)
+        has_result = participant_1_score is not None or participant_2_score is not None
+        if has_result and not all(isinstance(score, int) and not isinstance(score, bool) for score in (participant_1_score, participant_2_score)):
+            errors.append(f"некорректный счет матча {match.id}")
+        if errors:
+            continue
+
+        # Старый результат матча вычитается из турнирной таблицы, новый добавляется после изменения
+        standings_changes.add_match(match, match.stage.group, sign=-1)
+        for field, value in times.items():
+            setattr(match, field, value)
+        if has_result:
+            winner_id = None
+            if participant_1_score > participant_2_score:
+                winner_id = match.participant1_id
+            elif participant_1_score < participant_2_score:
+                winner_id = match.participant2_id
+
+            match.winner_id = winner_id
+            match.participant1_score = participant_1_score
+            match.participant2_score = participant_2_score
+            match.status = 2
+        standings_changes.add_match(match, match.stage.group)
+
+    if errors:
+        raise ValidationError(f"Ошибка при обновлении: {', '.join(errors)}!")
+    return list(matches.values())
+
+def place_participant(match, participant_id):
+    if not match.participant1_id:
+        match.participant1_id = participant_id
+    elif not match.participant2_id:
+        match.participant2_id = participant_id
+
+def advance_stage_matches(matches, bracket):
+    """
+    Переводит победителей матчей этапа в следующие матчи,
+    а в Double Elimination и проигравших в матчи нижней сетки.
+    Следующие матчи блокируются и сохраняются одним bulk_update
+    """
+    next_matches_ids = {match.next_match_id for match in matches}
+    if bracket == 1:
+        next_matches_ids.update(match.next_lose_match_id for match in matches)
+    next_matches_ids.discard(None)
+    next_matches = Match.objects.select_for_update().in_bulk(next_matches_ids)
+
+    for match in matches:
+        if match.next_match_id:
+            place_participant(next_matches[match.next_match_id], match.winner_id)
+        if bracket == 1 and match.next_lose_match_id:  # Double elimination logic
+            loser_id = match.participant2_id if match.participant1_id == match.winner_id else match.participant1_id
+            place_participant(next_matches[match.next_lose_match_id], loser_id)
+
+    Match.objects.bulk_update(next_matches.values(), ['participant1', 'participant2'])
+
+
+def get_stages_counts(tournament):
+    """Количество этапов, количество этапов групповой стадии и закончилась ли групповая стадия"""
+    stages_count = TournamentStage.objects.filter(tournament=tournament).count()
+    group_stages_count = tournament.group_stages_count()
+    group_stage_ended = ((tournament.tournament_type == 1) and (stages_count > group_stages_count) or tournament.tournament_type == 0)
+    return stages_count, group_stages_count, group_stage_ended
+
+
+def check_stage_matches_ended(tournament, matches, group_stage_ended):
+    # Групповую стадию и Leaderboard можно завершить с несыгранными матчами
+    if group_stage_ended and tournament.bracket != 4 and not all(match.status == 2 for match in matches):
+        raise ValidationError("Не все матчи этапа завершены!")
+
+
+@transaction.atomic
+def end_tournament_stage(tournament, active_stage):
+    """Завершает этап турнира и возвращает сообщение для ответа. Используется в EndTournamentStage и в задаче celery"""
+    stages_count, group_stages_count, group_stage_ended = get_stages_counts(tournament)
+
+    # Этап и его матчи блокируются до конца транзакции, чтобы этап не завершили дважды
+    active_stage = TournamentStage.objects.select_for_update().get(id=active_stage.id)
+    matches = list(Match.objects.select_for_update().filter(stage=active_stage).order_by('id'))
+    check_stage_matches_ended(tournament, matches, group_stage_ended)
+
+    if not active_stage.ended:
+        set_stage_scores(active_stage, matches, tournament)
+
+        if group_stage_ended:
+            if tournament.bracket in [0, 1]:
+                # Proceed to next stage
+                advance_stage_matches(matches, tournament.bracket)
+            # Пропускаем эти сетки так как их уже обработали выше
+            # elif tournament.bracket in [2, 4]:                                                        
+            #     pass
+            elif tournament.bracket == 3:                    
+                # Swiss or other multi-round bracket logic                                                                
+                should_create_next_round = False
+                if tournament.tournament_type == 0:
+                    should_create_next_round = tournament.rounds_count > stages_count
+                else: 
+                    should_create_next_round = (tournament.active_stage_position != group_stages_count + tournament.final_stages_count())
+
+                if should_create_next_round:
+                    new_stage = TournamentStage.objects.create(
+                        name=f"Этап {active_stage.position - group_stages_count + 1}",
+                        tournament=tournament,
+                        position=active_stage.position+1
+                    )
+                    create_new_swiss_round(new_stage, tournament)                                
+
+        tournament.active_stage_position += 1
+
+    active_stage.ended = True
+    active_stage.save()
+
+    # Если групповой этап окончен создаем финальный
+    if tournament.tournament_type == 1 and tournament.all_stages_ended() and stages_count == group_stages_count:
+        tournament.set_qualified_participants()
+        qualified_participants = tournament.get_qualified_participants()
+        # print(qualified_participants)
+        if tournament.bracket == 0:
+            create_single_elimination_bracket(tournament, [], list(qualified_participants))
+        elif tournament.bracket == 1:
+            create_double_elimination_bracket(tournament, [], list(qualified_participants)) 
+        elif tournament.bracket == 2: 
+            create_round_robin_bracket(tournament, qualified_participants)
+        elif tournament.bracket == 3: 
+            create_swiss_bracket(tournament, [], list(qualified_participants))
+        elif tournament.bracket == 4: 
+            create_leaderboard_bracket(tournament)
+
+    # Если турнир окончен
+    if not tournament.has_next_stage(active_stage):
+        if tournament.bracket == 0:  # Single elimination
+            assign_final_positions_single_elimination(tournament)
+        elif tournament.bracket == 1:  # Double elimination
+            assign_final_positions_double_elimination(tournament)
+        elif tournament.bracket == 4: # Leaderboard
+            assign_final_positions_leaderboard(tournament)
+        else: # Swiss, Round Robin
+            assign_final_positions(tournament)
+
+        if tournament.tournament_type == 1:
+            assign_final_positions_group_stage(tournament)
+
+        return "Турнир завершен!"
+
+    tournament.save()
+    return "Этап турнира завершен!"
+
+
+PRICE_INTERVALS = 20
+
+def get_price_bucket(field, min_price, max_price):
+    """Номер интервала цены: floor((цена - min) * PRICE_INTERVALS / (max - min)), максимальная цена попадает в последний интервал"""
+    if max_price == min_price:
+        return Value(0)
+    position = ExpressionWrapper((F(field) - min_price) * float(PRICE_INTERVALS) / (max_price - min_price), output_field=FloatField())
+    return Least(Floor(position), Value(PRICE_INTERVALS - 1), output_field=FloatField())
+
+def get_price_intervals(min_price, max_price, counts):
+    interval_size = (max_price - min_price) / PRICE_INTERVALS
+    return [
+        {
+            "start_price": min_price + i * interval_size,
+            "end_price": min_price + (i + 1) * interval_size,
+            "count": counts[i],
+        }
+        for i in range(PRICE_INTERVALS)
+    ]
+
+def get_prices_histogram(tournaments):
+    """
+    Количество турниров по интервалам призового фонда и цены участия.
+    Границы считаются одним aggregate, обе гистограммы - одним запросом с группировкой по номерам интервалов
+    """
+    limits = tournaments.aggregate(
+        min_prize=Min('prize_pool'), max_prize=Max('prize_pool'),
+        min_enter=Min('enter_price'), max_enter=Max('enter_price'),
+    )
+    min_prize, max_prize = limits['min_prize'] or 0, limits['max_prize'] or 0
+    min_enter, max_enter = limits['min_enter'] or 0, limits['max_enter'] or 0
+
+    prize_counts = Counter()
+    enter_counts = Counter()
+    if limits['max_prize'] is not None:
+        buckets = (
+            tournaments.order_by()
+            .annotate(
+                prize_bucket=get_price_bucket('prize_pool', min_prize, max_prize),
+                enter_bucket=get_price_bucket('enter_price', min_enter, max_enter),
+            )
+            .values('prize_bucket', 'enter_bucket')
+            .annotate(count=Count('id'))
+        )
+        for bucket in buckets:
+            prize_counts[int(bucket['prize_bucket'])] += bucket['count']
+            enter_counts[int(bucket['enter_bucket'])] += bucket['count']
+
+    return {
+        'prize_pool': get_price_intervals(min_prize, max_prize, prize_counts),
+        'enter_price': get_price_intervals(min_enter, max_enter, enter_counts),
+    }
+
 
 def print_tournament_bracket(tournament_id):
     try:
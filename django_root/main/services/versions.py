@@ -0,0 +1,115 @@
+import json
+from functools import wraps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import parse_etags
+from main.all_models.match import AmateurMatch
+from main.all_models.tournament import Tournament
+from main.services.redis import PricesHistogramCache, TournamentDetailCache
+
+# У турнира и любительского матча есть поле version, которое увеличивается при каждом изменении через API.
+# По версии строятся ETag и ключи кеша, поэтому ответ 304 и чтение из кеша не требуют сериализации.
+
+
+def get_tournament_cache():
+    """Кеш готового JSON турнира или None, если он выключен в настройках"""
+    if not settings.TOURNAMENT_DETAIL_REDIS_CACHE:
+        return None
+    from main.apps import redis_instance
+    return TournamentDetailCache(redis_instance, settings.TOURNAMENT_DETAIL_CACHE_TIMEOUT)
+
+
+def get_prices_cache():
+    """Кеш гистограмм цен турниров или None, если он выключен в настройках"""
+    if not settings.TOURNAMENT_PRICES_REDIS_CACHE:
+        return None
+    from main.apps import redis_instance
+    return PricesHistogramCache(redis_instance, settings.TOURNAMENT_PRICES_CACHE_TIMEOUT)
+
+
+# Поля, от которых зависят гистограммы цен: сами цены и поля TournamentFilter
+PRICES_FIELDS = ['prize_pool', 'enter_price', 'name', 'sport_id', 'start']
+
+def get_prices_state(tournament):
+    return [getattr(tournament, field) for field in PRICES_FIELDS]
+
+
+def bump_prices_version():
+    """Сбрасывает кеш гистограмм цен после коммита транзакции"""
+    cache = get_prices_cache()
+    if cache:
+        transaction.on_commit(cache.bump_version)
+
+
+def bump_version(model, object_id):
+    try:
+        object_id = int(object_id)
+    except (TypeError, ValueError):
+        return
+    model.objects.filter(id=object_id).update(version=F('version') + 1)
+
+
+def bump_versions(queryset):
+    """Увеличивает версию всех объектов queryset одним запросом"""
+    queryset.update(version=F('version') + 1)
+
+
+def bump_tournament_version(tournament_id):
+    bump_version(Tournament, tournament_id)
+
+
+def bump_match_version(match_id):
+    bump_version(AmateurMatch, match_id)
+
+
+def get_request_object_id(request, kwargs, body_field):
+    if kwargs.get('id'):
+        return kwargs['id']
+    try:
+        return json.loads(request.body).get(body_field, None)
+    except:
+        return None
+
+
+def bumps_version(model, body_field):
+    """
+    Декоратор изменяющих методов APIView: после успешного (2xx) ответа увеличивает версию объекта.
+    id берется из url (id) или из поля body_field тела запроса.
+    Ответ с ошибкой не должен ничего менять: view, которые пишут в БД до проверок, откатывают транзакцию
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            response = method(view, request, *args, **kwargs)
+            if 200 <= response.status_code < 300:
+                bump_version(model, get_request_object_id(request, kwargs, body_field))
+            return response
+        return wrapper
+    return decorator
+
+
+bumps_tournament_version = bumps_version(Tournament, 'tournament')
+bumps_match_version = bumps_version(AmateurMatch, 'match')
+
+
+def get_etag(*parts):
+    return '"{}"'.format('-'.join(str(part) for part in parts))
+
+
+def get_tournament_etag(tournament, prefix='tournament'):
+    """ETag турнира. is_registration_available меняется со временем без изменения версии, поэтому входит в ETag"""
+    registration_available = bool(tournament.start) and timezone.now() < tournament.get_registration_end()
+    return get_etag(prefix, tournament.id, tournament.version, int(registration_available))
+
+
+def get_not_modified_response(request, etag):
+    """Ответ 304, если клиент передал в If-None-Match текущий ETag"""
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in etags or '*' in etags:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    return None
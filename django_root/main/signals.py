@@ -0,0 +1,108 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from main.all_models.match import AmateurMatch
+from main.all_models.sport import Sport
+from main.all_models.team import Team
+from main.all_models.tournament import Participant, Tournament
+from main.models import User
+from kombu.exceptions import OperationalError
+from main.services.search_index import get_model_index
+from main.services.versions import bump_tournament_version, bump_versions
+
+logger = logging.getLogger(__name__)
+
+
+def queue_search_document_update(name, object_id):
+    """Ставит обновление документа в очередь celery. Недоступный брокер не должен ломать уже закоммиченный запрос"""
+    from main.tasks import update_search_index_task
+    try:
+        update_search_index_task.delay(name, [object_id])
+    except OperationalError as error:
+        logger.warning('Не удалось поставить обновление поискового индекса %s для %s: %s', name, object_id, error)
+
+
+@receiver([post_save, post_delete], sender=Tournament)
+@receiver([post_save, post_delete], sender=AmateurMatch)
+@receiver([post_save, post_delete], sender=Team)
+@receiver([post_save, post_delete], sender=User)
+def update_search_document(sender, instance, update_fields=None, **kwargs):
+    """Обновляет документ в поисковом индексе после коммита. Изменения через update()/bulk_update() сюда не попадают"""
+    if not settings.SEARCH_INDEXING:
+        return
+    index = get_model_index(sender)
+    # Сохранение только неиндексируемых полей (например, last_login при входе) документ не меняет
+    if update_fields is not None and not index.model_fields & set(update_fields):
+        return
+    # После удаления у instance не будет pk, поэтому запоминаем сразу
+    name, object_id = index.name, instance.pk
+    transaction.on_commit(lambda: queue_search_document_update(name, object_id))
+
+
+# Ответы турнира и любительского матча включают участников, команды, профили пользователей и вид спорта.
+# Они меняются и вне API турнира (профиль, админка), поэтому здесь тоже увеличивается версия для ETag и кеша
+
+# Поля пользователя, которые входят в ответы турниров и матчей (UserSerializer, AmateurMatchUserSerializer)
+USER_RESPONSE_FIELDS = {
+    'email', 'avatar', 'first_name', 'surname', 'role', 'degree', 'rating', 'google', 'phone', 'active_subscription', 'date_payment',
+}
+
+
+def get_teams_tournaments(team_ids):
+    return Tournament.objects.filter(
+        Q(id__in=Participant.objects.filter(team_id__in=team_ids).values('tournament_id'))
+        | Q(id__in=Tournament.teams_requests.through.objects.filter(team_id__in=team_ids).values('tournament_id'))
+    )
+
+
+@receiver([post_save, post_delete], sender=Participant)
+def bump_participant_tournament(sender, instance, **kwargs):
+    bump_tournament_version(instance.tournament_id)
+
+
+@receiver(post_save, sender=Team)
+@receiver(pre_delete, sender=Team)
+def bump_team_tournaments(sender, instance, **kwargs):
+    bump_versions(get_teams_tournaments([instance.id]))
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def bump_team_members_tournaments(sender, instance, action, reverse, pk_set, **kwargs):
+    # clear обрабатывается до удаления, пока известно, из каких команд удаляются участники
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        team_ids = [instance.id]
+    else:
+        team_ids = pk_set if pk_set is not None else instance.teams.values('id')
+    bump_versions(get_teams_tournaments(team_ids))
+
+
+@receiver(post_save, sender=User)
+@receiver(pre_delete, sender=User)
+def bump_user_versions(sender, instance, update_fields=None, created=False, **kwargs):
+    if created or (update_fields is not None and not USER_RESPONSE_FIELDS & set(update_fields)):
+        return
+    user_teams = Team.objects.filter(members=instance.id).values('id')
+    bump_versions(Tournament.objects.filter(
+        Q(owner_id=instance.id)
+        | Q(id__in=Participant.objects.filter(Q(user_id=instance.id) | Q(team_id__in=user_teams)).values('tournament_id'))
+        | Q(id__in=Tournament.moderators.through.objects.filter(user_id=instance.id).values('tournament_id'))
+        | Q(id__in=Tournament.users_requests.through.objects.filter(user_id=instance.id).values('tournament_id'))
+        | Q(id__in=Tournament.teams_requests.through.objects.filter(team_id__in=user_teams).values('tournament_id'))
+    ))
+    bump_versions(AmateurMatch.objects.filter(
+        Q(owner_id=instance.id)
+        | Q(id__in=AmateurMatch.participants.through.objects.filter(user_id=instance.id).values('amateurmatch_id'))
+        | Q(id__in=AmateurMatch.requests.through.objects.filter(user_id=instance.id).values('amateurmatch_id'))
+    ))
+
+
+@receiver(post_save, sender=Sport)
+def bump_sport_versions(sender, instance, created=False, **kwargs):
+    if not created:
+        bump_versions(Tournament.objects.filter(sport_id=instance.id))
+        bump_versions(AmateurMatch.objects.filter(sport_id=instance.id))
@@ -0,0 +1,36 @@
+from celery import shared_task
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from main.all_models.tournament import StageFinalizationJob
+from main.services.tournament import end_tournament_stage
+from main.services.search_index import update_search_index
+from main.services.versions import bump_tournament_version
+
+
+@shared_task
+def end_tournament_stage_task(job_id):
+    """Завершает этап турнира в фоне и записывает результат в StageFinalizationJob"""
+    job = StageFinalizationJob.objects.select_related('tournament', 'stage').get(id=job_id)
+    job.status = 1
+    job.save(update_fields=['status'])
+
+    try:
+        job.message = end_tournament_stage(job.tournament, job.stage)
+        job.status = 2
+    except ValidationError as error:
+        job.message = str(error.detail[0])
+        job.status = 3
+    except Exception as error:
+        job.message = f'Ошибка при завершении этапа: {str(error)}'
+        job.status = 3
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'message', 'finished_at'])
+    bump_tournament_version(job.tournament_id)
+
+
+@shared_task
+def update_search_index_task(name, ids):
+    """Обновляет документы поискового индекса name для объектов ids"""
+    update_search_index(name, ids)
@@ -0,0 +1,650 @@
+import json
+from datetime import timedelta
+from importlib import import_module
+from django.apps import apps as django_apps
+from unittest import mock
+from django.core import signing
+from django.db import IntegrityError, connection, transaction
+import redis
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
+from main.all_models.tournament import Participant, StageFinalizationJob, StageResult, Tournament, TournamentPhoto, TournamentStage, Match
+from main.all_models.team import Team
+from main.models import User
+from main.all_models.sport import Sport
+from main.services.versions import bump_tournament_version
+from main.services.bracket import PLAN_SIGNING_SALT, BracketPlan, ParticipantsSeeding, build_double_elimination, build_single_elimination, get_bracket_topology, get_round_robin_rounds, pair_swiss_participants, plan_double_elimination
+from main.services.tournament import check_stage_matches_ended, create_double_elimination_bracket, create_new_swiss_round, create_leaderboard_bracket, create_round_robin_bracket, create_round_robin_bracket_2step, create_single_elimination_bracket, create_swiss_bracket, save_stage_scores, assign_final_positions, assign_final_positions_leaderboard
+
+
+class BracketsTests(TestCase):
+    def setUp(self):
+        self.sport = Sport.objects.create(name='Футбол')
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+
+    def create_tournament(self, participants_count, bracket=0, tournament_type=0):
+        tournament = Tournament.objects.create(
+            name='Test Tournament',
+            owner=self.owner,
+            sport=self.sport,
+            enter_price=0,
+            prize_pool=1000,
+            max_participants=128,
+            bracket=bracket,
+            tournament_type=tournament_type,
+            win_points=3,
+            draw_points=1,
+            rounds_count=3,
+            mathces_count=1,
+        )
+        users = User.objects.bulk_create([
+            User(username=f'{tournament.id}_{i}', email=f'{tournament.id}_{i}@mail.ru') for i in range(participants_count)
+        ])
+        Participant.objects.bulk_create([Participant(user=user, tournament=tournament) for user in users])
+        return tournament
+
+    def get_participants(self, tournament):
+        return list(Participant.objects.filter(tournament=tournament).order_by('id'))
+
+    def count_queries(self, create_bracket, participants_count, **kwargs):
+        tournament = self.create_tournament(participants_count, **kwargs)
+        participants = self.get_participants(tournament)
+        with CaptureQueriesContext(connection) as context:
+            create_bracket(tournament, [], participants)
+        return len(context.captured_queries)
+
+    def test_single_elimination_structure(self):
+        tournament = self.create_tournament(12)
+        create_single_elimination_bracket(tournament, [], self.get_participants(tournament))
+
+        stages = list(TournamentStage.objects.filter(tournament=tournament).order_by('position'))
+        self.assertEqual([stage.name for stage in stages], ["Этап 0", "Этап 1", "Полуфинал", "Финал"])
+        self.assertEqual([stage.matches.count() for stage in stages], [4, 4, 2, 1])
+
+        # Каждое свободное место первого раунда занимает победитель предварительного этапа
+        for match in Match.objects.filter(stage=stages[1]):
+            free_slots = [match.participant1, match.participant2].count(None)
+            self.assertEqual(match.next_match_on_win.count(), free_slots)
+        self.assertFalse(Match.objects.filter(stage__tournament=tournament, next_match__isnull=True).exclude(stage=stages[-1]).exists())
+
+    def test_single_elimination_power_of_two(self):
+        tournament = self.create_tournament(8)
+        create_single_elimination_bracket(tournament, [], self.get_participants(tournament))
+
+        stages = TournamentStage.objects.filter(tournament=tournament).order_by('position')
+        self.assertEqual([stage.matches.count() for stage in stages], [4, 2, 1])
+        self.assertFalse(Match.objects.filter(stage=stages[0], participant2__isnull=True).exists())
+
+    def test_single_elimination_queries_count(self):
+        self.assertEqual(
+            self.count_queries(create_single_elimination_bracket, 8),
+            self.count_queries(create_single_elimination_bracket, 64),
+        )
+
+    def test_seeding_from_matches_data(self):
+        tournament = self.create_tournament(8)
+        participants = self.get_participants(tournament)
+        matches_data = [
+            {'participants': [participants[0].user_id, participants[7].user_id]},
+            {'participants': [participants[1].user_id]},
+        ]
+        create_single_elimination_bracket(tournament, matches_data, participants)
+
+        matches = list(Match.objects.filter(stage__tournament=tournament, stage__position=1).order_by('id'))
+        self.assertEqual((matches[0].participant1, matches[0].participant2), (participants[0], participants[7]))
+        self.assertEqual(matches[1].participant1, participants[1])
+        # Участники из matches_data не попадают в другие матчи
+        seated = [p for match in matches for p in (match.participant1, match.participant2)]
+        self.assertEqual(len(seated), len(set(seated)))
+        self.assertNotIn(None, seated)
+
+    def test_seeding_errors(self):
+        tournament = self.create_tournament(4)
+        participants = self.get_participants(tournament)
+        matches_data = [
+            {'participants': [participants[0].user_id, -1]},
+            {'participants': [participants[0].user_id, -2]},
+        ]
+        with self.assertRaises(ValidationError) as context:
+            ParticipantsSeeding(tournament, matches_data, participants, [2, 2])
+        message = str(context.exception.detail[0])
+        self.assertIn('-1, -2', message)
+        self.assertIn(str(participants[0].user_id), message)
+
+        for create_bracket in (create_single_elimination_bracket, create_swiss_bracket):
+            with self.assertRaises(ValidationError):
+                create_bracket(tournament, matches_data, participants)
+        self.assertFalse(TournamentStage.objects.filter(tournament=tournament).exists())
+
+    def test_seeding_respects_topology(self):
+        # 6 участников: 2 матча предварительного этапа, в первом раунде 2 места для посева и 2 для победителей
+        tournament = self.create_tournament(6)
+        participants = self.get_participants(tournament)
+        ids = [participant.user_id for participant in participants]
+        with self.assertRaises(ValidationError) as context:
+            create_single_elimination_bracket(tournament, [{}, {}, {}, {'participants': ids[:2]}], participants)
+        self.assertIn('4 (мест: 0)', str(context.exception.detail[0]))
+
+        with self.assertRaises(ValidationError):
+            create_single_elimination_bracket(tournament, [{}] * 5, participants)
+
+    def test_topology_cache(self):
+        tournament = self.create_tournament(24, bracket=1)
+        get_bracket_topology.cache_clear()
+        create_double_elimination_bracket(tournament, [], self.get_participants(tournament))
+        create_double_elimination_bracket(tournament, [], self.get_participants(tournament))
+        self.assertEqual(get_bracket_topology.cache_info().hits, 1)
+
+        topology = get_bracket_topology(1, 24)
+        self.assertEqual(BracketPlan.from_topology(topology).to_topology(), build_double_elimination(24).to_topology())
+        self.assertEqual(
+            Match.objects.filter(stage__tournament=tournament).count(),
+            2 * len(topology['matches'])
+        )
+
+    @override_settings(BRACKET_TOPOLOGY_REDIS_CACHE=True)
+    def test_topology_redis_errors(self):
+        # Недоступный redis или поврежденное значение не мешают построить сетку
+        get_bracket_topology.cache_clear()
+        redis_instance = mock.Mock()
+        redis_instance.get.side_effect = redis.ConnectionError()
+        redis_instance.set.side_effect = redis.ConnectionError()
+        with mock.patch('main.apps.redis_instance', redis_instance):
+            self.assertEqual(get_bracket_topology(0, 8), build_single_elimination(8).to_topology())
+
+        get_bracket_topology.cache_clear()
+        redis_instance = mock.Mock()
+        redis_instance.get.return_value = b'{oops'
+        with mock.patch('main.apps.redis_instance', redis_instance):
+            self.assertEqual(get_bracket_topology(0, 8), build_single_elimination(8).to_topology())
+        redis_instance.set.assert_called_once()
+        get_bracket_topology.cache_clear()
+
+    def assert_plan_is_consistent(self, plan):
+        """Каждый матч получает ровно двух участников: из посева или из предыдущих матчей"""
+        matches = plan.matches()
+        incoming = {id(match): 0 for match in matches}
+        for match in matches:
+            for next_match in (match.next_match, match.next_lose_match):
+                if next_match:
+                    incoming[id(next_match)] += 1
+        for match in matches:
+            seeded = len([p for p in (match.participant1, match.participant2) if p])
+            self.assertEqual(seeded + incoming[id(match)], 2)
+
+        positions = [stage.position for stage in plan.stages]
+        self.assertEqual(positions, list(range(1, len(positions) + 1)))
+        # Матч может вести только в более поздний этап
+        for match in matches:
+            for next_match in (match.next_match, match.next_lose_match):
+                if next_match:
+                    self.assertGreater(next_match.stage.position, match.stage.position)
+
+    def test_double_elimination_plan(self):
+        tournament = Tournament(is_team_tournament=False)
+        for participants_count in range(2, 41):
+            participants = [Participant(user_id=i) for i in range(participants_count)]
+            plan = plan_double_elimination(tournament, [], participants)
+            self.assert_plan_is_consistent(plan)
+            self.assertEqual(plan.stages[-1].name, "Финал")
+            # Финал играется один раз, поэтому всего матчей 2 * (n - 1)
+            self.assertEqual(len(plan.matches()), 2 * participants_count - 2)
+
+    def test_double_elimination_queries_count(self):
+        self.assertEqual(
+            self.count_queries(create_double_elimination_bracket, 8),
+            self.count_queries(create_double_elimination_bracket, 40),
+        )
+
+    def test_round_robin_rounds(self):
+        for participants_count in range(2, 17):
+            rounds = get_round_robin_rounds(range(participants_count))
+            self.assertEqual(len(rounds), participants_count - 1 + participants_count % 2)
+
+            played_pairs = set()
+            for pairs in rounds:
+                players = [player for pair in pairs for player in pair]
+                self.assertEqual(len(players), len(set(players)))
+                played_pairs.update(frozenset(pair) for pair in pairs)
+            self.assertEqual(len(played_pairs), participants_count * (participants_count - 1) // 2)
+
+    def test_round_robin_2step_groups(self):
+        tournament = self.create_tournament(12, bracket=2, tournament_type=1)
+        tournament.max_participants = 8
+        tournament.participants_in_group = 4
+        tournament.mathces_count = 2
+        create_round_robin_bracket_2step(tournament)
+
+        # 2 группы по 6 участников: 5 туров на круг, 2 круга
+        stages = TournamentStage.objects.filter(tournament=tournament).order_by('position')
+        self.assertEqual([stage.group for stage in stages], [1] * 10 + [2] * 10)
+        self.assertEqual(tournament.group_stages_count(), 20)
+        self.assertEqual(tournament.get_stage_offset(), 20)
+        for stage in stages:
+            self.assertEqual(stage.matches.count(), 3)
+
+    def test_stage_group_backfill(self):
+        # Этапы, созданные до поля group: 2 группы по rounds_count=3 этапа и один этап финала
+        tournament = self.create_tournament(8, bracket=2, tournament_type=1)
+        tournament.max_participants = 8
+        tournament.participants_in_group = 4
+        tournament.save()
+        names = ['Группа 1. Этап 1', 'Группа 1. Этап 2', 'Тур 3', 'Группа 2. Этап 4', 'Тур 5', 'Тур 6', 'Этап 1']
+        TournamentStage.objects.bulk_create([
+            TournamentStage(tournament=tournament, name=name, position=position) for position, name in enumerate(names, start=1)
+        ])
+
+        migration = import_module('main.migrations.0060_tournamentstage_group')
+        migration.fill_stage_group(django_apps, None)
+
+        stages = TournamentStage.objects.filter(tournament=tournament).order_by('position')
+        self.assertEqual([stage.group for stage in stages], [1, 1, 1, 2, 2, 2, None])
+        self.assertEqual(tournament.group_stages_count(), 6)
+        self.assertEqual(tournament.get_stage_offset(), 6)
+
+    def test_qualification_per_group(self):
+        tournament = self.create_tournament(12, bracket=2, tournament_type=1)
+        tournament.max_participants = 8
+        tournament.participants_in_group = 4
+        tournament.final_stage_advance_count = 2
+        create_round_robin_bracket_2step(tournament)
+
+        # Очки участника равны его порядковому номеру, из каждой группы проходят двое последних
+        groups = {}
+        for stage in TournamentStage.objects.filter(tournament=tournament).prefetch_related('matches'):
+            scores = {}
+            for match in stage.matches.all():
+                groups.setdefault(stage.group, set()).update([match.participant1_id, match.participant2_id])
+                scores.update({match.participant1_id: match.participant1_id, match.participant2_id: match.participant2_id})
+            save_stage_scores(stage, scores)
+
+        with self.assertNumQueries(2):
+            tournament.set_qualified_participants()
+
+        expected = {participant_id for group in groups.values() for participant_id in sorted(group)[-2:]}
+        self.assertEqual(set(tournament.get_qualified_participants().values_list('id', flat=True)), expected)
+
+    def test_round_robin_queries_count(self):
+        self.assertEqual(
+            self.count_queries(lambda tournament, data, participants: create_round_robin_bracket(tournament, participants), 4),
+            self.count_queries(lambda tournament, data, participants: create_round_robin_bracket(tournament, participants), 12),
+        )
+
+    def test_swiss_pairing_without_rematches(self):
+        for participants_count in [7, 8]:
+            participants = [Participant(id=i) for i in range(participants_count)]
+            played_pairs = set()
+            # За participants_count - 1 туров каждый должен сыграть с каждым ровно один раз
+            for _ in range(participants_count - 1 if participants_count % 2 == 0 else participants_count):
+                pairs = pair_swiss_participants(participants, played_pairs)
+                self.assertEqual(len(pairs), participants_count // 2)
+                for participant1, participant2 in pairs:
+                    pair = frozenset((participant1.id, participant2.id))
+                    self.assertNotIn(pair, played_pairs)
+                    played_pairs.add(pair)
+
+    def test_stage_scores_upsert(self):
+        tournament = self.create_tournament(3, bracket=4)
+        stage = TournamentStage.objects.create(name="Этап 1", tournament=tournament, position=1)
+        participant1, participant2, participant3 = self.get_participants(tournament)
+
+        with CaptureQueriesContext(connection) as first_context:
+            save_stage_scores(stage, {participant1.id: 3, participant2.id: 1})
+        with CaptureQueriesContext(connection) as second_context:
+            save_stage_scores(stage, {participant1.id: 5, participant3.id: 2, None: 1})
+        self.assertEqual(len(first_context.captured_queries), len(second_context.captured_queries))
+
+        scores = dict(StageResult.objects.filter(stage=stage).values_list('participant_id', 'score'))
+        self.assertEqual(scores, {participant1.id: 5, participant2.id: 1, participant3.id: 2})
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            StageResult.objects.create(stage=stage, participant=participant1, score=1)
+
+    def test_final_positions_with_score_difference(self):
+        tournament = self.create_tournament(4, bracket=2)
+        stage = TournamentStage.objects.create(name="Этап 1", tournament=tournament, position=1)
+        participant1, participant2, participant3, participant4 = self.get_participants(tournament)
+        save_stage_scores(stage, {participant1.id: 3, participant2.id: 3, participant3.id: 1, participant4.id: 1})
+        Match.objects.bulk_create([
+            Match(stage=stage, participant1=participant1, participant2=participant3, participant1_score=5, participant2_score=0, status=2),
+            Match(stage=stage, participant1=participant4, participant2=participant2, participant1_score=0, participant2_score=1, status=2),
+        ])
+
+        # Без учета разницы участники с равными очками делят место
+        assign_final_positions(tournament)
+        places = dict(Participant.objects.filter(tournament=tournament).values_list('id', 'place'))
+        self.assertEqual([places[p.id] for p in (participant1, participant2, participant3, participant4)], [1, 1, 3, 3])
+
+        tournament.check_score_difference_on_draw = True
+        assign_final_positions(tournament)
+        places = dict(Participant.objects.filter(tournament=tournament).values_list('id', 'place'))
+        self.assertEqual([places[p.id] for p in (participant1, participant2, participant3, participant4)], [1, 2, 4, 3])
+        self.assertEqual(Participant.objects.get(id=participant1.id).score, 3)
+
+    def test_leaderboard_positions_queries_count(self):
+        counts = []
+        for participants_count in [5, 50]:
+            tournament = self.create_tournament(participants_count, bracket=4)
+            create_leaderboard_bracket(tournament)
+            participants = self.get_participants(tournament)
+            for stage in TournamentStage.objects.filter(tournament=tournament):
+                save_stage_scores(stage, {participant.id: index % 4 for index, participant in enumerate(participants)})
+
+            with CaptureQueriesContext(connection) as context:
+                assign_final_positions_leaderboard(tournament)
+            counts.append(len(context.captured_queries))
+
+            best = Participant.objects.filter(tournament=tournament).order_by('place').first()
+            self.assertEqual((best.place, best.score), (1, 3 * tournament.rounds_count))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_swiss_round_queries_count(self):
+        def create_swiss_round(tournament, data, participants):
+            stage = TournamentStage.objects.create(name="Этап 1", tournament=tournament, position=1)
+            create_new_swiss_round(stage, tournament)
+
+        self.assertEqual(
+            self.count_queries(create_swiss_round, 8, bracket=3),
+            self.count_queries(create_swiss_round, 64, bracket=3),
+        )
+
+
+class BracketPreviewTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=Sport.objects.create(name='Футбол'),
+            enter_price=0, prize_pool=1000, max_participants=8, bracket=1,
+        )
+        users = User.objects.bulk_create([User(username=f'user_{i}', email=f'user_{i}@mail.ru') for i in range(6)])
+        Participant.objects.bulk_create([Participant(user=user, tournament=self.tournament) for user in users])
+        self.client.force_authenticate(self.owner)
+
+    def post(self, name, data):
+        return self.client.post(reverse(name, args=[self.tournament.id]), json.dumps(data), content_type='application/json')
+
+    def test_preview_and_commit(self):
+        first_user_id = Participant.objects.filter(tournament=self.tournament).order_by('id')[0].user_id
+        with CaptureQueriesContext(connection) as context:
+            response = self.post('create_tournament_bracket', {'preview': True, 'matches': [{'participants': [first_user_id]}]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any(query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) for query in context.captured_queries))
+        self.assertFalse(TournamentStage.objects.filter(tournament=self.tournament).exists())
+
+        preview = response.data['bracket_stages']
+        self.assertEqual(preview[0]['matches'][0]['participant1']['user']['id'], first_user_id)
+        self.assertEqual(sum(len(stage['matches']) for stage in preview), 10)
+
+        response = self.post('commit_tournament_bracket', {'plan_token': response.data['plan_token']})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [stage['name'] for stage in response.data['bracket_stages']],
+            [stage['name'] for stage in preview]
+        )
+        first_match = Match.objects.filter(stage__tournament=self.tournament).order_by('id').first()
+        self.assertEqual(first_match.participant1.user_id, first_user_id)
+        self.assertEqual(Match.objects.filter(stage__tournament=self.tournament).count(), 10)
+
+        # Поверх сохраненной сетки предпросмотр уже не сохраняется
+        plan_token = self.post('create_tournament_bracket', {'preview': True}).data['plan_token']
+        response = self.post('commit_tournament_bracket', {'plan_token': plan_token})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def commit_plan(self, plan):
+        plan_token = signing.dumps({'tournament': self.tournament.id, 'plan': plan}, salt=PLAN_SIGNING_SALT, compress=True)
+        response = self.post('commit_tournament_bracket', {'plan_token': plan_token})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TournamentStage.objects.filter(tournament=self.tournament).exists())
+        return response
+
+    def test_commit_validation(self):
+        preview = self.post('create_tournament_bracket', {'preview': True}).data
+
+        # Сетку, которую не строил сервер, сохранить нельзя
+        response = self.post('commit_tournament_bracket', {'plan_token': preview['plan_token'][:-2]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post('commit_tournament_bracket', {'plan': preview['plan']})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        plan = json.loads(json.dumps(preview['plan']))
+        plan['matches'][0][1] = -1
+        self.commit_plan(plan)
+
+        # Другая форма сетки
+        plan = json.loads(json.dumps(preview['plan']))
+        plan['matches'][-1][4] = 0
+        self.commit_plan(plan)
+        plan = json.loads(json.dumps(preview['plan']))
+        plan['matches'].pop()
+        self.commit_plan(plan)
+
+        # Один участник в нескольких матчах и участник вне мест посева
+        plan = json.loads(json.dumps(preview['plan']))
+        plan['matches'][1][1] = plan['matches'][0][1]
+        self.assertIn('нескольких матчах', self.commit_plan(plan).data['message'])
+        plan = json.loads(json.dumps(preview['plan']))
+        plan['matches'][-1][1] = plan['matches'][0][1]
+        plan['matches'][0][1] = None
+        self.assertIn('местах посева', self.commit_plan(plan).data['message'])
+
+    def test_commit_participants_changed(self):
+        plan_token = self.post('create_tournament_bracket', {'preview': True}).data['plan_token']
+        Participant.objects.filter(tournament=self.tournament).order_by('id').last().delete()
+        response = self.post('commit_tournament_bracket', {'plan_token': plan_token})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_commit_permissions(self):
+        plan_token = self.post('create_tournament_bracket', {'preview': True}).data['plan_token']
+        self.client.force_authenticate(User.objects.create(username='stranger', email='stranger@mail.ru'))
+        response = self.post('commit_tournament_bracket', {'plan_token': plan_token})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        for data in [{'preview': True}, {}]:
+            response = self.post('create_tournament_bracket', data)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(TournamentStage.objects.filter(tournament=self.tournament).exists())
+
+    def test_create_twice(self):
+        response = self.post('create_tournament_bracket', {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        stages_count = TournamentStage.objects.filter(tournament=self.tournament).count()
+
+        response = self.post('create_tournament_bracket', {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(TournamentStage.objects.filter(tournament=self.tournament).count(), stages_count)
+
+
+class EndStageTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.sport = Sport.objects.create(name='Футбол')
+        self.client.force_authenticate(self.owner)
+
+    def create_played_stage(self, participants_count, bracket):
+        tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=self.sport, enter_price=0, prize_pool=1000,
+            max_participants=128, bracket=bracket, tournament_type=0, win_points=3, draw_points=1,
+        )
+        users = User.objects.bulk_create([
+            User(username=f'{tournament.id}_{i}', email=f'{tournament.id}_{i}@mail.ru') for i in range(participants_count)
+        ])
+        Participant.objects.bulk_create([Participant(user=user, tournament=tournament) for user in users])
+        participants = list(Participant.objects.filter(tournament=tournament).order_by('id'))
+        if bracket == 0:
+            create_single_elimination_bracket(tournament, [], participants)
+        else:
+            create_double_elimination_bracket(tournament, [], participants)
+
+        stage = TournamentStage.objects.get(tournament=tournament, position=1)
+        matches = list(stage.matches.all())
+        for match in matches:
+            match.status = 2
+            match.participant1_score = 2
+            match.participant2_score = 1
+            match.winner_id = match.participant1_id
+        Match.objects.bulk_update(matches, ['status', 'participant1_score', 'participant2_score', 'winner'])
+        return tournament, stage
+
+    def end_stage(self, tournament):
+        return self.client.post(reverse('end_tournament_stage', args=[tournament.id]), json.dumps({}), content_type='application/json')
+
+    def test_end_stage_advances_participants(self):
+        tournament, stage = self.create_played_stage(8, bracket=1)
+        response = self.end_stage(tournament)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        winners = {match.winner_id for match in stage.matches.all()}
+        losers = {match.participant2_id for match in stage.matches.all()}
+        next_upper = Match.objects.filter(stage__tournament=tournament, stage__name="Верхняя сетка - Этап 2")
+        next_lower = Match.objects.filter(stage__tournament=tournament, stage__name="Нижняя сетка - Этап 1")
+        self.assertEqual({p for match in next_upper for p in (match.participant1_id, match.participant2_id)}, winners)
+        self.assertEqual({p for match in next_lower for p in (match.participant1_id, match.participant2_id)}, losers)
+
+        results = StageResult.objects.filter(stage=stage)
+        self.assertEqual({result.participant_id for result in results}, winners)
+        self.assertTrue(all(result.score == 3 for result in results))
+        self.assertTrue(TournamentStage.objects.get(id=stage.id).ended)
+
+    def test_end_stage_queries_count(self):
+        counts = []
+        for participants_count in [8, 64]:
+            tournament, stage = self.create_played_stage(participants_count, bracket=0)
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.end_stage(tournament).status_code, status.HTTP_200_OK)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_tournament_detail_queries_count(self):
+        counts = []
+        for participants_count in [8, 64]:
+            tournament, stage = self.create_played_stage(participants_count, bracket=1)
+            self.end_stage(tournament)
+            Tournament.objects.filter(id=tournament.id).update(start=timezone.now() + timedelta(days=1))
+            users = list(User.objects.filter(participant__tournament=tournament)[:3])
+            team = Team.objects.create(name=f'Команда {participants_count}', sport=self.sport)
+            team.members.add(*users)
+            tournament.moderators.add(*users)
+            tournament.users_requests.add(*users)
+            tournament.teams_requests.add(team)
+            TournamentPhoto.objects.create(tournament=tournament, photo='tournament_photos/photo.jpg')
+
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse('tournament-detail', args=[tournament.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            counts.append(len(context.captured_queries))
+
+            next_matches = [match['next_match'] for stage_data in response.data['stages'] for match in stage_data['matches']]
+            self.assertTrue(any(next_match and next_match['participant1'] for next_match in next_matches))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_flat_bracket(self):
+        counts = []
+        for participants_count in [8, 64]:
+            tournament, stage = self.create_played_stage(participants_count, bracket=1)
+            self.end_stage(tournament)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse('tournament_bracket', args=[tournament.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            counts.append(len(context.captured_queries))
+
+            data = response.data
+            matches_ids = {match['id'] for match in data['matches']}
+            stages_ids = {stage_data['id'] for stage_data in data['stages']}
+            self.assertEqual(len(data['participants']), participants_count)
+            self.assertEqual(len(data['matches']), Match.objects.filter(stage__tournament=tournament).count())
+            for match in data['matches']:
+                self.assertIn(match['stage_id'], stages_ids)
+                self.assertTrue({match['next_match_id'], match['next_lose_match_id']} <= matches_ids | {None})
+                self.assertTrue({match['participant1_id'], match['participant2_id']} <= set(data['participants']) | {None})
+            self.assertEqual({result['stage_id'] for result in data['results']}, {stage.id})
+        self.assertEqual(counts[0], counts[1])
+
+    def update_matches(self, tournament, matches_data):
+        return self.client.patch(reverse('update_tournament', args=[tournament.id]), {'matches': matches_data}, format='json')
+
+    def test_update_matches_queries_count(self):
+        counts = []
+        for participants_count in [8, 64]:
+            tournament, stage = self.create_played_stage(participants_count, bracket=0)
+            stage.matches.update(status=1)
+            matches_data = [
+                {'id': match.id, 'participant_1_score': 0, 'participant_2_score': 1, 'actual_end': '2024-01-02T15:00:00Z'}
+                for match in stage.matches.all()
+            ]
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.update_matches(tournament, matches_data).status_code, status.HTTP_200_OK)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+        matches = list(stage.matches.all())
+        self.assertTrue(all(match.winner_id == match.participant2_id and match.actual_end for match in matches))
+
+    def test_update_matches_validates_whole_payload(self):
+        tournament, stage = self.create_played_stage(8, bracket=0)
+        other_tournament, other_stage = self.create_played_stage(8, bracket=0)
+        first_match, second_match = list(stage.matches.order_by('id'))[:2]
+        response = self.update_matches(tournament, [
+            {'id': first_match.id, 'participant_1_score': 0, 'participant_2_score': 5},
+            {'id': second_match.id, 'participant_1_score': 'много', 'participant_2_score': 1},
+            {'id': other_stage.matches.first().id, 'participant_1_score': 0, 'participant_2_score': 1},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(f'некорректный счет матча {second_match.id}', response.data['message'])
+        self.assertIn(f'матч {other_stage.matches.first().id} не найден', response.data['message'])
+        # Корректная часть запроса тоже не сохраняется
+        self.assertEqual(Match.objects.get(id=first_match.id).participant2_score, 1)
+
+    def test_end_stage_async_job(self):
+        tournament, stage = self.create_played_stage(8, bracket=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('end_tournament_stage', args=[tournament.id]), json.dumps({'async': True}), content_type='application/json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        response = self.client.get(reverse('stage_job_status', args=[response.data['job_id']]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['job']['status'], 2)
+        self.assertEqual(response.data['job']['message'], 'Этап турнира завершен!')
+        self.assertTrue(TournamentStage.objects.get(id=stage.id).ended)
+
+        # Статус задачи видят только организатор и модераторы
+        job_url = reverse('stage_job_status', args=[response.data['job']['id']])
+        moderator = User.objects.create(username='moderator', email='moderator@mail.ru')
+        tournament.moderators.add(moderator)
+        self.client.force_authenticate(moderator)
+        self.assertEqual(self.client.get(job_url).status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(User.objects.create(username='stranger', email='stranger@mail.ru'))
+        self.assertEqual(self.client.get(job_url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_end_stage_keeps_concurrent_version_bump(self):
+        tournament, stage = self.create_played_stage(8, bracket=0)
+        bumped_versions = []
+
+        def check_and_bump(*args):
+            # Пока этап завершается, турнир меняется в другом запросе
+            bump_tournament_version(tournament.id)
+            bumped_versions.append(Tournament.objects.get(id=tournament.id).version)
+            return check_stage_matches_ended(*args)
+
+        with mock.patch('main.services.tournament.check_stage_matches_ended', side_effect=check_and_bump):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse('end_tournament_stage', args=[tournament.id]), json.dumps({'async': True}), content_type='application/json'
+                )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(StageFinalizationJob.objects.get(id=response.data['job_id']).status, 2)
+        # tournament.save() в конце этапа не возвращает старую версию, задача еще раз увеличивает ее
+        self.assertEqual(Tournament.objects.get(id=tournament.id).version, bumped_versions[0] + 1)
+
+    def test_end_stage_async_unfinished_matches(self):
+        tournament, stage = self.create_played_stage(8, bracket=0)
+        stage.matches.filter(id=stage.matches.first().id).update(status=1)
+        response = self.client.post(
+            reverse('end_tournament_stage', args=[tournament.id]), json.dumps({'async': True}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(StageFinalizationJob.objects.exists())
@@ -0,0 +1,309 @@
+import json
+from datetime import timedelta
+from unittest import mock
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from main.all_models.match import AmateurMatch
+from main.all_models.tournament import Match, Participant, Tournament, TournamentStage
+from main.all_models.team import Team
+from main.models import User
+from main.all_models.sport import Sport
+from main.services.tournament import create_single_elimination_bracket
+
+
+class FakeRedis:
+    """Словарь с интерфейсом redis, которого нет в тестовом окружении"""
+
+    def __init__(self):
+        self.data = {}
+        self.timeouts = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        self.timeouts[key] = ex
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+
+
+@override_settings(TOURNAMENT_DETAIL_REDIS_CACHE=True, TOURNAMENT_DETAIL_CACHE_TIMEOUT=600)
+class TournamentDetailCacheTests(APITestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('main.apps.redis_instance', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=Sport.objects.create(name='Футбол'),
+            enter_price=0, prize_pool=1000, max_participants=8, bracket=0, tournament_type=0,
+            start=timezone.now() + timedelta(days=1), register_open_until='1 час',
+        )
+        users = User.objects.bulk_create([User(username=f'user_{i}', email=f'user_{i}@mail.ru') for i in range(4)])
+        Participant.objects.bulk_create([Participant(user=user, tournament=self.tournament) for user in users])
+        create_single_elimination_bracket(self.tournament, [], list(Participant.objects.filter(tournament=self.tournament)))
+        self.client.force_authenticate(self.owner)
+
+    def get_detail(self):
+        response = self.client.get(reverse('tournament-detail', args=[self.tournament.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return json.loads(response.content)
+
+    def test_detail_cached_until_change(self):
+        first = self.get_detail()
+        # Читается только версия турнира
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.get_detail(), first)
+        self.assertEqual(len(context.captured_queries), 1)
+
+        # Запись через UpdateTournament увеличивает версию, следующий запрос видит новый счет
+        match = Match.objects.filter(stage__tournament=self.tournament).order_by('id').first()
+        response = self.client.patch(
+            reverse('update_tournament', args=[self.tournament.id]),
+            {'matches': [{'id': match.id, 'participant_1_score': 2, 'participant_2_score': 0}]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Tournament.objects.get(id=self.tournament.id).version, 1)
+
+        scores = [stage_data['matches'][0]['participant1_score'] for stage_data in self.get_detail()['stages'] if stage_data['matches']]
+        self.assertEqual(scores[0], 2)
+
+    def test_detail_cache_expires_with_registration(self):
+        self.get_detail()
+        timeout = self.redis.timeouts[f'tournament:{self.tournament.id}:detail:0']
+        self.assertTrue(0 < timeout <= 600)
+
+        Tournament.objects.filter(id=self.tournament.id).update(start=timezone.now() + timedelta(minutes=65), version=1)
+        self.get_detail()
+        self.assertLessEqual(self.redis.timeouts[f'tournament:{self.tournament.id}:detail:1'], 300)
+
+    def test_join_bumps_version(self):
+        user = User.objects.create(username='new_user', email='new_user@mail.ru')
+        self.client.force_authenticate(user)
+        self.get_detail()
+        response = self.client.post(reverse('join_tournament'), json.dumps({'tournament': self.tournament.id}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Tournament.objects.get(id=self.tournament.id).version, 1)
+
+    def test_error_keeps_version(self):
+        # Ошибка на втором пользователе откатывает добавление первого, версия не меняется
+        user = User.objects.create(username='new_user', email='new_user@mail.ru')
+        response = self.client.post(
+            reverse('add_tournament_participants', args=[self.tournament.id]),
+            json.dumps({'participants': [user.id, 0]}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Participant.objects.filter(tournament=self.tournament, user=user).exists())
+        self.assertEqual(Tournament.objects.get(id=self.tournament.id).version, 0)
+
+
+class ETagTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.sport = Sport.objects.create(name='Футбол')
+        self.tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=self.sport,
+            enter_price=0, prize_pool=1000, max_participants=8, bracket=0, tournament_type=0,
+            start=timezone.now() + timedelta(days=1),
+        )
+        users = User.objects.bulk_create([User(username=f'user_{i}', email=f'user_{i}@mail.ru') for i in range(4)])
+        Participant.objects.bulk_create([Participant(user=user, tournament=self.tournament) for user in users])
+        create_single_elimination_bracket(self.tournament, [], list(Participant.objects.filter(tournament=self.tournament)))
+        self.client.force_authenticate(self.owner)
+
+    def assert_conditional_get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        # Сериализатор не вызывается: только запрос версии
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(context.captured_queries), 1)
+        return etag
+
+    def test_tournament_and_bracket(self):
+        for url in [reverse('tournament-detail', args=[self.tournament.id]), reverse('tournament_bracket', args=[self.tournament.id])]:
+            etag = self.assert_conditional_get(url)
+            self.client.post(reverse('set_tournament_moderators', args=[self.tournament.id]), json.dumps({'users': [self.owner.id]}), content_type='application/json')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_amateur_match(self):
+        match = AmateurMatch.objects.create(
+            name='Test Match', start=timezone.now() + timedelta(days=1), address='123 Test St', owner=self.owner,
+            enter_price=20, sport=self.sport, max_participants=3, auto_accept_participants=True,
+        )
+        url = reverse('amateurmatch-detail', args=[match.id])
+        etag = self.assert_conditional_get(url)
+
+        self.client.force_authenticate(User.objects.get(username='user_0'))
+        response = self.client.post(reverse('join_amateur_match'), json.dumps({'match': match.id}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['participants']), 1)
+
+    def assert_etag_changed(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response['ETag']
+
+    def test_related_changes(self):
+        url = reverse('tournament-detail', args=[self.tournament.id])
+        etag = self.assert_conditional_get(url)
+        user = User.objects.get(username='user_0')
+
+        # Вход пользователя ответ не меняет
+        user.last_login = timezone.now()
+        user.save(update_fields=['last_login'])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        user.avatar = 'avatars/new.png'
+        user.save()
+        etag = self.assert_etag_changed(url, etag)
+
+        self.sport.name = 'Мини-футбол'
+        self.sport.save()
+        etag = self.assert_etag_changed(url, etag)
+
+        team = Team.objects.create(name='Команда')
+        Participant.objects.create(team=team, tournament=self.tournament)
+        etag = self.assert_etag_changed(url, etag)
+        team.members.add(user)
+        etag = self.assert_etag_changed(url, etag)
+        user.teams.clear()
+        etag = self.assert_etag_changed(url, etag)
+
+        # Изменения из админки
+        admin = User.objects.create(username='admin', email='admin@mail.ru', is_staff=True, is_superuser=True)
+        self.client.force_login(admin)
+        self.client.force_authenticate(admin)
+        match = Match.objects.filter(stage__tournament=self.tournament).first()
+        response = self.client.post(reverse('admin:main_match_delete', args=[match.id]), {'post': 'yes'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assert_etag_changed(url, etag)
+
+
+class PricesHistogramTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.football = Sport.objects.create(name='Футбол')
+        self.tennis = Sport.objects.create(name='Теннис')
+        Tournament.objects.bulk_create([
+            Tournament(
+                name=f'Турнир {i}', owner=self.owner, sport=self.football if i % 2 else self.tennis,
+                enter_price=i * 10, prize_pool=1000 + i * 500, max_participants=8, start=timezone.now() + timedelta(days=1),
+            )
+            for i in range(41)
+        ])
+        self.client.force_authenticate(self.owner)
+
+    def get_prices(self, **params):
+        response = self.client.get(reverse('tournament_prices'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_histogram(self):
+        with self.assertNumQueries(2):
+            data = self.get_prices()
+
+        for field, histogram in data.items():
+            self.assertEqual(len(histogram), 20)
+            self.assertEqual(sum(interval['count'] for interval in histogram), 41)
+            for interval in histogram[:-1]:
+                expected = Tournament.objects.filter(**{
+                    f'{field}__gte': interval['start_price'], f'{field}__lt': interval['end_price']
+                }).count()
+                self.assertEqual(interval['count'], expected)
+        self.assertEqual((data['enter_price'][0]['start_price'], data['enter_price'][-1]['end_price']), (0, 400))
+
+        data = self.get_prices(sport=self.football.id)
+        self.assertEqual(sum(interval['count'] for interval in data['prize_pool']), 20)
+
+    @override_settings(TOURNAMENT_PRICES_REDIS_CACHE=True)
+    def test_histogram_cache(self):
+        redis = FakeRedis()
+        with mock.patch('main.apps.redis_instance', redis):
+            first = self.get_prices()
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get_prices(), first)
+
+            # Изменение описания не влияет на цены, кеш остается
+            tournament = Tournament.objects.order_by('id').first()
+            url = reverse('tournament-detail', args=[tournament.id])
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.client.patch(url, {'description': 'Новое описание'}, format='json').status_code, status.HTTP_200_OK)
+            with self.assertNumQueries(0):
+                self.get_prices()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.client.patch(url, {'enter_price': 1000}, format='json').status_code, status.HTTP_200_OK)
+            self.assertEqual(self.get_prices()['enter_price'][-1]['end_price'], 1000)
+
+
+class FacetsTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.football = Sport.objects.create(name='Футбол')
+        self.tennis = Sport.objects.create(name='Теннис')
+        now = timezone.now()
+        AmateurMatch.objects.bulk_create([
+            AmateurMatch(
+                name=f'Матч {i}', owner=self.owner, sport=self.football if i % 3 else self.tennis, address='ул. Абая',
+                city='Алматы' if i % 2 else 'Астана', enter_price=i * 1000, start=now + timedelta(days=i),
+            )
+            for i in range(30)
+        ])
+        self.client.force_authenticate(self.owner)
+
+    def get_facets(self, **params):
+        response = self.client.get(reverse('amateur_match_facets'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['facets']
+
+    def test_facets(self):
+        with self.assertNumQueries(3):
+            facets = self.get_facets()
+
+        self.assertEqual(facets['total'], 30)
+        self.assertEqual({sport['name']: sport['count'] for sport in facets['sport']}, {'Футбол': 20, 'Теннис': 10})
+        self.assertEqual({city['name']: city['count'] for city in facets['city']}, {'Алматы': 15, 'Астана': 15})
+        self.assertEqual([band['count'] for band in facets['price']], [1, 1, 4, 15, 9])
+        self.assertEqual([window['count'] for window in facets['date']], [1, 7, 30])
+
+        facets = self.get_facets(sport=self.tennis.id)
+        self.assertEqual(facets['total'], 10)
+        self.assertEqual([sport['id'] for sport in facets['sport']], [self.tennis.id])
+
+        response = self.client.get(reverse('amateur_match_facets'), {'sport': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_tournament_facets(self):
+        Tournament.objects.create(name='Турнир', owner=self.owner, sport=self.football, enter_price=0, prize_pool=0, city='Алматы', max_participants=8, start=timezone.now())
+        response = self.client.get(reverse('tournament_facets'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        facets = response.data['facets']
+        self.assertEqual((facets['total'], facets['price'][0]['count'], facets['date'][0]['count']), (1, 1, 1))
+
+    @override_settings(FACETS_REDIS_CACHE=True)
+    def test_facets_cache(self):
+        with mock.patch('main.apps.redis_instance', FakeRedis()):
+            first = self.get_facets(city='Алматы')
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get_facets(city='Алматы'), first)
+            self.assertNotEqual(self.get_facets(city='Астана'), first)
@@ -0,0 +1,174 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+from rest_framework import status
+from rest_framework.test import APITestCase
+from main.all_models.match import AmateurMatch
+from main.all_models.tournament import Tournament
+from main.models import User
+from main.all_models.sport import Sport
+from main.all_models.team import Team
+from main.services.search_index import InMemorySearchBackend, get_search_backend
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.sport = Sport.objects.create(name='Футбол')
+        start = timezone.now() + timedelta(days=1)
+        for name in ['Кубок города', 'Летний кубок Алматы', 'Турнир по футболу', 'Кубок']:
+            Tournament.objects.create(name=name, owner=self.owner, sport=self.sport, enter_price=0, prize_pool=100, max_participants=8, start=start)
+        for name, address, city in [('Вечерний матч', 'ул. Абая 1', 'Алматы'), ('Утренний матч', 'пр. Мира 5', 'Астана')]:
+            AmateurMatch.objects.create(name=name, address=address, city=city, owner=self.owner, sport=self.sport, enter_price=0, start=start)
+        self.client.force_authenticate(self.owner)
+
+    def search(self, url_name, value):
+        response = self.client.get(reverse(url_name), {'search': value})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['name'] for item in response.data['results']]
+
+    def test_tournament_search(self):
+        names = self.search('tournament-list', 'кубок')
+        self.assertEqual(set(names), {'Кубок города', 'Летний кубок Алматы', 'Кубок'})
+        # Точное совпадение выше частичного
+        self.assertEqual(names[0], 'Кубок')
+
+        self.assertEqual(self.search('tournament-list', 'кубок алматы'), ['Летний кубок Алматы'])
+        self.assertEqual(self.search('tournament-list', 'хоккей'), [])
+
+    def test_index_follows_updates(self):
+        tournament = Tournament.objects.get(name='Турнир по футболу')
+        tournament.name = 'Хоккейный турнир'
+        tournament.save()
+        self.assertEqual(self.search('tournament-list', 'футбол'), [])
+        self.assertEqual(self.search('tournament-list', 'хоккей'), ['Хоккейный турнир'])
+
+        tournament.delete()
+        self.assertEqual(self.search('tournament-list', 'хоккей'), [])
+
+    def test_match_search(self):
+        self.assertEqual(self.search('amateurmatch-list', 'абая'), ['Вечерний матч'])
+        self.assertEqual(self.search('amateurmatch-list', 'астана матч'), ['Утренний матч'])
+        # Короткие слова ищутся без индекса
+        self.assertEqual(self.search('amateurmatch-list', 'ул'), ['Вечерний матч'])
+
+
+@override_settings(SEARCH_INDEXING=True, SEARCH_BACKEND='main.services.search_index.InMemorySearchBackend')
+class SearchIndexTests(APITestCase):
+    def setUp(self):
+        get_search_backend().indexes.clear()
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru', first_name='Иван', surname='Петров')
+        self.sport = Sport.objects.create(name='Футбол')
+        self.client.force_authenticate(self.owner)
+
+    def create_tournament(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Tournament.objects.create(
+                name=name, owner=self.owner, sport=self.sport, enter_price=0, prize_pool=100,
+                max_participants=8, start=timezone.now() + timedelta(days=1),
+            )
+
+    def search(self, url_name, value):
+        response = self.client.get(reverse(url_name), {'search': value})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item.get('name', item['id']) for item in response.data['results']]
+
+    def test_incremental_indexing(self):
+        tournament = self.create_tournament('Кубок города')
+        self.create_tournament('Летний кубок')
+        self.assertEqual(self.search('tournament-list', 'куб гор'), ['Кубок города'])
+        self.assertEqual(len(self.search('tournament-list', 'футбол')), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            tournament.name = 'Зимний турнир'
+            tournament.save()
+        self.assertEqual(self.search('tournament-list', 'кубок'), ['Летний кубок'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            tournament.delete()
+        self.assertEqual(self.search('tournament-list', 'зимний'), [])
+
+    def test_reindex_command(self):
+        # Без сигналов индекс пустой, команда заполняет его из базы
+        Team.objects.bulk_create([Team(name=f'Команда {i}', sport=self.sport) for i in range(5)])
+        self.assertEqual(self.search('team-list', 'команда'), [])
+
+        out = StringIO()
+        call_command('reindex_search', 'teams', 'users', batch_size=2, stdout=out)
+        self.assertIn('teams: 5', out.getvalue())
+        self.assertEqual(len(self.search('team-list', 'команда')), 5)
+        self.assertEqual(self.search('user-list', 'петров'), [self.owner.id])
+
+    def test_backend_unavailable(self):
+        self.create_tournament('Кубок города')
+        with mock.patch.object(InMemorySearchBackend, 'search', side_effect=ConnectionError):
+            with self.assertLogs('main.services.search_index', 'WARNING'):
+                self.assertEqual(self.search('tournament-list', 'кубок'), ['Кубок города'])
+        # Ошибки в коде не скрываются запасным поиском
+        with mock.patch.object(InMemorySearchBackend, 'search', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                self.search('tournament-list', 'кубок')
+
+    def test_skip_unindexed_fields(self):
+        with mock.patch('main.tasks.update_search_index_task.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.owner.last_login = timezone.now()
+                self.owner.save(update_fields=['last_login'])
+            delay.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.owner.surname = 'Сидоров'
+                self.owner.save(update_fields=['surname'])
+            delay.assert_called_once_with('users', [self.owner.id])
+
+    def test_broker_unavailable(self):
+        # Запрос уже закоммичен, поэтому ошибка брокера только логируется
+        with mock.patch('main.tasks.update_search_index_task.delay', side_effect=OperationalError):
+            with self.assertLogs('main.signals', 'WARNING'):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.owner.surname = 'Сидоров'
+                    self.owner.save(update_fields=['surname'])
+        self.assertEqual(User.objects.get(id=self.owner.id).surname, 'Сидоров')
+
+
+class UserFullnameSearchTests(APITestCase):
+    def setUp(self):
+        names = [('Иван', 'Петров', ''), ('Петр', 'Иванов', ''), ('Алёна', 'Иванова', 'Сергеевна'), ('Мария', 'Сидорова', '')]
+        self.users = [
+            User.objects.create(username=f'user{i}', email=f'user{i}@mail.ru', first_name=first_name, surname=surname, last_name=last_name)
+            for i, (first_name, surname, last_name) in enumerate(names)
+        ]
+        self.client.force_authenticate(self.users[0])
+
+    def search(self, value):
+        response = self.client.get(reverse('user-list'), {'fullname': value})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_search_name_on_save(self):
+        user = self.users[2]
+        self.assertEqual((user.search_name, user.search_surname_name), ('алена иванова сергеевна', 'иванова алена сергеевна'))
+        user.surname = 'Смирнова'
+        user.save(update_fields=['surname'])
+        user.refresh_from_db()
+        self.assertEqual((user.search_name, user.search_surname_name), ('алена смирнова сергеевна', 'смирнова алена сергеевна'))
+
+    def test_prefix_ranking(self):
+        ivan, petr, alena, maria = self.users
+        # Первое слово - начало имени или фамилии, порядок по "фамилия имя"
+        self.assertEqual(self.search('Иван'), [petr.id, alena.id, ivan.id])
+        self.assertEqual(self.search('петр'), [petr.id, ivan.id])
+        self.assertEqual(self.search('с'), [maria.id])
+        self.assertEqual(self.search('иванова ал'), [alena.id])
+        self.assertEqual(self.search('петров и'), [ivan.id])
+        self.assertEqual(self.search('АЛЕНА'), [alena.id])
+        # Сначала ФИО, начинающиеся со всего запроса
+        self.assertEqual(self.search('иван петр'), [ivan.id, petr.id])
+        # Совпадение внутри слова и первое слово по отчеству не считаются
+        self.assertEqual(self.search('ванов'), [])
+        self.assertEqual(self.search('сергеевна'), [])
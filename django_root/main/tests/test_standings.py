@@ -0,0 +1,207 @@
+import json
+from importlib import import_module
+from unittest import mock
+from django.urls import reverse
+from rest_framework import status
+from django.apps import apps as django_apps
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from rest_framework.test import APITestCase
+from main.all_models.tournament import Participant, StageResult, Standing, Tournament, TournamentStage, Match
+from main.models import User
+from main.all_models.sport import Sport
+from main.services.tournament import create_leaderboard_bracket, create_round_robin_bracket, save_stage_scores
+
+
+class StandingsTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=Sport.objects.create(name='Футбол'),
+            enter_price=0, prize_pool=1000, max_participants=8, bracket=2, tournament_type=0,
+            win_points=3, draw_points=1, mathces_count=1,
+        )
+        users = User.objects.bulk_create([User(username=f'user_{i}', email=f'user_{i}@mail.ru') for i in range(4)])
+        Participant.objects.bulk_create([Participant(user=user, tournament=self.tournament) for user in users])
+        create_round_robin_bracket(self.tournament, list(Participant.objects.filter(tournament=self.tournament).order_by('id')))
+        self.client.force_authenticate(self.owner)
+
+    def update_matches(self, matches_data):
+        response = self.client.patch(reverse('update_tournament', args=[self.tournament.id]), {'matches': matches_data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def get_standings(self):
+        response = self.client.get(reverse('tournament_standings', args=[self.tournament.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {row['participant']['user']['id']: row for row in response.data['standings'][0]['rows']}
+
+    def test_standings_follow_results(self):
+        stage = TournamentStage.objects.get(tournament=self.tournament, position=1)
+        first_match, second_match = Match.objects.filter(stage=stage).order_by('id')
+        self.update_matches([
+            {'id': first_match.id, 'participant_1_score': 3, 'participant_2_score': 1},
+            {'id': second_match.id, 'participant_1_score': 2, 'participant_2_score': 2},
+        ])
+
+        standings = self.get_standings()
+        winner = standings[first_match.participant1.user_id]
+        self.assertEqual((winner['wins'], winner['losses'], winner['score_difference'], winner['points']), (1, 0, 2, 0))
+        self.assertEqual(standings[second_match.participant2.user_id]['draws'], 1)
+
+        # Исправленный результат заменяет старый, а не добавляется к нему
+        self.update_matches([{'id': first_match.id, 'participant_1_score': 0, 'participant_2_score': 1}])
+        standings = self.get_standings()
+        self.assertEqual(standings[first_match.participant1.user_id]['wins'], 0)
+        self.assertEqual(standings[first_match.participant1.user_id]['losses'], 1)
+        self.assertEqual(standings[first_match.participant2.user_id]['score_difference'], 1)
+
+        # Очки начисляются при завершении этапа
+        response = self.client.post(reverse('end_tournament_stage', args=[self.tournament.id]), json.dumps({}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        standings = self.get_standings()
+        self.assertEqual(standings[first_match.participant2.user_id]['points'], 3)
+        self.assertEqual(standings[second_match.participant1.user_id]['points'], 1)
+        self.assertEqual(list(standings.values())[0]['place'], 1)
+        self.assertEqual(Participant.objects.get(id=first_match.participant2_id).score, 3)
+        self.assertEqual(Standing.objects.filter(tournament=self.tournament).count(), 4)
+
+    def test_group_backfill_rebuilds_standings(self):
+        # Этапы групп без group: очки групповой стадии попали в общую таблицу и в final_step_score
+        tournament = Tournament.objects.create(
+            name='Two Step', owner=self.owner, sport=self.tournament.sport, enter_price=0, prize_pool=1000,
+            max_participants=4, participants_in_group=2, bracket=2, tournament_type=1,
+        )
+        first, second = Participant.objects.bulk_create([Participant(tournament=tournament) for _ in range(2)])
+        group_stage = TournamentStage.objects.create(tournament=tournament, name='Группа 1. Этап 1', position=1)
+        final = TournamentStage.objects.create(tournament=tournament, name='Этап 1', position=3)
+        StageResult.objects.bulk_create([
+            StageResult(stage=group_stage, participant=first, score=3),
+            StageResult(stage=final, participant=second, score=1),
+        ])
+        Standing.objects.bulk_create([
+            Standing(tournament=tournament, participant=first, group=0, points=3),
+            Standing(tournament=tournament, participant=second, group=0, points=1),
+        ])
+        Participant.objects.filter(id=first.id).update(score=3, final_step_score=3)
+        other = Standing.objects.create(
+            tournament=self.tournament, participant=Participant.objects.filter(tournament=self.tournament).first(), points=5,
+        )
+
+        migration = import_module('main.migrations.0067_backfill_tournamentstage_group')
+        migration.backfill_stage_group(django_apps, None)
+
+        rows = Standing.objects.filter(tournament=tournament).values_list('participant_id', 'group', 'points')
+        self.assertEqual(set(rows), {(first.id, 1, 3), (second.id, 0, 1)})
+        first.refresh_from_db()
+        self.assertEqual((first.score, first.final_step_score), (3, 0))
+        # Таблицы остальных турниров не пересчитываются
+        self.assertTrue(Standing.objects.filter(id=other.id, points=5).exists())
+
+
+class LeaderboardUploadTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.tournament = Tournament.objects.create(
+            name='Test Tournament', owner=self.owner, sport=Sport.objects.create(name='Футбол'),
+            enter_price=0, prize_pool=1000, max_participants=16, bracket=4, tournament_type=0, rounds_count=2,
+        )
+        self.users = User.objects.bulk_create([User(username=f'user_{i}', email=f'user_{i}@mail.ru') for i in range(10)])
+        Participant.objects.bulk_create([Participant(user=user, tournament=self.tournament) for user in self.users])
+        create_leaderboard_bracket(self.tournament)
+        self.stage = TournamentStage.objects.get(tournament=self.tournament, position=1)
+        self.client.force_authenticate(self.owner)
+
+    def upload(self, lines):
+        body = '\n'.join(lines).encode()
+        return self.client.post(
+            reverse('upload_tournament_results', args=[self.tournament.id]), data=body, content_type='application/x-ndjson'
+        )
+
+    def test_upload_in_batches(self):
+        lines = [json.dumps({'participant_id': user.id, 'score': index}) for index, user in enumerate(self.users)]
+        # Повтор заменяет прошлый результат, пустые строки пропускаются
+        lines += ['', json.dumps({'participant_id': self.users[0].id, 'score': 20})]
+
+        with mock.patch('main.services.tournament.RESULTS_BATCH_SIZE', 4), \
+                mock.patch('main.services.tournament.save_stage_scores', wraps=save_stage_scores) as save_mock:
+            response = self.upload(lines)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 11)
+        self.assertEqual(save_mock.call_count, 3)
+
+        results = dict(StageResult.objects.filter(stage=self.stage).values_list('participant__user_id', 'score'))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results[self.users[0].id], 20)
+        self.assertEqual(Participant.objects.get(user=self.users[0], tournament=self.tournament).score, 20)
+
+    def test_upload_errors_rollback(self):
+        lines = [json.dumps({'participant_id': user.id, 'score': 1}) for user in self.users]
+        lines += ['{oops', json.dumps({'participant_id': 0, 'score': 1})]
+        with mock.patch('main.services.tournament.RESULTS_BATCH_SIZE', 4):
+            response = self.upload(lines)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('строка 11: некорректный JSON', response.data['message'])
+        self.assertIn('строка 12: участник 0 не найден', response.data['message'])
+        self.assertFalse(StageResult.objects.filter(stage=self.stage).exists())
+
+
+class StandingsMigrationTests(TransactionTestCase):
+    """Заполнение турнирных таблиц в 0062_standing для двуступенчатого турнира, созданного до поля TournamentStage.group"""
+    migrate_from = [('main', '0059_participant_qualified')]
+    migrate_to = [('main', '0062_standing')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        self.old_apps = executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_two_step_tournament(self):
+        apps = self.old_apps
+        owner = apps.get_model('main', 'User').objects.create(username='owner', email='owner@mail.ru')
+        tournament = apps.get_model('main', 'Tournament').objects.create(
+            name='Test Tournament', owner=owner, sport=apps.get_model('main', 'Sport').objects.create(name='Футбол'),
+            enter_price=0, prize_pool=1000, max_participants=4, participants_in_group=2, bracket=2, tournament_type=1,
+        )
+        participants = [
+            apps.get_model('main', 'Participant').objects.create(tournament=tournament) for _ in range(4)
+        ]
+        TournamentStage = apps.get_model('main', 'TournamentStage')
+        group_1 = TournamentStage.objects.create(tournament=tournament, name='Группа 1. Этап 1', position=1)
+        group_2 = TournamentStage.objects.create(tournament=tournament, name='Группа 2. Этап 2', position=2)
+        final = TournamentStage.objects.create(tournament=tournament, name='Этап 1', position=3)
+        Match = apps.get_model('main', 'Match')
+        Match.objects.create(stage=group_1, participant1=participants[0], participant2=participants[1], participant1_score=2, participant2_score=0, status=2)
+        Match.objects.create(stage=group_2, participant1=participants[2], participant2=participants[3], participant1_score=1, participant2_score=1, status=2)
+        Match.objects.create(stage=final, participant1=participants[0], participant2=participants[2], participant1_score=0, participant2_score=3, status=2)
+        StageResult = apps.get_model('main', 'StageResult')
+        StageResult.objects.bulk_create([
+            StageResult(stage=group_1, participant=participants[0], score=3),
+            StageResult(stage=group_2, participant=participants[2], score=1),
+            StageResult(stage=final, participant=participants[2], score=3),
+        ])
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        new_apps = executor.loader.project_state(self.migrate_to).apps
+
+        standings = new_apps.get_model('main', 'Standing').objects.filter(tournament_id=tournament.id)
+        rows = {(row.participant_id, row.group): (row.points, row.wins, row.draws, row.losses) for row in standings}
+        self.assertEqual(rows, {
+            (participants[0].id, 1): (3, 1, 0, 0),
+            (participants[1].id, 1): (0, 0, 0, 1),
+            (participants[2].id, 2): (1, 0, 1, 0),
+            (participants[3].id, 2): (0, 0, 1, 0),
+            (participants[0].id, 0): (0, 0, 0, 1),
+            (participants[2].id, 0): (3, 1, 0, 0),
+        })
+        scores = dict(
+            new_apps.get_model('main', 'Participant').objects.filter(tournament_id=tournament.id)
+            .values_list('id', 'final_step_score')
+        )
+        self.assertEqual(scores[participants[0].id], 0)
+        self.assertEqual(scores[participants[2].id], 3)
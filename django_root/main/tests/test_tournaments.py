@@ -1,8 +1,10 @@
 from turtle import position
 from rest_framework.test import APITestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from django.urls import reverse
-from main.all_models.tournament import Participant, Tournament, TournamentStage, Match
+from main.all_models.tournament import Participant, Tournament, TournamentPhoto, TournamentStage, Match
 from main.models import User
 from main.all_models.sport import Sport
 import json
@@ -508,3 +510,39 @@ class TournamentsTests(APITestCase):
         # print([(participant.place, participant.user.email) for participant in places])
         for i in range(places_count):
             self.assertEqual(predicted_places[i], places[i].user.email)
+
+
+class TournamentListTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner', email='owner@mail.ru')
+        self.sport = Sport.objects.create(name='Футбол')
+        self.client.force_authenticate(self.owner)
+
+    def create_tournaments(self, count):
+        for index in range(count):
+            tournament = Tournament.objects.create(
+                name=f'Турнир {index}', owner=self.owner, sport=self.sport, enter_price=0, prize_pool=0, max_participants=8,
+            )
+            users = User.objects.bulk_create([User(username=f'{tournament.id}_{i}', email=f'{tournament.id}_{i}@mail.ru') for i in range(6)])
+            Participant.objects.bulk_create([Participant(user=user, tournament=tournament) for user in users])
+            TournamentPhoto.objects.bulk_create([
+                TournamentPhoto(tournament=tournament, photo=f'tournament_photos/{tournament.id}_{i}.jpg') for i in range(2)
+            ])
+
+    def get_list(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('tournament-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'], len(context.captured_queries)
+
+    def test_list_queries_count(self):
+        self.create_tournaments(2)
+        _, small_count = self.get_list()
+        self.create_tournaments(10)
+        results, big_count = self.get_list()
+        self.assertEqual(small_count, big_count)
+
+        first = Tournament.objects.get(id=results[0]['id'])
+        self.assertEqual(len(results[0]['participants']), 4)
+        self.assertEqual(results[0]['participants_count'], 6)
+        self.assertTrue(results[0]['photo'].endswith(first.photos.order_by('id').first().photo.url))
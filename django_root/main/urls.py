@@ -1,11 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from main.views.team import TeamViewSet
-from main.views.amateur_match import AcceptMatch, AcceptMatchRequest, AddMatchParticipants, AmateurMatchViewSet, DeclineMatch, DeleteMatchParticipants, JoinMatch, LeaveMatch, MyMatches, RefuseMatchRequest
+from main.views.amateur_match import AcceptMatch, AcceptMatchRequest, AddMatchParticipants, AmateurMatchViewSet, DeclineMatch, DeleteMatchParticipants, JoinMatch, LeaveMatch, MyMatches, RefuseMatchRequest, GetMatchFacets
 
 from main.views.city import CityRequest
 from main.views.sport import SportViewSet
-from main.views.tournament import EndTournamentStage, AcceptTournament, AcceptTournamentRequest, AddTournamentParticipants, DeclineTournament, DeleteTournamentParticipants, GetTournamentsPrices, JoinTournament, LeaveTournament, RefuseTournamentRequest, SetTournamentModerators, TournamentViewSet, UpdateTournament, CreateTournamentBracket
+from main.views.tournament import EndTournamentStage, AcceptTournament, AcceptTournamentRequest, AddTournamentParticipants, DeclineTournament, DeleteTournamentParticipants, GetTournamentsPrices, JoinTournament, LeaveTournament, RefuseTournamentRequest, SetTournamentModerators, TournamentViewSet, UpdateTournament, CreateTournamentBracket, CommitTournamentBracket, GetTournamentStandings, GetStageFinalizationJob, UploadTournamentResults, GetTournamentBracket, GetTournamentFacets
 from main.views.user import UserViewSet, UserDetail
 
 from main.views.auth import Login, RestorePassword, UserExists
@@ -37,6 +37,7 @@ urlpatterns = [
     path('amateur-matches/accept/', AcceptMatch.as_view(), name='accept_amateur_match'),
     path('amateur-matches/decline/', DeclineMatch.as_view(), name='decline_amateur_match'),
     path('amateur-matches/my/', MyMatches.as_view(), name='my_matches'),
+    path('amateur-matches/facets/', GetMatchFacets.as_view(), name='amateur_match_facets'),
 
     path('match-request/accept/', AcceptMatchRequest.as_view(), name='accept_match_request'),
     path('match-request/refuse/', RefuseMatchRequest.as_view(), name='refuse_match_request'),
@@ -44,15 +45,21 @@ urlpatterns = [
     path('match-request/add/', AddMatchParticipants.as_view(), name='add_match_participants'),
 
     path('tournaments/<int:id>/create-bracket/', CreateTournamentBracket.as_view(), name='create_tournament_bracket'),
+    path('tournaments/<int:id>/create-bracket/commit/', CommitTournamentBracket.as_view(), name='commit_tournament_bracket'),
     path('tournaments/<int:id>/add-participants/', AddTournamentParticipants.as_view(), name='add_tournament_participants'),
     path('tournaments/<int:id>/set-moderators/', SetTournamentModerators.as_view(), name='set_tournament_moderators'),
     path('tournaments/<int:id>/end-stage/', EndTournamentStage.as_view(), name='end_tournament_stage'),
     path('tournaments/<int:id>/update-matches/', UpdateTournament.as_view(), name='update_tournament'),
+    path('tournaments/<int:id>/upload-results/', UploadTournamentResults.as_view(), name='upload_tournament_results'),
+    path('tournaments/<int:id>/bracket/', GetTournamentBracket.as_view(), name='tournament_bracket'),
+    path('tournaments/<int:id>/standings/', GetTournamentStandings.as_view(), name='tournament_standings'),
+    path('tournaments/stage-jobs/<uuid:job_id>/', GetStageFinalizationJob.as_view(), name='stage_job_status'),
     path('tournaments/join/', JoinTournament.as_view(), name='join_tournament'),
     path('tournaments/leave/', LeaveTournament.as_view(), name='leave_tournament'),
     path('tournaments/accept/', AcceptTournament.as_view(), name='accept_tournament'),
     path('tournaments/decline/', DeclineTournament.as_view(), name='decline_tournament'),
     path('tournaments/prices/', GetTournamentsPrices.as_view(), name='tournament_prices'),
+    path('tournaments/facets/', GetTournamentFacets.as_view(), name='tournament_facets'),
     
 
     path('tournament-request/accept/', AcceptTournamentRequest.as_view(), name='accept_tournament_request'),
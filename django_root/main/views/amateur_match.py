@@ -18,10 +18,14 @@ from drf_yasg import openapi
 from main.filters import AmateurMatchFilter
 
 from rest_framework.views import APIView
+from django.db import transaction
 from django.db.models import Count
 
 from django.core.mail import send_mail
 
+from main.services.facets import FACETS_RESPONSE, get_cached_facets
+from main.services.versions import bump_match_version, bumps_match_version, get_etag, get_not_modified_response
+
 
 class AmateurMatchViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
@@ -85,8 +89,25 @@ class AmateurMatchViewSet(viewsets.ModelViewSet):
 
     def perform_update(self, serializer):
         instance = serializer.save()
+        bump_match_version(instance.id)
         self.send_email_to_participants(instance)
 
+    def retrieve(self, request, *args, **kwargs):
+        pk = str(kwargs.get('pk', ''))
+        match = AmateurMatch.objects.only('version').filter(id=pk).first() if pk.isdigit() else None
+        if not match:
+            return super(AmateurMatchViewSet, self).retrieve(request, *args, **kwargs)
+
+        # Если матч не изменился, отвечаем 304 без сериализации
+        etag = get_etag('match', match.id, match.version)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified:
+            return not_modified
+
+        response = super(AmateurMatchViewSet, self).retrieve(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
     def send_email_to_participants(self, match):
         participants = match.participants.all()        
         recipient_list = [participant.email for participant in participants if participant.email]
@@ -154,6 +175,8 @@ class JoinMatch(APIView):
             ),            
     })
 
+    @bumps_match_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -187,6 +210,7 @@ class JoinMatch(APIView):
             # TODO
             # сделать уведомление создателя матча, что на него откликнулись
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Матча с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -223,6 +247,7 @@ class LeaveMatch(APIView):
             ),            
     })
 
+    @bumps_match_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -273,6 +298,8 @@ class AcceptMatchRequest(APIView):
             ),            
     })
 
+    @bumps_match_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -294,6 +321,7 @@ class AcceptMatchRequest(APIView):
 
             return Response({'success': True, 'message': 'Пользователь принят на матч!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Матча или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -331,6 +359,7 @@ class RefuseMatchRequest(APIView):
             ),            
     })
 
+    @bumps_match_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -384,6 +413,8 @@ class DeleteMatchParticipants(APIView):
             ),            
     })
 
+    @bumps_match_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -396,12 +427,14 @@ class DeleteMatchParticipants(APIView):
                 user = User.objects.get(id=user_id)
                 
                 if not match.participants.contains(user):
+                    transaction.set_rollback(True)
                     return Response({'success': False, 'message': 'Переданного пользователя нет в списке участников!'}, status=status.HTTP_400_BAD_REQUEST) 
             
                 match.participants.remove(user)
 
             return Response({'success': True, 'message': 'Пользователь был удален!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Матча или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -439,6 +472,8 @@ class AddMatchParticipants(APIView):
             ),            
     })
 
+    @bumps_match_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -450,6 +485,7 @@ class AddMatchParticipants(APIView):
                 user = User.objects.get(id=user_id)            
 
                 if match.participants.contains(user):
+                    transaction.set_rollback(True)
                     return Response({'success': False, 'message': 'Переданный пользователь уже участвует в этом матче!'}, status=status.HTTP_400_BAD_REQUEST) 
 
                 if match.requests.contains(user):
@@ -459,6 +495,7 @@ class AddMatchParticipants(APIView):
             
             return Response({'success': True, 'message': 'Пользователь добавлен на матч!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Матча или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
         
 
@@ -495,6 +532,7 @@ class AcceptMatch(APIView):
             ),            
     })
 
+    @bumps_match_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -547,6 +585,7 @@ class DeclineMatch(APIView):
             ),            
     })
 
+    @bumps_match_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -563,3 +602,21 @@ class DeclineMatch(APIView):
 
         except:
             return Response({'success': False, 'message': 'Матча с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
+
+
+class GetMatchFacets(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Количество любительских матчей по видам спорта, городам, диапазонам цены участия и датам начала для текущих фильтров списка',
+        manual_parameters=[
+            openapi.Parameter(name, openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False)
+            for name in AmateurMatchFilter.base_filters
+        ],
+        responses={"200": FACETS_RESPONSE},
+    )
+    def get(self, request):
+        filterset = AmateurMatchFilter(request.query_params, queryset=AmateurMatch.objects.all())
+        if not filterset.is_valid():
+            return Response({'success': False, 'message': 'Некорректные фильтры!', 'errors': filterset.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, 'facets': get_cached_facets('matches', filterset)}, status=status.HTTP_200_OK)
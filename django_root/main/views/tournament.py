@@ -1,5 +1,5 @@
 from turtle import position
-from main.all_models.tournament import Match, Participant, StageResult, Tournament, Team, TournamentStage
+from main.all_models.tournament import Match, Participant, StageFinalizationJob, StageResult, Standing, Tournament, Team, TournamentStage
 
 from champion_backend.settings import EMAIL_HOST_USER
 from main.models import User
@@ -15,28 +15,40 @@ from rest_framework import viewsets, status
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-from main.filters import TournamentFilter
+from main.filters import TournamentFilter, get_filters_key
+from main.services.facets import FACETS_RESPONSE, get_cached_facets
 
 from rest_framework.views import APIView
+from rest_framework.exceptions import ValidationError
 
 from django.core.mail import send_mail
 
-from main.serializers.tournament import TournamentListSerializer, TournamentSerializer, TournamentStageSerializer
+from main.serializers.tournament import StageFinalizationJobSerializer, StandingSerializer, TournamentListSerializer, TournamentSerializer, TournamentStageSerializer, get_bracket_data, get_bracket_preview, get_stages_queryset, get_tournament_list_prefetches, get_tournament_prefetches
 
 import json
+from django.db import transaction
 from django.db.models import Q
 
 from django.shortcuts import get_object_or_404
+from django.http import HttpResponse
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 
 from main.services.img_functions import _decode_photo
+from main.services.bracket import load_signed_plan, sign_plan
+from main.services.standings import StandingsChanges
+from main.services.versions import bump_prices_version, get_prices_cache, get_prices_state, bump_tournament_version, bumps_tournament_version, get_not_modified_response, get_tournament_cache, get_tournament_etag
+from main.tasks import end_tournament_stage_task
 
 from django.db.models import Min, Max
 from django.db.models import Count
 
-from main.services.tournament import assign_final_positions_group_stage, assign_final_positions_leaderboard, create_double_elimination_bracket, create_leaderboard_bracket, create_new_swiss_round, create_round_robin_bracket, create_round_robin_bracket_2step, create_single_elimination_bracket, create_swiss_bracket, print_next_matches_for_tournament, print_tournament_bracket, save_stage_score
+from main.services.tournament import assign_final_positions_group_stage, assign_final_positions_leaderboard, create_double_elimination_bracket, create_leaderboard_bracket, create_new_swiss_round, create_round_robin_bracket, create_round_robin_bracket_2step, create_single_elimination_bracket, create_swiss_bracket, plan_tournament_bracket, print_next_matches_for_tournament, print_tournament_bracket, save_stage_scores, get_results_scores, get_updated_matches, import_stage_results, get_prices_histogram, MATCH_UPDATE_FIELDS, end_tournament_stage, get_stages_counts, check_stage_matches_ended
 
 from main.services.tournament import assign_final_positions, assign_final_positions_double_elimination, assign_final_positions_single_elimination
 
+
 class TournamentViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
     filterset_class = TournamentFilter
@@ -63,6 +75,52 @@ class TournamentViewSet(viewsets.ModelViewSet):
         except (KeyError, AttributeError):
             return super(TournamentViewSet, self).get_serializer_class()
 
+    def retrieve(self, request, *args, **kwargs):
+        pk = str(kwargs.get('pk', ''))
+        tournament = Tournament.objects.only('version', 'start', 'register_open_until').filter(id=pk).first() if pk.isdigit() else None
+        if not tournament:
+            return super(TournamentViewSet, self).retrieve(request, *args, **kwargs)
+
+        # Версия читается до данных турнира: ETag и ключ кеша никогда не новее самих данных
+        etag = get_tournament_etag(tournament)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified:
+            return not_modified
+
+        cache = get_tournament_cache()
+        if not cache:
+            response = super(TournamentViewSet, self).retrieve(request, *args, **kwargs)
+            response['ETag'] = etag
+            return response
+
+        # Пока турнир не изменился, отдаем готовый JSON без запросов к базе и сериализации
+        content = cache.get_detail(tournament.id, tournament.version)
+        if content is None:
+            instance = self.get_object()
+            content = JSONRenderer().render(self.get_serializer(instance).data)
+            cache.set_detail(tournament.id, tournament.version, content, timeout=self.get_detail_cache_timeout(instance))
+
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    def get_detail_cache_timeout(self, instance):
+        """is_registration_available меняется со временем, поэтому кеш не должен жить дольше окончания регистрации"""
+        timeout = settings.TOURNAMENT_DETAIL_CACHE_TIMEOUT
+        if instance.start:
+            seconds_left = int((instance.get_registration_end() - timezone.now()).total_seconds())
+            if seconds_left > 0:
+                timeout = min(timeout, seconds_left)
+        return timeout
+
+    def get_queryset(self):
+        queryset = super(TournamentViewSet, self).get_queryset()
+        if self.action == 'retrieve':
+            queryset = queryset.prefetch_related(*get_tournament_prefetches())
+        elif self.action == 'list':
+            queryset = queryset.prefetch_related(*get_tournament_list_prefetches())
+        return queryset
+
     @swagger_auto_schema(
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
@@ -89,9 +147,14 @@ class TournamentViewSet(viewsets.ModelViewSet):
     )
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
+        bump_prices_version()
 
     def perform_update(self, serializer):
+        old_prices = get_prices_state(serializer.instance)
         instance = serializer.save()
+        bump_tournament_version(instance.id)
+        if get_prices_state(instance) != old_prices:
+            bump_prices_version()
         self.send_email_to_participants(instance)
 
     def send_email_to_participants(self, tournament):
@@ -175,6 +238,8 @@ class UpdateTournament(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def patch(self, request, id):
         #try:
             data = json.loads(request.body)
@@ -189,45 +254,82 @@ class UpdateTournament(APIView):
             else:
                 stage = tournament.get_active_stage()
 
-            if results_data and stage:             
-                for result_data in results_data:
-                    participant_id = result_data.get("participant_id", None)
-                    if not participant_id:
-                        return Response({'success': False, 'message': 'Ошибка при обновлении: Участник с переданым participant_id не найден!'}, status=status.HTTP_400_BAD_REQUEST)
-
-                    participant = Participant.objects.get((Q(user__id=participant_id) | Q(team__id=participant_id)) & Q(tournament=tournament))
-                    score = result_data.get("score", 0)
-                    save_stage_score(participant, stage, score)
-                    
-            for match_data in matches_data:
-                match = get_object_or_404(Match, pk=match_data.get("id"))
-                
-                match.scheduled_start = match_data.get("scheduled_start", match.scheduled_start)
-                match.actual_start = match_data.get("actual_start", match.actual_start)
-                match.actual_end = match_data.get("actual_end", match.actual_end)
-                participant_1_score = match_data.get("participant_1_score", None)
-                participant_2_score = match_data.get("participant_2_score", None)   
-
-                winner = None
-                                                                                
-                if participant_1_score > participant_2_score:
-                    winner = match.participant1
-                elif participant_1_score < participant_2_score:
-                    winner = match.participant2                                         
-                     
-                match.winner = winner
-                match.participant1_score = participant_1_score
-                match.participant2_score = participant_2_score
-                match.status = 2                
-
-                match.save()                                      
-
+            # Весь запрос проверяется до записи: матчи и участники загружаются одним запросом каждый
+            standings_changes = StandingsChanges(tournament)
+            try:
+                scores = get_results_scores(tournament, results_data) if results_data and stage else {}
+                matches = get_updated_matches(tournament, matches_data, standings_changes)
+            except ValidationError as error:
+                return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+
+            if scores:
+                save_stage_scores(stage, scores)
+            Match.objects.bulk_update(matches, MATCH_UPDATE_FIELDS)
+            standings_changes.save()
             return Response({'success': True, 'message': 'Турнир обновлен!'}, status=status.HTTP_200_OK)
 
         # except Exception as e:
         #     return Response({'success': False, 'message': f'Ошибка при обновлении: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class UploadTournamentResults(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description=(
+            'Загрузить результаты этапа Leaderboard турнира потоком (Content-Type: application/x-ndjson). '
+            'Каждая строка тела - {"participant_id": id пользователя или команды, "score": очки}. '
+            'Этап передается в stage_id (query), иначе используется активный этап. При ошибке в любой строке ничего не сохраняется.'
+        ),
+        manual_parameters=[
+            openapi.Parameter('stage_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='id Этапа'),
+        ],
+        responses={
+            "200": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'count': 1500,
+                        'message': 'Результаты загружены!'
+                    },
+                }
+            ),
+            "400": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Ошибка при загрузке: строка 3: участник 17 не найден!'
+                    },
+                }
+            ),
+    })
+    @bumps_tournament_version
+    def post(self, request, id):
+        tournament = get_object_or_404(Tournament, id=id)
+        if tournament.owner != request.user and not tournament.moderators.filter(id=request.user.id).exists():
+            return Response({'success': False, 'message': "Только организатор или модераторы могут загружать результаты!"}, status=status.HTTP_403_FORBIDDEN)
+        if tournament.bracket != 4:
+            return Response({'success': False, 'message': "Загрузка результатов доступна только для Leaderboard турниров!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        stage_id = request.query_params.get("stage_id", None)
+        if stage_id:
+            stage = get_object_or_404(TournamentStage, id=stage_id, tournament=tournament)
+        else:
+            stage = tournament.get_active_stage()
+        if not stage:
+            return Response({'success': False, 'message': "Турнир уже завершен или нет активного этапа!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Тело не загружается целиком (request.data/request.body), строки читаются из потока по одной
+        lines = iter(request.stream.readline, b'') if request.stream else []
+        try:
+            count = import_stage_results(tournament, stage, lines)
+        except ValidationError as error:
+            return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, 'count': count, 'message': 'Результаты загружены!'}, status=status.HTTP_200_OK)
+
+
 class EndTournamentStage(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -236,7 +338,8 @@ class EndTournamentStage(APIView):
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             properties={                
-                "stage_id": openapi.Schema(type=openapi.TYPE_INTEGER, description='id Этапа')               
+                "stage_id": openapi.Schema(type=openapi.TYPE_INTEGER, description='id Этапа'),
+                "async": openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Завершить этап в фоне. Возвращает job_id для tournaments/stage-jobs/<job_id>/'),
             }
         ),
         responses={
@@ -249,6 +352,16 @@ class EndTournamentStage(APIView):
                     },                    
                 }
             ),
+            "202": openapi.Response(
+                description='async=true',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'job_id': '8f5b3c2e-3c1a-4d7e-9a51-5d0c1f6a2b7e',
+                        'message': 'Этап турнира завершается'
+                    },
+                }
+            ),
             "401": openapi.Response(
                 description='',                
                 examples={
@@ -260,6 +373,8 @@ class EndTournamentStage(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request, id):
         #try:        
             data = json.loads(request.body)
@@ -278,132 +393,88 @@ class EndTournamentStage(APIView):
             if tournament.owner != request.user and not tournament.moderators.filter(id=request.user.id).exists():
                 return Response({'success': False, 'message': "Только организатор или модераторы могут завершить этап!"}, status=status.HTTP_403_FORBIDDEN) 
             
-            stages_count = TournamentStage.objects.filter(tournament=tournament).count()
-            group_stages_count = tournament.group_stages_count()
-            group_stage_ended = ((tournament.tournament_type == 1) and (stages_count > group_stages_count) or tournament.tournament_type == 0)
-
-            matches = Match.objects.filter(stage=active_stage)
-            if group_stage_ended and tournament.bracket != 4 and not all(match.status == 2 for match in matches):  # Проверяем, завершены ли все матчи
-                return Response({'success': False, 'message': "Не все матчи этапа завершены!"}, status=status.HTTP_400_BAD_REQUEST)
-            
-            if not active_stage.ended:
-                for match in matches:
-                    self.set_scores(match)
-
-                if group_stage_ended:
-                    if tournament.bracket in [0, 1]:
-                        # Proceed to next stage
-                        for match in matches:                                                                                                                     
-                            self.process_match_winner_to_next_stage(match, tournament.bracket)
-                    # Пропускаем эти сетки так как их уже обработали выше
-                    # elif tournament.bracket in [2, 4]:                                                        
-                    #     pass
-                    elif tournament.bracket == 3:                    
-                        # Swiss or other multi-round bracket logic                                                                
-                        should_create_next_round = False
-                        if tournament.tournament_type == 0:
-                            should_create_next_round = tournament.rounds_count > stages_count
-                        else: 
-                            should_create_next_round = (tournament.active_stage_position != group_stages_count + tournament.final_stages_count())
-                        
-                        if should_create_next_round:
-                            new_stage = TournamentStage.objects.create(
-                                name=f"Этап {active_stage.position - group_stages_count + 1}",
-                                tournament=tournament,
-                                position=active_stage.position+1
-                            )
-                            create_new_swiss_round(new_stage, tournament)                                
-                
-                tournament.active_stage_position += 1
-            
-            active_stage.ended = True
-            active_stage.save()
-                    
-            # Если групповой этап окончен создаем финальный
-            if tournament.tournament_type == 1 and tournament.all_stages_ended() and stages_count == group_stages_count:
-                tournament.set_qualified_participants()
-                qualified_participants = tournament.get_qualified_participants()
-                # print(qualified_participants)
-                if tournament.bracket == 0:
-                    create_single_elimination_bracket(tournament, [], list(qualified_participants))
-                elif tournament.bracket == 1:
-                    create_double_elimination_bracket(tournament, [], list(qualified_participants)) 
-                elif tournament.bracket == 2: 
-                    create_round_robin_bracket(tournament, qualified_participants)
-                elif tournament.bracket == 3: 
-                    create_swiss_bracket(tournament, [], list(qualified_participants))
-                elif tournament.bracket == 4: 
-                    create_leaderboard_bracket(tournament)
-            
-            # Если турнир окончен
-            if not tournament.has_next_stage(active_stage):
-                if tournament.bracket == 0:  # Single elimination
-                    assign_final_positions_single_elimination(tournament)
-                elif tournament.bracket == 1:  # Double elimination
-                    assign_final_positions_double_elimination(tournament)
-                elif tournament.bracket == 4: # Leaderboard
-                    assign_final_positions_leaderboard(tournament)
-                else: # Swiss, Round Robin
-                    assign_final_positions(tournament)
-
-                if tournament.tournament_type == 1:
-                    assign_final_positions_group_stage(tournament)
-
-                return Response({'success': True, 'message': "Турнир завершен!"}, status=status.HTTP_200_OK)
-
-            tournament.save()
-            return Response({'success': True, 'message': "Этап турнира завершен!"}, status=status.HTTP_200_OK)
+            if data.get("async", False):
+                # Тяжелая часть выполняется в celery, клиент опрашивает статус задачи
+                return self.start_job(tournament, active_stage)
+
+            try:
+                message = end_tournament_stage(tournament, active_stage)
+            except ValidationError as error:
+                return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'success': True, 'message': message}, status=status.HTTP_200_OK)
         
         # except Tournament.DoesNotExist:
         #     return Response({'success': False, 'message': "Турнир не найден!"}, status=status.HTTP_404_NOT_FOUND)
         # except Exception as error:
         #     return Response({'success': False, 'message': f'Ошибка при обновлении: {str(error)}'}, status=status.HTTP_400_BAD_REQUEST)
 
-    def process_match_winner_to_next_stage(self, match, bracket):
-        # Обновляет следующий матч с победителем текущего матча
-        if match.next_match:
-            if not match.next_match.participant1:
-                match.next_match.participant1 = match.winner
-            elif not match.next_match.participant2:
-                match.next_match.participant2 = match.winner
-            match.next_match.save()
-        if bracket == 1:  # Double elimination logic
-            if match.next_lose_match:
-                loser = match.participant2 if match.participant1 == match.winner else match.participant1
-                if not match.next_lose_match.participant1:
-                    match.next_lose_match.participant1 = loser
-                elif not match.next_lose_match.participant2:
-                    match.next_lose_match.participant2 = loser
-                match.next_lose_match.save()
-
-    def set_scores(self, match):        
-        active_stage = match.stage
-        tournament = active_stage.tournament
-        
-        is_draw = match.participant1_score == match.participant2_score        
-
-        # Увеличиваем очки победителям
-        if tournament.tournament_type == 1 and active_stage.position < (tournament.groups_count() * tournament.rounds_count):
-            # Если турнир двуступенчатый и завершается этап из финальной стадии
-            if is_draw:
-                save_stage_score(match.participant1, active_stage, tournament.group_stage_draw_points)
-                save_stage_score(match.participant2, active_stage, tournament.group_stage_draw_points)
-            else:
-                save_stage_score(match.winner, active_stage, tournament.group_stage_win_points)         
-        elif tournament.tournament_type == 1:
-            if is_draw:
-                save_stage_score(match.participant1, active_stage, tournament.draw_points)         
-                save_stage_score(match.participant2, active_stage, tournament.draw_points)                         
-            else:
-                save_stage_score(match.winner, active_stage, tournament.win_points)         
-        else:
-            if is_draw:
-                save_stage_score(match.participant1, active_stage, tournament.draw_points)         
-                save_stage_score(match.participant2, active_stage, tournament.draw_points)                         
-            else:
-                save_stage_score(match.winner, active_stage, tournament.win_points)         
-    
-    
+    def start_job(self, tournament, stage):
+        # Блокировка этапа до конца транзакции: параллельный запрос дождется созданной задачи и не поставит вторую
+        TournamentStage.objects.select_for_update().get(id=stage.id)
+        job = StageFinalizationJob.objects.filter(stage=stage, status__in=[0, 1]).first()
+        if not job:
+            # Незавершенные матчи проверяются сразу, чтобы не ставить в очередь заведомо неудачную задачу
+            try:
+                _, _, group_stage_ended = get_stages_counts(tournament)
+                check_stage_matches_ended(tournament, Match.objects.filter(stage=stage), group_stage_ended)
+            except ValidationError as error:
+                return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+
+            job = StageFinalizationJob.objects.create(tournament=tournament, stage=stage)
+            transaction.on_commit(lambda: end_tournament_stage_task.delay(str(job.id)))
+
+        return Response({'success': True, 'job_id': job.id, 'message': 'Этап турнира завершается'}, status=status.HTTP_202_ACCEPTED)
+
+
+class GetStageFinalizationJob(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Статус задачи завершения этапа. status: 0 - в очереди, 1 - выполняется, 2 - завершена, 3 - ошибка',
+        responses={
+            "200": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'job': {
+                            'id': '8f5b3c2e-3c1a-4d7e-9a51-5d0c1f6a2b7e',
+                            'tournament': 1,
+                            'stage': 3,
+                            'status': 2,
+                            'message': 'Этап турнира завершен!',
+                            'created_at': '2024-01-02T15:00:00Z',
+                            'finished_at': '2024-01-02T15:00:03Z'
+                        }
+                    },
+                }
+            ),
+            "404": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "detail": "Not found."
+                    },
+                }
+            ),
+            "403": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Только организатор или модераторы могут смотреть статус завершения этапа!'
+                    },
+                }
+            ),
+    })
+    def get(self, request, job_id):
+        job = get_object_or_404(StageFinalizationJob.objects.select_related('tournament'), id=job_id)
+        tournament = job.tournament
+        if tournament.owner != request.user and not tournament.moderators.filter(id=request.user.id).exists():
+            return Response({'success': False, 'message': "Только организатор или модераторы могут смотреть статус завершения этапа!"}, status=status.HTTP_403_FORBIDDEN)
+        return Response({'success': True, 'job': StageFinalizationJobSerializer(job).data}, status=status.HTTP_200_OK)
+
+
 class JoinTournament(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -451,6 +522,8 @@ class JoinTournament(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -496,6 +569,7 @@ class JoinTournament(APIView):
                 else:
                     if is_team:
                         if tournament.teams_requests.contains(new_team):
+                            transaction.set_rollback(True)
                             return Response({'success': False, 'message': 'Вы уже подали заявку на этот матч!'}, status=status.HTTP_400_BAD_REQUEST)                
                         tournament.teams_requests.add(new_team)
                     else:
@@ -510,6 +584,7 @@ class JoinTournament(APIView):
             # TODO
             # сделать уведомление создателя турнира, что на него откликнулись
         except Exception as error:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': str(error)}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -547,6 +622,7 @@ class LeaveTournament(APIView):
             ),            
     })
 
+    @bumps_tournament_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -603,6 +679,8 @@ class AcceptTournamentRequest(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -625,6 +703,7 @@ class AcceptTournamentRequest(APIView):
                     new_participant = Participant.objects.create(user=user, tournament=tournament)
                     tournament.participants.add(new_participant)
                 except:
+                    transaction.set_rollback(True)
                     return Response({'success': False, 'message': 'Пользователь с переданным user id не найден!'}, status=status.HTTP_400_BAD_REQUEST)             
             elif team_id:
                 try:
@@ -639,10 +718,12 @@ class AcceptTournamentRequest(APIView):
                     new_participant = Participant.objects.create(team=team, tournament=tournament)
                     tournament.participants.add(new_participant)
                 except:
+                    transaction.set_rollback(True)
                     return Response({'success': False, 'message': 'Команда с переданным team id не найдена!'}, status=status.HTTP_400_BAD_REQUEST) 
 
             return Response({'success': True, 'message': 'Пользователь принят на матч!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Турнира или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -681,6 +762,7 @@ class RefuseTournamentRequest(APIView):
             ),            
     })
 
+    @bumps_tournament_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -747,6 +829,8 @@ class DeleteTournamentParticipants(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -763,9 +847,11 @@ class DeleteTournamentParticipants(APIView):
                         user = User.objects.get(id=user_id)
                         participant = tournament.participants.filter(user=user).first()
                         if not participant:
+                            transaction.set_rollback(True)
                             return Response({'success': False, 'message': 'Переданного пользователя нет в списке участников!'}, status=status.HTTP_400_BAD_REQUEST)         
                         tournament.users_requests.remove(user)                    
                     except:
+                        transaction.set_rollback(True)
                         return Response({'success': False, 'message': 'Пользователя с переданным user id не существует!'}, status=status.HTTP_400_BAD_REQUEST)                     
                     tournament.participants.remove(participant)
             elif teams_id:
@@ -774,15 +860,18 @@ class DeleteTournamentParticipants(APIView):
                         team = Team.objects.get(id=team_id)
                         participant = tournament.participants.filter(team=team).first()
                         if not participant:
+                            transaction.set_rollback(True)
                             return Response({'success': False, 'message': 'Переданного пользователя нет в списке участников!'}, status=status.HTTP_400_BAD_REQUEST)         
                         tournament.teams_requests.remove(team)
                     except:
+                        transaction.set_rollback(True)
                         return Response({'success': False, 'message': 'Команды с переданным team id не существует!'}, status=status.HTTP_400_BAD_REQUEST)             
 
                     tournament.participants.remove(participant)
             
             return Response({'success': True, 'message': 'Пользователь был удален!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Турнира или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -819,6 +908,8 @@ class AddTournamentParticipants(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request, id):
         try:
             data = json.loads(request.body)
@@ -832,29 +923,34 @@ class AddTournamentParticipants(APIView):
                     try:
                         team = Team.objects.get(id=team_id)
                         if tournament.participants.filter(team=team).exists():
+                            transaction.set_rollback(True)
                             return Response({'success': False, 'message': 'Переданная команда уже учавствует в этом матче!'}, status=status.HTTP_400_BAD_REQUEST) 
                         if tournament.teams_requests.contains(team):
                             tournament.teams_requests.remove(team)
                         new_participant = Participant.objects.create(team=team, tournament=tournament)
                         tournament.participants.add(new_participant)
                     except:
+                        transaction.set_rollback(True)
                         return Response({'success': False, 'message': 'Команды с переданным team id не существует!'}, status=status.HTTP_400_BAD_REQUEST)
             else:
                 for user_id in participants_id:
                     try:
                         user = User.objects.get(id=user_id)                    
                         if tournament.participants.filter(user=user).exists():
+                            transaction.set_rollback(True)
                             return Response({'success': False, 'message': 'Переданный пользователь уже учавствует в этом матче!'}, status=status.HTTP_400_BAD_REQUEST) 
                         if tournament.users_requests.contains(user):
                             tournament.users_requests.remove(user)
                         new_participant = Participant.objects.create(user=user, tournament=tournament)
                         tournament.participants.add(new_participant)
                     except:
+                        transaction.set_rollback(True)
                         return Response({'success': False, 'message': 'Пользователя с переданным user id не существует!'}, status=status.HTTP_400_BAD_REQUEST)            
             
             return Response({'success': True, 'message': 'Пользователь добавлен на матч!'}, status=200)
        
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Турнира или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -877,10 +973,22 @@ class CreateTournamentBracket(APIView):
                         },
                         required=['id']
                     ),
-                )                
+                ),
+                'preview': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='Только построить сетку без сохранения. Сохранить ее можно через create-bracket/commit/ с plan_token из ответа'),
             }
         ),
         responses={
+            "200": openapi.Response(
+                description='Предпросмотр сетки (preview=true)',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'bracket_stages': [],
+                        'plan': {'stages': [], 'matches': []},
+                        'plan_token': 'eyJ0b3VybmFtZW50Ijo...'
+                    },
+                }
+            ),
             "201": openapi.Response(        
                 description='',        
                 examples={
@@ -890,6 +998,15 @@ class CreateTournamentBracket(APIView):
                     },                    
                 }
             ),
+            "400": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Участники не найдены в турнире: 15'
+                    },
+                }
+            ),
             "401": openapi.Response(
                 description='',                
                 examples={
@@ -899,39 +1016,48 @@ class CreateTournamentBracket(APIView):
                     },                    
                 }
             ),            
+            "403": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Только организатор или модераторы могут создать сетку!'
+                    },
+                }
+            ),
     })
 
     def post(self, request, id):
         #try:       
             data = json.loads(request.body)
             matches_data = data.get("matches", None)
-            tournament = Tournament.objects.get(id=id)            
-
-            participants = list(Participant.objects.filter(tournament=tournament))
-            stages_count = TournamentStage.objects.filter(tournament=tournament).count()
-            if tournament.tournament_type == 1:  # Двуступенчатый турнир
-                if stages_count == 0:
-                    create_round_robin_bracket_2step(tournament)
-                else:
-                    participants = []
-
-
-            elif tournament.bracket == 0:  # Single Elimination
-                create_single_elimination_bracket(tournament, matches_data, participants)
+            # Блокировка турнира: два одновременных запроса не должны создать две сетки
+            with transaction.atomic():
+                tournament = get_object_or_404(Tournament.objects.select_for_update(), id=id)
+                if tournament.owner != request.user and not tournament.moderators.filter(id=request.user.id).exists():
+                    return Response({'success': False, 'message': "Только организатор или модераторы могут создать сетку!"}, status=status.HTTP_403_FORBIDDEN)
+
+                participants = list(Participant.objects.filter(tournament=tournament).select_related('user', 'team__sport').prefetch_related('team__members'))
+                # Сетка сначала строится в памяти, данные посева проверяются до записи в БД
+                try:
+                    plan = plan_tournament_bracket(tournament, matches_data, participants)
+                except ValidationError as error:
+                    return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
 
-            elif tournament.bracket == 1:  # Double Elimination
-                create_double_elimination_bracket(tournament, matches_data, participants)
+                if data.get("preview", False):
+                    return Response({
+                        'success': True, 'bracket_stages': get_bracket_preview(plan), 'plan': plan.to_data(), 'plan_token': sign_plan(tournament, plan)
+                    }, status=status.HTTP_200_OK)
 
-            elif tournament.bracket == 2:  # Round Robin
-                create_round_robin_bracket(tournament, participants)
-            
-            elif tournament.bracket == 3:  # Swiss or Leaderboard
-                create_swiss_bracket(tournament, matches_data, participants)
+                positions = [stage.position for stage in plan.stages]
+                if TournamentStage.objects.filter(tournament=tournament, position__in=positions).exists():
+                    return Response({'success': False, 'message': "Сетка турнира уже создана."}, status=status.HTTP_400_BAD_REQUEST)
 
-            elif tournament.bracket == 4:
-                create_leaderboard_bracket(tournament)
+                plan.save(tournament)
+                # Предпросмотр ничего не меняет, поэтому версия увеличивается только здесь
+                bump_tournament_version(tournament.id)
 
-            stages = TournamentStage.objects.filter(tournament=tournament).order_by("position")
+            stages = get_stages_queryset().filter(tournament=tournament)
             stages_serializer = TournamentStageSerializer(stages, many=True)
 
             return Response({'success': True, 'bracket_stages': stages_serializer.data}, status=status.HTTP_201_CREATED) 
@@ -939,6 +1065,181 @@ class CreateTournamentBracket(APIView):
         #     return Response({'success': False, 'message': str(error)}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
+class CommitTournamentBracket(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description=(
+            'Сохранить сетку турнира, полученную в предпросмотре create-bracket/ с preview=true. '
+            'Сетка должна совпадать по форме с сеткой для текущих участников турнира'
+        ),
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            required=['plan_token'],
+            properties={
+                'plan_token': openapi.Schema(type=openapi.TYPE_STRING, description='Поле plan_token из ответа предпросмотра'),
+            },
+        ),
+        responses={
+            "201": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'bracket_stages': []
+                    },
+                }
+            ),
+            "400": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Сетка турнира изменилась после предпросмотра.'
+                    },
+                }
+            ),
+            "403": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": False,
+                        'message': 'Только организатор или модераторы могут создать сетку!'
+                    },
+                }
+            ),
+    })
+    @bumps_tournament_version
+    def post(self, request, id):
+        data = json.loads(request.body)
+        # Проверки и сохранение под блокировкой турнира, иначе два коммита одного плана создадут две сетки
+        with transaction.atomic():
+            tournament = get_object_or_404(Tournament.objects.select_for_update(), id=id)
+            if tournament.owner != request.user and not tournament.moderators.filter(id=request.user.id).exists():
+                return Response({'success': False, 'message': "Только организатор или модераторы могут создать сетку!"}, status=status.HTTP_403_FORBIDDEN)
+            participants = list(Participant.objects.filter(tournament=tournament).select_related('user', 'team'))
+
+            try:
+                plan = load_signed_plan(tournament, data.get("plan_token", None), participants)
+                # Форма сверяется с сеткой, которую сервер построил бы сейчас: за время предпросмотра могли смениться участники
+                expected = plan_tournament_bracket(tournament, None, participants)
+                positions = [stage.position for stage in plan.stages]
+                if not positions or plan.to_shape() != expected.to_shape() or TournamentStage.objects.filter(tournament=tournament, position__in=positions).exists():
+                    raise ValidationError('Сетка турнира изменилась после предпросмотра.')
+                plan.check_participants(expected)
+            except ValidationError as error:
+                return Response({'success': False, 'message': str(error.detail[0])}, status=status.HTTP_400_BAD_REQUEST)
+
+            plan.save(tournament)
+
+        stages = get_stages_queryset().filter(tournament=tournament)
+        stages_serializer = TournamentStageSerializer(stages, many=True)
+        return Response({'success': True, 'bracket_stages': stages_serializer.data}, status=status.HTTP_201_CREATED)
+
+
+class GetTournamentBracket(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description=(
+            'Сетка турнира в нормализованном виде. Матчи ссылаются на этапы, участников и следующие матчи по id, '
+            'участники передаются один раз в словаре participants'
+        ),
+        responses={
+            "200": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'stages': [
+                            {'id': 1, 'name': 'Этап 1', 'position': 1, 'group': None, 'start': None, 'end': None, 'ended': False},
+                        ],
+                        'matches': [
+                            {
+                                'id': 10, 'stage_id': 1, 'scheduled_start': '2024-01-02T15:00:00Z', 'actual_start': None, 'actual_end': None, 'status': 0,
+                                'participant1_id': 5, 'participant2_id': 6, 'participant1_score': 0, 'participant2_score': 0,
+                                'winner_id': None, 'next_match_id': 12, 'next_lose_match_id': None
+                            },
+                        ],
+                        'results': [
+                            {'stage_id': 1, 'participant_id': 5, 'score': 3},
+                        ],
+                        'participants': {
+                            '5': {'user': {}, 'team': None, 'score': 3},
+                        },
+                    },
+                }
+            ),
+            "304": openapi.Response(description='Сетка не изменилась с версии из If-None-Match'),
+            "404": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "detail": "Not found."
+                    },
+                }
+            ),
+    })
+    def get(self, request, id):
+        tournament = get_object_or_404(Tournament, id=id)
+        etag = get_tournament_etag(tournament, prefix='bracket')
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified:
+            return not_modified
+        return Response({'success': True, **get_bracket_data(tournament)}, status=status.HTTP_200_OK, headers={'ETag': etag})
+
+
+class GetTournamentStandings(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Турнирная таблица. Для двуступенчатого турнира отдельная таблица для каждой группы (group 0 - финальная стадия)',
+        responses={
+            "200": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "success": True,
+                        'standings': [
+                            {
+                                'group': 0,
+                                'rows': [
+                                    {'place': 1, 'participant': {}, 'points': 9, 'wins': 3, 'draws': 0, 'losses': 0, 'score_difference': 7},
+                                ]
+                            },
+                        ]
+                    },
+                }
+            ),
+            "404": openapi.Response(
+                description='',
+                examples={
+                    "application/json": {
+                        "detail": "Not found."
+                    },
+                }
+            ),
+    })
+    def get(self, request, id):
+        tournament = get_object_or_404(Tournament, id=id)
+        standings = (
+            Standing.objects.filter(tournament=tournament)
+            .select_related('participant__user', 'participant__team__sport')
+            .prefetch_related('participant__team__members')
+            .order_by('group', '-points', '-score_difference', '-wins', 'participant_id')
+        )
+
+        groups = {}
+        for standing in standings:
+            rows = groups.setdefault(standing.group, [])
+            rows.append({'place': len(rows) + 1, **StandingSerializer(standing).data})
+
+        return Response({
+            'success': True,
+            'standings': [{'group': group, 'rows': rows} for group, rows in groups.items()]
+        }, status=status.HTTP_200_OK)
+
+
 class SetTournamentModerators(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -972,6 +1273,8 @@ class SetTournamentModerators(APIView):
             ),            
     })
 
+    @bumps_tournament_version
+    @transaction.atomic
     def post(self, request, id):
         try:
             data = json.loads(request.body)
@@ -987,10 +1290,12 @@ class SetTournamentModerators(APIView):
                         user = User.objects.get(id=user_id)                    
                         tournament.moderators.add(user)
                     except:
+                        transaction.set_rollback(True)
                         return Response({'success': False, 'message': 'Пользователя с переданным user id не существует!'}, status=status.HTTP_400_BAD_REQUEST)                     
 
             return Response({'success': True, 'message': 'Модераторы турнира изменены!'}, status=200)
         except:
+            transaction.set_rollback(True)
             return Response({'success': False, 'message': 'Турнира или пользователя с таким id не найдено!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
 
@@ -1027,6 +1332,7 @@ class AcceptTournament(APIView):
             ),            
     })
 
+    @bumps_tournament_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -1079,6 +1385,7 @@ class DeclineTournament(APIView):
             ),            
     })
 
+    @bumps_tournament_version
     def post(self, request):
         try:
             data = json.loads(request.body)
@@ -1088,6 +1395,7 @@ class DeclineTournament(APIView):
             
             if request.user.role == 3: # admin
                 tournament.delete()
+                bump_prices_version()
             else:
                 return Response({'success': False, 'message': 'Принять или Отклонить матч может только Админ!'}, status=status.HTTP_401_UNAUTHORIZED) 
 
@@ -1101,7 +1409,11 @@ class GetTournamentsPrices(APIView):
     permission_classes = [IsAuthenticated]
 
     @swagger_auto_schema(
-        operation_description='Получить количество турниров для разлинчых диапозонов призовых фондов и вступительных взносов',                
+        operation_description='Получить количество турниров для разлинчых диапозонов призовых фондов и вступительных взносов. Принимает те же фильтры, что и список турниров',
+        manual_parameters=[
+            openapi.Parameter(name, openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False)
+            for name in TournamentFilter.base_filters
+        ],
         responses={
             "200": openapi.Response(        
                 description='',        
@@ -1146,44 +1458,36 @@ class GetTournamentsPrices(APIView):
     })
 
     def get(self, request):
-        tournaments = Tournament.objects.all()
-
-        min_prize = tournaments.aggregate(min_price=Min('prize_pool'))['min_price']
-        max_prize = tournaments.aggregate(max_price=Max('prize_pool'))['max_price']
-        min_enter = tournaments.aggregate(min_price=Min('enter_price'))['min_price']
-        max_enter = tournaments.aggregate(max_price=Max('enter_price'))['max_price']
-
-        min_prize = min_prize if min_prize else 0
-        max_prize = max_prize if max_prize else 0
-        min_enter = min_enter if min_enter else 0
-        max_enter = max_enter if max_enter else 0
-
-        num_intervals = 20
-        prize_interval_size = (max_prize - min_prize) / num_intervals
-        enter_interval_size = (max_enter - min_enter) / num_intervals
-
-        prize_pool = []
-        enter_price = []
-
-        for i in range(num_intervals):
-            start_prize = min_prize + i * prize_interval_size
-            end_prize = start_prize + prize_interval_size
-            count_prize = tournaments.filter(prize_pool__gte=start_prize, prize_pool__lte=end_prize).count()
-
-            prize_pool.append({
-                "start_price": start_prize,
-                "end_price": end_prize,
-                "count": count_prize
-            })
-
-            start_enter = min_enter + i * enter_interval_size
-            end_enter = start_enter + enter_interval_size
-            count_enter = tournaments.filter(enter_price__gte=start_enter, enter_price__lte=end_enter).count()
-
-            enter_price.append({
-                "start_price": start_enter,
-                "end_price": end_enter,
-                "count": count_enter
-            })
-
-        return Response({'prize_pool': prize_pool, 'enter_price': enter_price}, status=200)
\ No newline at end of file
+        filterset = TournamentFilter(request.query_params, queryset=Tournament.objects.all())
+        if not filterset.is_valid():
+            return Response({'success': False, 'message': 'Некорректные фильтры!', 'errors': filterset.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        filters_key = get_filters_key(filterset)
+
+        cache = get_prices_cache()
+        version = cache.get_version() if cache else None
+        histogram = cache.get_histogram(version, filters_key) if version is not None else None
+        if histogram is None:
+            histogram = get_prices_histogram(filterset.qs)
+            if version is not None:
+                cache.set_histogram(version, filters_key, histogram)
+
+        return Response(histogram, status=200)
+
+
+class GetTournamentFacets(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Количество турниров по видам спорта, городам, диапазонам цены участия и датам начала для текущих фильтров списка',
+        manual_parameters=[
+            openapi.Parameter(name, openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False)
+            for name in TournamentFilter.base_filters
+        ],
+        responses={"200": FACETS_RESPONSE},
+    )
+    def get(self, request):
+        filterset = TournamentFilter(request.query_params, queryset=Tournament.objects.all())
+        if not filterset.is_valid():
+            return Response({'success': False, 'message': 'Некорректные фильтры!', 'errors': filterset.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, 'facets': get_cached_facets('tournaments', filterset)}, status=status.HTTP_200_OK)